@@ -11,101 +11,20 @@ Shepherd 03/20
 # imports
 import numpy as np
 from pathlib import Path
-from pycromanager import Dataset
 import npy2bdv
 import gc
 import sys
 import getopt
-import re
-from skimage.measure import block_reduce
 from skimage.util import apply_parallel
 import time
-from numba import njit, prange
-
-# perform stage scanning reconstruction using orthogonal interpolation
-# http://numba.pydata.org/numba-doc/latest/user/parallel.html#numba-parallel
-@njit(parallel=True)
-def stage_deskew(data,parameters):
-
-    # unwrap parameters 
-    theta = parameters[0]             # (degrees)
-    distance = parameters[1]          # (nm)
-    pixel_size = parameters[2]        # (nm)
-    [num_images,ny,nx]=data.shape  # (pixels)
-
-    # change step size from physical space (nm) to camera space (pixels)
-    pixel_step = distance/pixel_size    # (pixels)
-
-    # calculate the number of pixels scanned during stage scan 
-    scan_end = num_images * pixel_step  # (pixels)
-
-    # calculate properties for final image
-    final_ny = np.int64(np.ceil(scan_end+ny*np.cos(theta*np.pi/180))) # (pixels)
-    final_nz = np.int64(np.ceil(ny*np.sin(theta*np.pi/180)))          # (pixels)
-    final_nx = np.int64(nx)                                           # (pixels)
-
-    # create final image
-    output = np.zeros((final_nz, final_ny, final_nx),dtype=np.float32)  # (pixels,pixels,pixels - data is float32)
-
-    # precalculate trig functions for scan angle
-    tantheta = np.float32(np.tan(theta * np.pi/180)) # (float32)
-    sintheta = np.float32(np.sin(theta * np.pi/180)) # (float32)
-    costheta = np.float32(np.cos(theta * np.pi/180)) # (float32)
-
-    # perform orthogonal interpolation
-
-    # loop through output z planes
-    # defined as parallel loop in numba
-    # http://numba.pydata.org/numba-doc/latest/user/parallel.html#numba-parallel
-    for z in prange(0,final_nz):
-        # calculate range of output y pixels to populate
-        y_range_min=np.minimum(0,np.int64(np.floor(np.float32(z)/tantheta)))
-        y_range_max=np.maximum(final_ny,np.int64(np.ceil(scan_end+np.float32(z)/tantheta+1)))
-
-        # loop through final y pixels
-        # defined as parallel loop in numba
-        # http://numba.pydata.org/numba-doc/latest/user/parallel.html#numba-parallel
-        for y in prange(y_range_min,y_range_max):
-
-            # find the virtual tilted plane that intersects the interpolated plane 
-            virtual_plane = y - z/tantheta
-
-            # find raw data planes that surround the virtual plane
-            plane_before = np.int64(np.floor(virtual_plane/pixel_step))
-            plane_after = np.int64(plane_before+1)
-
-            # continue if raw data planes are within the data range
-            if ((plane_before>=0) and (plane_after<num_images)):
-                
-                # find distance of a point on the  interpolated plane to plane_before and plane_after
-                l_before = virtual_plane - plane_before * pixel_step
-                l_after = pixel_step - l_before
-                
-                # determine location of a point along the interpolated plane
-                za = z/sintheta
-                virtual_pos_before = za + l_before*costheta
-                virtual_pos_after = za - l_after*costheta
-
-                # determine nearest data points to interpoloated point in raw data
-                pos_before = np.int64(np.floor(virtual_pos_before))
-                pos_after = np.int64(np.floor(virtual_pos_after))
-
-                # continue if within data bounds
-                if ((pos_before>=0) and (pos_after >= 0) and (pos_before<ny-1) and (pos_after<ny-1)):
-                    
-                    # determine points surrounding interpolated point on the virtual plane 
-                    dz_before = virtual_pos_before - pos_before
-                    dz_after = virtual_pos_after - pos_after
-
-                    # compute final image plane using orthogonal interpolation
-                    output[z,y,:] = (l_before * dz_after * data[plane_after,pos_after+1,:] + \
-                                    l_before * (1-dz_after) * data[plane_after,pos_after,:] + \
-                                    l_after * dz_before * data[plane_before,pos_before+1,:] + \
-                                    l_after * (1-dz_before) * data[plane_before,pos_before,:]) /pixel_step
-
-
-    # return output
-    return output
+
+# shared deskew engine lives with the reconstruction scripts
+sys.path.append(str(Path(__file__).resolve().parents[1] / 'Reconstruction-python'))
+from deskew_engine import stage_deskew_channels, QUALITY_MODES
+from memory_planner import plan_frame_blocks, block_ranges, print_memory_plan
+from opm_pipeline import prefetch, BackgroundBdvWriter, print_pipeline_report
+from opm_io import open_strip, read_strip
+from opm_manifest import load_manifest, manifest_strips, manifest_counts
 
 # parse experimental directory, load data, perform orthogonal deskew, and save as BDV H5 file
 def main(argv):
@@ -113,24 +32,40 @@ def main(argv):
     # parse directory name from command line argument 
     input_dir_string = ''
     output_dir_string = ''
+    quality = 'orthogonal'
+    output_scale = 1.0
+    memory_budget = None
+    # frames at the start of every strip acquired while the stage speeds up
+    skip_frames = 10
 
     try:
-        arguments, values = getopt.getopt(argv,"hi:o:n:c:",["help","ipath=","opath="])
+        arguments, values = getopt.getopt(argv,"hi:o:n:c:q:s:m:f:",["help","ipath=","opath=","quality=","scale=","memory=","skip="])
     except getopt.GetoptError:
-        print('Error. stage_recon.py -i <inputdirectory> -o <outputdirectory>')
+        print('Error. stage_recon.py -i <inputdirectory> -o <outputdirectory> -q <nearest|orthogonal|cubic> -s <output scale> -m <RAM budget in GB> -f <lead-in frames to skip>')
         sys.exit(2)
     for current_argument, current_value in arguments:
         if current_argument == '-h':
-            print('Usage. stage_recon.py -i <inputdirectory> -o <outputdirectory>')
+            print('Usage. stage_recon.py -i <inputdirectory> -o <outputdirectory> -q <nearest|orthogonal|cubic> -s <output scale> -m <RAM budget in GB> -f <lead-in frames to skip>')
             sys.exit()
         elif current_argument in ("-i", "--ipath"):
             input_dir_string = current_value
         elif current_argument in ("-o", "--opath"):
             output_dir_string = current_value
+        elif current_argument in ("-q", "--quality"):
+            quality = current_value
+        elif current_argument in ("-s", "--scale"):
+            output_scale = float(current_value)
+        elif current_argument in ("-m", "--memory"):
+            memory_budget = int(float(current_value)*1e9)
+        elif current_argument in ("-f", "--skip"):
+            skip_frames = int(current_value)
         
     if (input_dir_string == ''):
         print('Input parse error.')
         sys.exit(2)
+    if quality not in QUALITY_MODES:
+        print('Quality parse error. Use one of '+', '.join(QUALITY_MODES)+'.')
+        sys.exit(2)
 
     # Load data
     # this approach assumes data is generated by QI2lab pycromanager control code
@@ -139,100 +74,118 @@ def main(argv):
     # Create Path object to directory
     input_dir_path=Path(input_dir_string)
 
-    # determine number of directories in root directory. loop over each one.
-    tile_dir_path = [f for f in input_dir_path.iterdir() if f.is_dir()]
-    num_tiles = len(tile_dir_path)
-
-    # TO DO: read text file with this information in root directory
-    num_y = 73
-    num_z = 3
-    num_channels = 2
-    split=40
-
     # create parameter array
     # [theta, stage move distance, camera pixel size]
     # units are [degrees,nm,nm]
+    # used unless the acquisition recorded its own
     params=np.array([30,200,115],dtype=np.float32)
 
+    # tiles, heights, and channels come from the acquisition manifest written by run_opm_pycromanager.py.
+    # Experiments acquired without one are indexed once and the manifest is saved for the next run.
+    manifest = load_manifest(input_dir_path, params=params)
+    params = np.array(manifest['params'],dtype=np.float32)
+    strips = manifest_strips(manifest)
+    num_channels, num_y, num_z = manifest_counts(manifest)
+    # tile and height IDs of the acquisition, whose positions number the H5 tiles
+    y_ids = sorted({strip['tile'] for strip in strips})
+    z_ids = sorted({strip['height'] for strip in strips})
+
     # check if user provided output path
     if (output_dir_string==''):
         output_dir_path = input_dir_path
     else:
         output_dir_path = Path(output_dir_string)
 
+    # blocks are planned for the longest strip. Split each strip into the fewest overlapping blocks of frames
+    # whose channels fit in the RAM budget together, with the next block read and the previous one written during
+    # every deskew. BDV sub-sampling levels are shared by the memory planner and the writer.
+    subsamp = ((1,1,1),(2,2,2),(4,4,4),(8,8,8),(16,16,16))
+    num_x = max([strip['frames'] for strip in strips])-skip_frames
+    memory_plan = plan_frame_blocks(num_x, tuple(manifest['frame_shape']), params, num_channels=num_channels, dtype=manifest['dtype'], z_bin=2, \
+        output_dtype=np.uint16, quality=quality, subsamp=subsamp, overlap=0.05, budget_bytes=memory_budget, \
+        pipelined=True)
+    print_memory_plan(memory_plan)
+    num_blocks = memory_plan.num_blocks
+
     # https://github.com/nvladimus/npy2bdv
     # create BDV H5 file with sub-sampling for BigStitcher
+    # views are written by a background thread while the next block is deskewed. The memory plan counts one block of
+    # every channel being written, so the writer queues no more than that.
     output_path = output_dir_path / 'full.h5'
-    bdv_writer = npy2bdv.BdvWriter(str(output_path), nchannels=num_channels, ntiles=(num_z*num_y*split)+1, \
-        subsamp=((1,1,1),(2,2,2),(4,4,4),(8,8,8),(16,16,16)),blockdim=((16, 16, 8),))
-
-    # loop over each directory. Each directory will be placed as a "tile" into the BigStitcher file
-    # TO DO: implement directory polling to do this in the background while data is being acquired.
-    for tile in range(0,num_tiles):
-
-        # load tile
-        tile_dir_path_to_load = tile_dir_path[tile]
-        print('Loading directory: '+str(tile_dir_path_to_load))
-
-        # decode directory name to determine tile_id in h5. reverse Z order, normal y order
-        test_string = tile_dir_path_to_load.parts[-1].split('_')
-        for i in range(len(test_string)):
-            if 'y0' in test_string[i]:
-                y_idx = int(test_string[i].split('y')[1])
-            if 'z0' in test_string[i]:
-                z_idx = int(test_string[i].split('z')[1])
-
-        tile_id = ((num_z-z_idx-1)*(num_y))+y_idx
-        print('y index: '+str(y_idx)+' z index: '+str(z_idx)+' H5 tile id: '+str(tile_id))
-
-        # https://pycro-manager.readthedocs.io/en/latest/read_data.html
-        dataset = Dataset(tile_dir_path_to_load)
-        
-        # extract number of images in the tile
-        num_x = len(dataset.axes['x'])
-        num_x = num_x-10
+    pipeline_stats = {}
+    bdv_writer = BackgroundBdvWriter(npy2bdv.BdvWriter(str(output_path), nchannels=num_channels, ntiles=(num_z*num_y*num_blocks)+1, \
+        subsamp=subsamp,blockdim=((16, 16, 8),)), max_bytes=memory_plan.binned_bytes//2, stats=pipeline_stats, name='write')
 
-        # loop over channels inside tile
-        for channel_id in range(num_channels):
+    # read every block of every strip, in order. Runs in the background while the previous block is deskewed.
+    def read_blocks():
+
+        # loop over each strip. Each strip will be placed as a "tile" into the BigStitcher file
+        # TO DO: implement directory polling to do this in the background while data is being acquired.
+        for strip in strips:
+
+            # load tile
+            tile_dir_path_to_load = input_dir_path / strip['path']
+            print('Loading directory: '+str(tile_dir_path_to_load))
+
+            # determine tile_id in h5. reverse Z order, normal y order
+            y_idx = y_ids.index(strip['tile'])
+            z_idx = z_ids.index(strip['height'])
 
-            # read images from dataset. Skip first 10 images for stage speed up
-            sub_stack = np.zeros([num_x,256,1600])
-            for i in range(num_x):
-                sub_stack[i,:,:] = dataset.read_image(channel=channel_id, x=i+10, y=0, z=0, read_metadata=False)
-
-            #TO DO: Integrate Microvolution hook here to do deconvolution on skewed data before deskewing.
-            
-            print('Deskew tile.')
-            # run deskew
-            deskewed = stage_deskew(data=sub_stack,parameters=params)
-            del sub_stack
-            gc.collect()
-
-            # downsample by 2x in z due to oversampling when going from OPM to coverslip geometry
-            deskewed_downsample = block_reduce(deskewed, block_size=(2,1,1), func=np.mean)
-            del deskewed
-            gc.collect()
-
-            print('Split and write tiles.')
-            # write BDV tile
-            # https://github.com/nvladimus/npy2bdv 
-            for split_id in range(split):
-                size = np.floor(num_x/split)
-                size_overlap = size * 1.1
-
-                if split_id == split-1:
-                    deskewed_downsample_substack = deskewed_downsample[split_id*size:]
-                else:
-                    deskewed_downsample_substack = deskewed_downsample[split_id*size:(split_id+1)*size_overlap]
-
-                bdv_writer.append_view(deskewed_downsample_substack, time=0, channel=channel_id, 
-                                        tile=(tile_id*split)+split_id,
-                                        voxel_size_xyz=(.115,.115,.200), voxel_units='um')
-
-            # free up memory
-            del deskewed_downsample
-            #del deskewed_downsample
-            gc.collect()
+            tile_id = ((num_z-z_idx-1)*(num_y))+y_idx
+            print('y index: '+str(y_idx)+' z index: '+str(z_idx)+' H5 tile id: '+str(tile_id))
+
+            # file and pixel offset of every frame, straight from the NDTiff index, or the packed container of the strip
+            # https://pycro-manager.readthedocs.io/en/latest/read_data.html
+            source = open_strip(input_dir_path, strip)
+
+            # extract number of images in the tile
+            num_x = source.num_frames-skip_frames
+
+            # each block of the strip is its own BDV tile, with a small overlap for alignment in BigStitcher
+            for block_id, (block_start, block_end) in enumerate(block_ranges(num_x, num_blocks, overlap=0.05)):
+
+                # read images from dataset for every channel. Skip first frames for stage speed up
+                print('Loading block '+str(block_id+1)+' of '+str(num_blocks)+'.')
+                sub_stack = read_strip(source, block_start, block_end, skip_frames=skip_frames, report=True)
+
+                yield tile_id, block_id, sub_stack
+                del sub_stack
+
+    # deskew one block of every channel
+    def deskew_block(block):
+        tile_id, block_id, sub_stack = block
+
+        #TO DO: Integrate Microvolution hook here to do deconvolution on skewed data before deskewing.
+
+        print('Deskew block '+str(block_id+1)+'.')
+        # run deskew for all channels in one pass over the interpolation geometry
+        # downsample by 2x in z due to oversampling when going from OPM to coverslip geometry
+        deskewed_channels = stage_deskew_channels(data=sub_stack,parameters=params,z_bin=2,quality=quality,output_dtype=np.uint16,scale=output_scale)
+        return tile_id, block_id, deskewed_channels
+
+    # queue one deskewed block of every channel for writing
+    def write_block(block):
+        tile_id, block_id, deskewed_channels = block
+
+        print('Writing deskewed block '+str(block_id+1)+'.')
+        # write BDV tile for every channel
+        # https://github.com/nvladimus/npy2bdv 
+        for channel_id in range(num_channels):
+            bdv_writer.append_view(deskewed_channels[channel_id], time=0, channel=channel_id, 
+                                    tile=(tile_id*num_blocks)+block_id,
+                                    voxel_size_xyz=(.115,.115,.200), voxel_units='um')
+
+    # reading, deskewing, and writing overlap. The stage timings show which one limits the reconstruction.
+    pipeline_start = time.perf_counter()
+    for block in prefetch(read_blocks(), depth=1, stats=pipeline_stats, name='read'):
+        deskewed_block = deskew_block(block)
+        del block
+        write_block(deskewed_block)
+        del deskewed_block
+
+    # wait for the last block to be written
+    bdv_writer.flush()
+    print_pipeline_report(pipeline_stats, time.perf_counter()-pipeline_start)
 
     # write BDV xml file
     # https://github.com/nvladimus/npy2bdv
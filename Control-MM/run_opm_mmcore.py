@@ -23,6 +23,13 @@ import numpy as np
 import time
 import os
 import gc
+import sys
+
+# acquisition manifest lives with the reconstruction scripts
+sys.path.append(str(Path(__file__).resolve().parents[1] / 'Reconstruction-python'))
+from opm_manifest import new_manifest, add_strip, write_manifest
+from opm_pipeline import BackgroundBdvWriter
+from memory_planner import available_memory_bytes, _writer_staging_bytes
 
 def main():
 
@@ -101,8 +108,9 @@ def main():
     # change core timeout for long stage moves
     core.set_property('Core','TimeoutMs',100000)
 
-    # set circular buffer to 10 GB
-    core.set_circular_buffer_memory_footprint(15000)
+    # set circular buffer to 15 GB
+    circular_buffer_mb = 15000
+    core.set_circular_buffer_memory_footprint(circular_buffer_mb)
 
     # crop FOV
     #core.set_roi(*ROI)
@@ -273,18 +281,38 @@ def main():
     print('Number of channels:' +str(np.sum(channel_states)))
     print('Number of BDV H5 tiles: '+str(total_tiles))
 
+    # acquisition manifest. Rewritten after every strip, so the reconstruction never has to scan the save directory.
+    # strips are recorded with their laser index. The BDV channel is the position of that index in the manifest channels.
+    channel_names = ['405nm','488nm','561nm','637nm','730nm']
+    active_channels = [c for c in range(len(channel_states)) if channel_states[c]==1]
+    manifest = new_manifest('bdv', params=[30.,scan_axis_step_um*1000.,pixel_size_um*1000.], \
+        channels=active_channels, channel_names=[channel_names[c] for c in active_channels], \
+        frame_shape=(ROI[3],ROI[2]), dtype=np.uint16)
+
     # define unit tranformation matrix
     unit_matrix = np.array(((1.0, 0.0, 0.0, 0.0), # change the 4. value for x_translation (px)
                         (0.0, 1.0, 0.0, 0.0), # change the 4. value for y_translation (px)
                         (0.0, 0.0, 1.0, 0.0)))# change the 4. value for z_translation (px)
 
+    # RAM left for strips queued for writing, once the circular buffer, the strip being acquired, and the npy2bdv
+    # staging of the strip being written are taken out. Strips are only written while the next one is acquired if at
+    # least one fits. Otherwise each strip is written before the next one, with the circular buffer shrunk meanwhile.
+    strip_bytes = int(scan_axis_positions)*ROI[3]*ROI[2]*np.dtype(np.uint16).itemsize
+    write_queue_bytes = available_memory_bytes() - circular_buffer_mb*1024*1024 - strip_bytes - \
+        _writer_staging_bytes((int(scan_axis_positions),ROI[3],ROI[2]), ((1, 1, 1),))
+    overlap_writes = write_queue_bytes >= strip_bytes
+    print('Strips written '+('while the next one is acquired' if overlap_writes else 'between acquisitions')+ \
+        '. Write queue: {:.2f} GB, strip: {:.2f} GB.'.format(max(write_queue_bytes,0)/1e9, strip_bytes/1e9))
+
     # run acquisition over all positions
     for y in range(tile_axis_positions):
 
         # create BDV H5 using npy2bdv
         y_save_name = str(save_name) + '_y'+str(y).zfill(4)+'.h5'
         fname = save_directory/Path(y_save_name)
-        bdv_writer = npy2bdv.BdvWriter(fname, nchannels=np.sum(channel_states), ntiles=height_axis_positions, subsamp=((1, 1, 1),), blockdim=((256,16,128),))
+        # strips are written by a background thread, queued up to the RAM left next to the circular buffer
+        bdv_writer = BackgroundBdvWriter(npy2bdv.BdvWriter(fname, nchannels=np.sum(channel_states), ntiles=height_axis_positions, subsamp=((1, 1, 1),), blockdim=((256,16,128),)), \
+            max_bytes=max(write_queue_bytes,0))
 
         # reset tile index for BDV H5 file
         tile_index = 0
@@ -347,7 +375,7 @@ def main():
                     z_now = core.get_position(z_stage)
                             
                     # calculate affine matrix components for translation transformation
-                    affine_matrix = unit_matrix
+                    affine_matrix = unit_matrix.copy()
                     affine_matrix[0,3] = y_now/pixel_size_um # x axis in BDV H5 (tile axis on scope).
                     affine_matrix[1,3] = z_now/(pixel_size_um*np.sin(30.*np.pi/180.)) # y axis in BDV H5 (height axis on scope).
                     affine_matrix[2,3] = x_now/(pixel_size_um*np.cos(30.*np.pi/180.)) # z axis in BDV H5 (scan axis on scope).
@@ -411,20 +439,28 @@ def main():
                     # this is necessary to avoid PVCAM driver issues that we keep having for long acquisitions.
                     core.set_property('Camera','TriggerMode','Internal Trigger')
 
-                    # set circular buffer to 0.1 GB for H5 processing/writing step
-                    core.set_circular_buffer_memory_footprint(100)
+                    # set circular buffer to 0.1 GB for H5 processing/writing step if the write cannot overlap the next acquisition
+                    if not overlap_writes:
+                        core.set_circular_buffer_memory_footprint(100)
 
-                    # write from np.memmap to BDV H5 with stage translations
+                    # queue the strip for writing to BDV H5 with stage translations. Blocks while the write queue is full.
                     bdv_writer.append_view(stack=raw_data, time=0, channel=channel_index, tile=tile_index, 
                                            m_affine=affine_matrix, name_affine = 'stage translation', 
                                            voxel_size_xyz=(pixel_size_um,pixel_size_um,scan_axis_step_um), voxel_units='um')
 
+                    # otherwise wait for the write and set circular buffer back to 15 GB
+                    if not overlap_writes:
+                        bdv_writer.flush()
+                        core.set_circular_buffer_memory_footprint(circular_buffer_mb)
+
                     # clean up memory
                     del raw_data
                     gc.collect()
 
-                    # set circular buffer to 15 GB
-                    core.set_circular_buffer_memory_footprint(15000)
+                    # add this strip to the acquisition manifest
+                    add_strip(manifest, y_save_name, y, scan_axis_positions, channel=c, height=z, \
+                        position_um=(x_now,y_now,z_now), view=(channel_index,tile_index))
+                    write_manifest(save_directory, manifest)
 
                     # increment channel index for BDV H5 file
                     channel_index = channel_index + 1
@@ -11,6 +11,11 @@ from pycromanager import Bridge, Acquisition
 from pathlib import Path
 import numpy as np
 import time
+import sys
+
+# acquisition manifest lives with the reconstruction scripts
+sys.path.append(str(Path(__file__).resolve().parents[1] / 'Reconstruction-python'))
+from opm_manifest import new_manifest, add_strip, write_manifest
 
 
 def camera_hook_fn(event,bridge,event_queue):
@@ -284,6 +289,15 @@ def main():
 
     #time.sleep(10)
 
+    # acquisition manifest. Rewritten after every strip, so the reconstruction never has to scan the save directory.
+    # channels are numbered in acquisition order, the order they are stored in every dataset.
+    channel_names = ['405nm','488nm','561nm','637nm','730nm']
+    active_channel_names = [channel_names[c] for c in range(len(channel_states)) if channel_states[c]==1]
+    manifest = new_manifest('ndtiff', params=[30.,scan_axis_step_um*1000.,pixel_size_um*1000.], \
+        channels=range(len(active_channel_names)), channel_names=active_channel_names, \
+        frame_shape=(core.get_image_height(),core.get_image_width()), \
+        dtype=np.uint16 if core.get_bytes_per_pixel()==2 else np.uint8)
+
     for y in range(tile_axis_positions):
         # calculate tile axis position
         tile_position_um = tile_axis_start_um+(tile_axis_step_um*y)
@@ -339,6 +353,12 @@ def main():
             # try to clean up acquisition so that AcqEngJ releases directory. This way we can move it to the network storage
             # in the background.
             acq = None
+
+            # add this strip to the acquisition manifest. AcqEngJ makes the dataset directory name unique with a suffix.
+            dataset_dir = sorted([f for f in save_directory.glob(save_name_z+'*') if f.is_dir()], key=lambda f: f.stat().st_mtime)[-1]
+            add_strip(manifest, dataset_dir.name, y, scan_axis_positions+10, height=z, \
+                position_um=(scan_axis_start_um,tile_position_um,height_position_um))
+            write_manifest(save_directory, manifest)
             
             # turn off lasers
             core.set_config('Coherent-State','off')
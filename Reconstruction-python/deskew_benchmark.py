@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+'''
+Accuracy vs throughput benchmark of the stage scanning OPM deskew on a synthetic bead and filament phantom.
+For every deskew quality this reports raw and output voxels per second, the peak resident memory of the
+deskew, and how far the deskewed beads are from their known positions, so kernel changes can be accepted
+or rejected on numbers instead of on real multi-hundred-GB acquisitions.
+
+Peak memory is the VmHWM of this process, reset before each quality through /proc/self/clear_refs (Linux).
+Elsewhere the lifetime peak of the process is reported instead.
+'''
+
+# imports
+import numpy as np
+import sys
+import getopt
+import gc
+import time
+from deskew_engine import stage_deskew, get_deskew_plan, QUALITY_MODES, DESKEW_BACKENDS, DEFAULT_BACKEND
+from opm_phantom import make_phantom, bead_localisation_error
+
+# resident memory field of /proc/self/status in bytes, or None where it is not available
+def _proc_status_bytes(field):
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith(field+':'):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+    return None
+
+# reset the peak resident memory of this process. Returns False if the peak cannot be reset on this system.
+def _reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+# peak resident memory of this process in bytes, since the last reset where supported
+def _peak_rss():
+    peak = _proc_status_bytes('VmHWM')
+    if peak is None:
+        try:
+            import resource
+            # ru_maxrss is in kB on Linux and in bytes on macOS
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*(1 if sys.platform == 'darwin' else 1024)
+        except ImportError:
+            peak = None
+    return peak
+
+def run_benchmark(phantom, parameters=(30,200,116), qualities=QUALITY_MODES, sigma=1.2, z_bin=1, output_dtype=np.float32,
+                  backend=DEFAULT_BACKEND, repeats=3):
+    '''deskew a phantom with every quality and measure speed, peak memory, and bead localisation error.
+    Args:
+        phantom: Phantom from opm_phantom.make_phantom
+        parameters: [theta, stage move distance, camera pixel size] in [degrees,nm,nm] used to make the phantom
+        qualities: deskew qualities to compare
+        sigma: PSF standard deviation of the phantom in camera pixels
+        z_bin: z binning factor
+        output_dtype: deskewed stack dtype
+        backend: deskew backend, 'auto' or one of DESKEW_BACKENDS
+        repeats: number of timed runs per quality. The fastest is reported.
+    Returns:
+        dict per quality with deskew time (s), raw and output voxels/s, peak RSS and peak RSS above the
+        pre-deskew baseline (bytes, None if unavailable), number of localised beads, and RMS localisation
+        error along z, y, x and in 3D (nm)
+    '''
+    raw = phantom.raw
+    pixel_size = float(parameters[2])
+
+    results = {}
+    for quality in qualities:
+        # plan, kernel compilation, and backend autotuning happen outside of the measured runs
+        plan = get_deskew_plan(parameters, raw.shape, quality=quality)
+        deskewed = stage_deskew(raw, parameters, z_bin=z_bin, output_dtype=output_dtype, plan=plan, backend=backend)
+        del deskewed
+        gc.collect()
+
+        baseline = _proc_status_bytes('VmRSS')
+        _reset_peak_rss()
+        times = []
+        for i in range(repeats):
+            start = time.perf_counter()
+            deskewed = stage_deskew(raw, parameters, z_bin=z_bin, output_dtype=output_dtype, plan=plan, backend=backend)
+            times.append(time.perf_counter() - start)
+            if i < repeats-1:
+                del deskewed
+        peak = _peak_rss()
+
+        errors = bead_localisation_error(deskewed, phantom, sigma=sigma, z_bin=z_bin)*pixel_size
+        deskew_s = min(times)
+        results[quality] = {'deskew_s': deskew_s,
+                            'raw_voxels_per_s': raw.size/deskew_s,
+                            'output_voxels_per_s': deskewed.size/deskew_s,
+                            'peak_rss': peak,
+                            'peak_rss_above_baseline': None if (peak is None or baseline is None) else max(peak-baseline, 0),
+                            'localised_beads': errors.shape[0],
+                            'rms_error_zyx_nm': np.sqrt(np.mean(errors**2, axis=0)) if errors.shape[0] else np.full(3, np.nan),
+                            'rms_error_nm': float(np.sqrt(np.mean(np.sum(errors**2, axis=1)))) if errors.shape[0] else np.nan}
+        del deskewed
+        gc.collect()
+
+    return results
+
+# make a phantom, run the benchmark, and print one line per quality
+def main(argv):
+
+    shape = [1000,256,512]
+    params = [30,200,116]
+    z_bin = 1
+    output_dtype = np.float32
+    backend = DEFAULT_BACKEND
+    repeats = 3
+    num_beads = 500
+    noise = True
+
+    try:
+        arguments, values = getopt.getopt(argv,"hn:y:x:b:k:r:d:up",["help","frames=","ny=","nx=","zbin=","backend=","repeats=","beads=","uint16","nonoise"])
+    except getopt.GetoptError:
+        print('Error. deskew_benchmark.py -n <frames> -y <camera rows> -x <camera columns> -b <z bin> -k <backend> -r <repeats> -d <beads> [-u] [-p]')
+        sys.exit(2)
+    for current_argument, current_value in arguments:
+        if current_argument in ('-h', '--help'):
+            print('Usage. deskew_benchmark.py -n <frames> -y <camera rows> -x <camera columns> -b <z bin> -k <backend> -r <repeats> -d <beads> [-u] [-p]')
+            print('       -k deskew backend: auto or one of '+', '.join(DESKEW_BACKENDS))
+            print('       -u writes uint16 instead of float32 output')
+            print('       -p renders the phantom without Poisson noise')
+            sys.exit()
+        elif current_argument in ("-n", "--frames"):
+            shape[0] = int(current_value)
+        elif current_argument in ("-y", "--ny"):
+            shape[1] = int(current_value)
+        elif current_argument in ("-x", "--nx"):
+            shape[2] = int(current_value)
+        elif current_argument in ("-b", "--zbin"):
+            z_bin = int(current_value)
+        elif current_argument in ("-k", "--backend"):
+            backend = current_value
+        elif current_argument in ("-r", "--repeats"):
+            repeats = int(current_value)
+        elif current_argument in ("-d", "--beads"):
+            num_beads = int(current_value)
+        elif current_argument in ("-u", "--uint16"):
+            output_dtype = np.uint16
+        elif current_argument in ("-p", "--nonoise"):
+            noise = False
+
+    if (backend != 'auto') and (backend not in DESKEW_BACKENDS):
+        print('Backend must be auto or one of: '+', '.join(DESKEW_BACKENDS))
+        sys.exit(2)
+
+    start = time.perf_counter()
+    phantom = make_phantom(shape=tuple(shape), parameters=params, num_beads=num_beads, noise=noise)
+    print('Phantom: '+str(tuple(shape))+' uint16, '+str(num_beads)+' beads, '+str(len(phantom.filaments))+' filaments, '+ \
+          ('Poisson noise' if noise else 'no noise')+', made in {:.1f} s'.format(time.perf_counter()-start))
+    print('Deskew: '+backend+' backend, output '+np.dtype(output_dtype).name+', z bin '+str(z_bin)+', best of '+str(repeats))
+
+    results = run_benchmark(phantom, parameters=params, z_bin=z_bin, output_dtype=output_dtype, backend=backend, repeats=repeats)
+    for quality in results:
+        result = results[quality]
+        peak = 'n/a' if result['peak_rss'] is None else '{:.0f} MB'.format(result['peak_rss']/1e6)
+        extra = 'n/a' if result['peak_rss_above_baseline'] is None else '{:.0f} MB'.format(result['peak_rss_above_baseline']/1e6)
+        print('{:>10}: {:.3f} s, {:.1f} Mvoxel/s raw, {:.1f} Mvoxel/s output, peak RSS {} (+{}), '.format(
+              quality, result['deskew_s'], result['raw_voxels_per_s']/1e6, result['output_voxels_per_s']/1e6, peak, extra) + \
+              '{} beads, RMS error {:.1f} nm (z {:.1f}, y {:.1f}, x {:.1f})'.format(
+              result['localised_beads'], result['rms_error_nm'], *result['rms_error_zyx_nm']))
+
+# run
+if __name__ == "__main__":
+    main(sys.argv[1:])
+
+
+# The MIT License
+#
+# Copyright (c) 2020 Douglas Shepherd, Arizona State University
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
@@ -0,0 +1,1584 @@
+#!/usr/bin/env python
+
+'''
+Stage scanning OPM deskew engine shared by the reconstruction scripts.
+Orthgonal interpolation method as described by Vincent Maioli (http://doi.org/10.25560/68022)
+
+The interpolation geometry (which raw planes and camera rows feed each output row, and with what weights)
+only depends on theta, stage step, camera pixel size, and the shape of the raw stack. It is computed once
+as a "deskew plan", kept in memory (least recently used plans dropped past OPM_PLAN_CACHE_GB) and in an
+on-disk cache, and reused for every tile and channel of an experiment. Deskewing a tile is then a pure gather-and-multiply-add over the plan.
+
+Three interpolation qualities share the same plan layout and kernel:
+    'nearest'    nearest raw pixel, 1 camera row per output row. Fast preview during acquisition.
+    'orthogonal' Maioli orthogonal linear interpolation, 2 raw planes x 2 camera rows. Default.
+    'cubic'      orthogonal linear between raw planes, cubic (Keys, a=-0.5) along the tilted camera axis,
+                 2 raw planes x 4 camera rows. Sharper along the light sheet for final data.
+Run "deskew_engine.py -q" for the measured speed/accuracy of each quality on this machine.
+
+All numba kernels are compiled with cache=True. The machine code for every (dtype, layout) combination used is
+written next to this module (__pycache__, or NUMBA_CACHE_DIR if set) the first time it is needed, so later recon
+runs skip JIT compilation. Run "deskew_engine.py -w" once per machine / numba version to compile the uint16 and
+float32 specialisations ahead of the first recon, and "deskew_engine.py -s" to measure cold vs warm startup.
+
+The plan can be executed by interchangeable backends (DESKEW_BACKENDS): the parallel numba kernel, a vectorised
+NumPy gather, and a scipy.ndimage affine resampler. With backend='auto' (the default of every entry point) the
+first deskew of a given geometry, camera rows, dtype, and camera correction times the exact backends at several
+thread counts on a fixed size crop of the real data and stores the winner in a per-machine JSON file next to the
+plans, so later blocks, slabs, and runs go straight to the fastest path. Set OPM_DESKEW_BACKEND to force one backend, and run "deskew_engine.py -a"
+to see the autotuner timings for a stack shape.
+'''
+
+# imports
+import numpy as np
+from pathlib import Path
+from collections import namedtuple, OrderedDict
+import os
+import sys
+import getopt
+import numba
+from numba import njit, prange
+import time
+import tifffile
+import skimage.io as io
+import subprocess
+import tempfile
+import json
+import platform
+from scipy import ndimage
+
+# bump when the layout of the plan arrays changes so stale on-disk plans are rebuilt
+PLAN_VERSION = 3
+
+# default directory for on-disk deskew plans. Override with the OPM_CACHE_DIR environment variable.
+DEFAULT_CACHE_DIR = Path(os.environ.get('OPM_CACHE_DIR', Path.home() / '.opm_cache'))
+
+# interpolation qualities understood by every deskew entry point. The index is the code passed to _build_plan.
+QUALITY_MODES = ('nearest', 'orthogonal', 'cubic')
+
+# gathered camera rows per output row for each quality
+_QUALITY_TAPS = (1, 4, 8)
+
+# precomputed interpolation geometry for one (theta, step, pixel size, num_images, ny, quality) combination
+# final_nz, final_ny: size of the deskewed output covered by the plan (final_nx is always the camera nx)
+# y_start[z]: first output y row stored for output plane z
+# row_ptr[z]:row_ptr[z+1]: rows of the plan arrays that belong to output plane z, one per output y
+# planes[i,:]: raw planes feeding plan row i (1 for nearest, 2 otherwise). planes[i,0] = -1 marks an empty output row
+# rows[i,:]: first camera row in each raw plane. Interpolation uses rows[i,j] to rows[i,j]+weights.shape[2]-1
+# weights[i,j,k]: weight of camera row rows[i,j]+k in raw plane planes[i,j]
+DeskewPlan = namedtuple('DeskewPlan', ['final_nz', 'final_ny', 'y_start', 'row_ptr', 'planes', 'rows', 'weights'])
+
+# per-core L2 cache size used to size the x tiles of the deskew kernel. Override with OPM_L2_BYTES.
+L2_CACHE_BYTES = int(os.environ.get('OPM_L2_BYTES', 1024*1024))
+
+# bytes of deskew plans kept in memory for reuse by get_deskew_plan. A plan larger than this is still kept on
+# its own until the next one is needed. Override with OPM_PLAN_CACHE_GB.
+PLAN_CACHE_BYTES = int(float(os.environ.get('OPM_PLAN_CACHE_GB', 1))*1024**3)
+
+# in-memory plan cache shared by all tiles and channels processed in this interpreter, least recently used first
+_plan_cache = OrderedDict()
+
+# deskew backend used when none is requested. 'auto' picks the fastest exact backend per stack shape on this machine.
+DEFAULT_BACKEND = os.environ.get('OPM_DESKEW_BACKEND', 'auto')
+
+# camera columns and raw frames of the trial stack timed by the autotuner. The plan does not depend on nx, and the
+# work per frame does not depend on the scan length, so a fixed size crop of the real stack ranks the backends like
+# the full stack in a fraction of the time, even for slow candidates and full-length strips.
+AUTOTUNE_COLUMNS = 256
+AUTOTUNE_FRAMES = 512
+
+# a deskew backend fills an output stack from the raw stacks and a plan, with the arguments of _apply_plan:
+#     function(data, parameters, plan, z_bin, x_tile, corrected, dark, gain, scale, clip_lo, clip_hi, rounded, output)
+# exact: implements the plan interpolation itself, so it gives the same values as the numba kernel (to float32
+#        rounding), also runs the slab and ROI sub-plans of stage_deskew_stream / stage_deskew_roi, and is a
+#        candidate for the autotuner
+# threaded: speed depends on the numba thread count, which the autotuner varies
+DeskewBackend = namedtuple('DeskewBackend', ['function', 'exact', 'threaded'])
+
+# registered backends by name. Filled below the backend functions, extended with register_backend.
+DESKEW_BACKENDS = {}
+
+# backend choices made by this process, keyed like the on-disk autotune file
+_backend_cache = {}
+
+# code of an interpolation quality name
+def _quality_code(quality):
+    if quality not in QUALITY_MODES:
+        raise ValueError('Unknown deskew quality '+repr(quality)+'. Use one of '+', '.join(QUALITY_MODES)+'.')
+    return QUALITY_MODES.index(quality)
+
+# Keys cubic convolution weights (a=-0.5) of camera rows pos-1, pos, pos+1, pos+2 for a point at pos+t
+@njit(cache=True)
+def _cubic_weights(t):
+    w0 = ((-0.5*t + 1.0)*t - 0.5)*t
+    w1 = (1.5*t - 2.5)*t*t + 1.0
+    w2 = ((-1.5*t + 2.0)*t + 0.5)*t
+    w3 = (0.5*t - 0.5)*t*t
+    return w0, w1, w2, w3
+
+# size of the deskewed output for a raw stack of shape (num_images, ny, any nx)
+@njit(cache=True)
+def _output_shape(theta, distance, pixel_size, num_images, ny):
+
+    # change step size from physical space (nm) to camera space (pixels)
+    pixel_step = distance/pixel_size    # (pixels)
+
+    # calculate the number of pixels scanned during stage scan
+    scan_end = num_images * pixel_step  # (pixels)
+
+    # calculate properties for final image
+    final_ny = np.int64(np.ceil(scan_end+ny*np.cos(theta*np.pi/180))) # (pixels)
+    final_nz = np.int64(np.ceil(ny*np.sin(theta*np.pi/180)))          # (pixels)
+
+    return final_nz, final_ny
+
+# range of raw frames [first, last] read by output rows y_begin <= y < y_end of a num_images scan
+@njit(cache=True)
+def _frame_window(theta, distance, pixel_size, num_images, ny, y_begin, y_end):
+
+    pixel_step = distance/pixel_size
+    final_nz, final_ny = _output_shape(theta, distance, pixel_size, num_images, ny)
+    tantheta = np.float32(np.tan(theta * np.pi/180))
+
+    # the top output plane reaches furthest back along the scan, the bottom plane furthest forward
+    first = np.int64(np.floor((y_begin - (final_nz-1)/tantheta)/pixel_step))
+    last = np.int64(np.floor((y_end - 1)/pixel_step)) + 1
+
+    return max(first, 0), min(last, num_images-1)
+
+# true if both raw planes around output pixel (z, y) are inside the scan. Same arithmetic as _build_plan.
+@njit(cache=True)
+def _planes_in_scan(z, y, tantheta, pixel_step, num_images):
+    virtual_plane = y - z/tantheta
+    plane_before = np.int64(np.floor(virtual_plane/pixel_step))
+    return (plane_before>=0) and (plane_before+1<num_images)
+
+# exact range [y_lo, y_hi) of output rows in plane z whose raw planes are inside the scan.
+# analytically y_lo = z/tan(theta) and y_hi = z/tan(theta) + (num_images-1)*step. The estimate is then
+# nudged with the same floor arithmetic the plan uses so the range is exact, not just approximately right.
+# A short scan ((num_images-1)*step < 1 px) can leave no integer y in the interval, which gives y_lo == y_hi.
+@njit(cache=True)
+def _plane_y_range(z, tantheta, pixel_step, num_images):
+    if num_images < 2:
+        return 0, 0
+
+    # search for the first row up to one row past the analytic end of the interval
+    y_last = np.int64(np.floor(z/tantheta + (num_images-1)*pixel_step)) + 1
+    y_lo = np.int64(np.ceil(z/tantheta))
+    while _planes_in_scan(z, y_lo-1, tantheta, pixel_step, num_images):
+        y_lo = y_lo - 1
+    while (y_lo <= y_last) and not _planes_in_scan(z, y_lo, tantheta, pixel_step, num_images):
+        y_lo = y_lo + 1
+    if y_lo > y_last:
+        return y_lo, y_lo
+
+    y_hi = np.int64(np.floor(z/tantheta + (num_images-1)*pixel_step))
+    while _planes_in_scan(z, y_hi, tantheta, pixel_step, num_images):
+        y_hi = y_hi + 1
+    while not _planes_in_scan(z, y_hi-1, tantheta, pixel_step, num_images):
+        y_hi = y_hi - 1
+
+    return y_lo, y_hi
+
+# compute the orthogonal interpolation geometry for output rows y_begin <= y < y_end of output planes
+# z_begin <= z < z_end of a raw stack of shape (num_images, ny, any nx).
+# Raw plane indices are stored relative to frame_offset and camera rows relative to row_offset.
+# quality is the index of the interpolation mode in QUALITY_MODES.
+@njit(cache=True)
+def _build_plan(theta, distance, pixel_size, num_images, ny, y_begin, y_end, frame_offset, z_begin, z_end, row_offset, quality):
+
+    # change step size from physical space (nm) to camera space (pixels)
+    pixel_step = distance/pixel_size    # (pixels)
+
+    # calculate properties for final image
+    final_nz, final_ny = _output_shape(theta, distance, pixel_size, num_images, ny)
+    plan_ny = y_end - y_begin
+    plan_nz = z_end - z_begin
+
+    # precalculate trig functions for scan angle
+    tantheta = np.float32(np.tan(theta * np.pi/180)) # (float32)
+    sintheta = np.float32(np.sin(theta * np.pi/180)) # (float32)
+    costheta = np.float32(np.cos(theta * np.pi/180)) # (float32)
+
+    # every output plane stores one plan row per output y pixel inside its exact valid y range.
+    # rows outside it (the empty wedges of the deskewed parallelogram) are never stored or visited.
+    y_start = np.zeros(plan_nz, dtype=np.int64)
+    y_stop = np.zeros(plan_nz, dtype=np.int64)
+    row_ptr = np.zeros(plan_nz+1, dtype=np.int64)
+    for zl in range(0,plan_nz):
+        y_lo, y_hi = _plane_y_range(z_begin+zl, tantheta, pixel_step, num_images)
+        y_lo = min(max(y_lo, y_begin), y_end)
+        y_hi = min(max(y_hi, y_lo), y_end)
+        y_start[zl] = y_lo - y_begin
+        y_stop[zl] = y_hi - y_begin
+        row_ptr[zl+1] = row_ptr[zl] + y_hi - y_lo
+    num_rows = row_ptr[plan_nz]
+
+    # taps per output row: raw planes x camera rows per plane
+    if quality == 0:
+        num_planes, num_taps = 1, 1
+    elif quality == 1:
+        num_planes, num_taps = 2, 2
+    else:
+        num_planes, num_taps = 2, 4
+
+    planes = np.full((num_rows, num_planes), -1, dtype=np.int32)
+    rows = np.zeros((num_rows, num_planes), dtype=np.int32)
+    weights = np.zeros((num_rows, num_planes, num_taps), dtype=np.float32)
+
+    for zl in range(0,plan_nz):
+        z = z_begin + zl
+        for y in range(y_begin+y_start[zl],y_begin+y_stop[zl]):
+            i = row_ptr[zl] + y - y_begin - y_start[zl]
+
+            # find the virtual tilted plane that intersects the interpolated plane
+            virtual_plane = y - z/tantheta
+
+            # find raw data planes that surround the virtual plane
+            plane_before = np.int64(np.floor(virtual_plane/pixel_step))
+            plane_after = np.int64(plane_before+1)
+
+            # raw data planes are within the data range by construction of the y range
+            if ((plane_before>=0) and (plane_after<num_images)):
+
+                # find distance of a point on the  interpolated plane to plane_before and plane_after
+                l_before = virtual_plane - plane_before * pixel_step
+                l_after = pixel_step - l_before
+
+                # determine location of a point along the interpolated plane
+                za = z/sintheta
+                virtual_pos_before = za + l_before*costheta
+                virtual_pos_after = za - l_after*costheta
+
+                # determine nearest data points to interpoloated point in raw data
+                pos_before = np.int64(np.floor(virtual_pos_before))
+                pos_after = np.int64(np.floor(virtual_pos_after))
+
+                # continue if within data bounds. This only rejects rows in the first and last few output
+                # planes, where the orthogonal step reaches past the edge of the camera ROI.
+                # every quality keeps this footprint so their outputs can be compared voxel by voxel.
+                if ((pos_before>=0) and (pos_after >= 0) and (pos_before<ny-1) and (pos_after<ny-1)):
+
+                    # determine points surrounding interpolated point on the virtual plane
+                    dz_before = virtual_pos_before - pos_before
+                    dz_after = virtual_pos_after - pos_after
+
+                    if quality == 0:
+                        # closest raw plane along the scan, then closest camera row in it
+                        if l_before <= l_after:
+                            planes[i,0] = plane_before - frame_offset
+                            rows[i,0] = pos_before + np.int64(dz_before >= 0.5) - row_offset
+                        else:
+                            planes[i,0] = plane_after - frame_offset
+                            rows[i,0] = pos_after + np.int64(dz_after >= 0.5) - row_offset
+                        weights[i,0,0] = 1.0
+
+                    elif quality == 1:
+                        # store orthogonal interpolation weights, normalised by the stage step
+                        planes[i,0] = plane_before - frame_offset
+                        planes[i,1] = plane_after - frame_offset
+                        rows[i,0] = pos_before - row_offset
+                        rows[i,1] = pos_after - row_offset
+                        weights[i,0,0] = l_after * (1-dz_before) / pixel_step
+                        weights[i,0,1] = l_after * dz_before / pixel_step
+                        weights[i,1,0] = l_before * (1-dz_after) / pixel_step
+                        weights[i,1,1] = l_before * dz_after / pixel_step
+
+                    else:
+                        # cubic along the camera rows of each raw plane. At the edge of the camera ROI the missing
+                        # row takes the value of the edge row, so the 4 taps are folded onto rows inside the ROI.
+                        planes[i,0] = plane_before - frame_offset
+                        planes[i,1] = plane_after - frame_offset
+                        for j in range(2):
+                            if j == 0:
+                                pos = pos_before
+                                w_cubic = _cubic_weights(dz_before)
+                                w_plane = l_after / pixel_step
+                            else:
+                                pos = pos_after
+                                w_cubic = _cubic_weights(dz_after)
+                                w_plane = l_before / pixel_step
+                            first_row = min(max(pos-1, 0), ny-4)
+                            rows[i,j] = first_row - row_offset
+                            for k in range(4):
+                                row = min(max(pos-1+k, 0), ny-1)
+                                weights[i,j,row-first_row] += w_plane * w_cubic[k]
+
+    return plan_nz, plan_ny, y_start, row_ptr, planes, rows, weights
+
+# file name of the on-disk plan for a given geometry, raw stack shape, and interpolation quality
+def _plan_file_name(parameters, num_images, ny, quality):
+    theta, distance, pixel_size = [float(p) for p in parameters[:3]]
+    return 'deskew_plan_v{}_{}_t{:.4f}_d{:.4f}_p{:.4f}_n{}_y{}.npz'.format(PLAN_VERSION, quality, theta, distance, pixel_size, num_images, ny)
+
+# bytes held by a plan
+def _plan_nbytes(plan):
+    return sum([field.nbytes for field in plan if isinstance(field, np.ndarray)])
+
+# upper bound on the bytes of the plan for a final_nz x final_ny output
+def _plan_nbytes_estimate(final_nz, final_ny, quality_code):
+    num_planes = 1 if quality_code == 0 else 2
+    return int(final_nz)*int(final_ny)*(8*num_planes + 4*_QUALITY_TAPS[quality_code])
+
+# drop least recently used plans until the cache holds at most max_bytes, always keeping keep plans
+def _evict_plans(max_bytes, keep=0):
+    total = sum([_plan_nbytes(plan) for plan in _plan_cache.values()])
+    while len(_plan_cache) > keep and total > max_bytes:
+        _, plan = _plan_cache.popitem(last=False)
+        total = total - _plan_nbytes(plan)
+
+def plan_cache_bytes():
+    '''return the bytes of deskew plans currently held in memory by get_deskew_plan.'''
+    return sum([_plan_nbytes(plan) for plan in _plan_cache.values()])
+
+def clear_plan_cache():
+    '''release all deskew plans held in memory. On-disk plans are kept.'''
+    _plan_cache.clear()
+
+def get_deskew_plan(parameters, shape, quality='orthogonal', cache_dir=DEFAULT_CACHE_DIR):
+    '''return the deskew plan for a geometry and raw stack shape, building it only once.
+    Args:
+        parameters: [theta, stage move distance, camera pixel size] in [degrees,nm,nm]
+        shape: shape of the raw stack (num_images, ny, nx). nx does not change the plan.
+        quality: interpolation quality, one of QUALITY_MODES
+        cache_dir: directory for on-disk plans. None keeps the plan in memory only.
+    Returns:
+        DeskewPlan
+    '''
+    parameters = np.asarray(parameters, dtype=np.float32)
+    quality_code = _quality_code(quality)
+    num_images, ny = int(shape[0]), int(shape[1])
+    file_name = _plan_file_name(parameters, num_images, ny, quality)
+
+    # plan already used by this process
+    if file_name in _plan_cache:
+        _plan_cache.move_to_end(file_name)
+        return _plan_cache[file_name]
+
+    # make room for the new plan before loading or building it, so the old and new plans never add up past the cap
+    final_nz, final_ny = _output_shape(parameters[0], parameters[1], parameters[2], num_images, ny)
+    _evict_plans(PLAN_CACHE_BYTES - _plan_nbytes_estimate(final_nz, final_ny, quality_code))
+
+    plan = None
+
+    # plan computed by a previous run on this machine
+    if cache_dir is not None:
+        plan_path = Path(cache_dir) / file_name
+        if plan_path.exists():
+            try:
+                with np.load(plan_path) as cached:
+                    plan = DeskewPlan(**{field: cached[field] for field in DeskewPlan._fields})
+                plan = plan._replace(final_nz=int(plan.final_nz), final_ny=int(plan.final_ny))
+            except Exception:
+                # unreadable plan (e.g. interrupted write). Rebuild it below.
+                plan = None
+
+    if plan is None:
+        plan = DeskewPlan(*_build_plan(parameters[0], parameters[1], parameters[2], num_images, ny, 0, final_ny, 0, 0, final_nz, 0, quality_code))
+
+        if cache_dir is not None:
+            # write to a temporary file first so parallel recon jobs never see a partial plan
+            Path(cache_dir).mkdir(parents=True, exist_ok=True)
+            tmp_path = plan_path.with_name(plan_path.stem + '.' + str(os.getpid()) + '.tmp.npz')
+            np.savez(tmp_path, **plan._asdict())
+            os.replace(tmp_path, plan_path)
+
+    _plan_cache[file_name] = plan
+    _evict_plans(PLAN_CACHE_BYTES, keep=1)
+    return plan
+
+# (channels, ny, nx) float32 copy of a scalar, (ny, nx) image, or (channels, ny, nx) stack of per channel images
+def _per_channel_image(image, frame_shape):
+    image = np.asarray(image, dtype=np.float32)
+    num_images = image.shape[0] if image.ndim == 3 else 1
+    return np.ascontiguousarray(np.broadcast_to(image, (num_images,)+tuple(frame_shape)), dtype=np.float32)
+
+# camera offset and gain images used by the kernel, each (1 or channels, ny, nx). Channel c uses image min(c, count-1).
+# a dummy 1x1x1 pair is returned when no correction is requested.
+def _camera_correction(frame_shape, dark_offset, flat_field):
+    if (dark_offset is None) and (flat_field is None):
+        return np.zeros((1,1,1), dtype=np.float32), np.ones((1,1,1), dtype=np.float32)
+
+    if dark_offset is None:
+        dark = np.zeros((1,)+tuple(frame_shape), dtype=np.float32)
+    else:
+        dark = _per_channel_image(dark_offset, frame_shape)
+
+    if flat_field is None:
+        gain = np.ones((1,)+tuple(frame_shape), dtype=np.float32)
+    else:
+        gain = 1.0/_per_channel_image(flat_field, frame_shape)
+
+    return dark, gain
+
+# scale, clip range, and rounding used by the kernel to write the output dtype directly.
+# integer outputs (uint16 for the BDV H5) are rounded to nearest and clipped to the dtype range, float outputs are only scaled.
+def _output_conversion(output_dtype, scale):
+    output_dtype = np.dtype(output_dtype)
+    if np.issubdtype(output_dtype, np.integer):
+        limits = np.iinfo(output_dtype)
+        return output_dtype, np.float32(scale), np.float32(limits.min), np.float32(limits.max), True
+    return output_dtype, np.float32(scale), np.float32(-np.inf), np.float32(np.inf), False
+
+# accumulate one interpolated x tile from four raw camera rows.
+# raw camera values (e.g. uint16) are converted to float32 as they are gathered.
+# kept separate from the corrected version so numba vectorises each loop on its own.
+@njit(cache=True)
+def _accumulate_row(acc, row_0, row_1, row_2, row_3, w_0, w_1, w_2, w_3):
+    for x in range(acc.shape[0]):
+        acc[x] += w_0 * np.float32(row_0[x]) + \
+                  w_1 * np.float32(row_1[x]) + \
+                  w_2 * np.float32(row_2[x]) + \
+                  w_3 * np.float32(row_3[x])
+
+# same as _accumulate_row with camera offset and flat-field correction of the four gathered camera rows.
+# dark and gain rows are (ny, nx) images that stay in cache, so this adds no pass over the stack.
+@njit(cache=True)
+def _accumulate_row_corrected(acc, row_0, row_1, row_2, row_3, w_0, w_1, w_2, w_3,
+                              dark_0, dark_1, dark_2, dark_3, gain_0, gain_1, gain_2, gain_3):
+    for x in range(acc.shape[0]):
+        acc[x] += w_0 * (np.float32(row_0[x]) - dark_0[x]) * gain_0[x] + \
+                  w_1 * (np.float32(row_1[x]) - dark_1[x]) * gain_1[x] + \
+                  w_2 * (np.float32(row_2[x]) - dark_2[x]) * gain_2[x] + \
+                  w_3 * (np.float32(row_3[x]) - dark_3[x]) * gain_3[x]
+
+# single camera row versions for plans whose taps are not a multiple of four (nearest neighbour)
+@njit(cache=True)
+def _accumulate_tap(acc, row, w):
+    for x in range(acc.shape[0]):
+        acc[x] += w * np.float32(row[x])
+
+@njit(cache=True)
+def _accumulate_tap_corrected(acc, row, w, dark, gain):
+    for x in range(acc.shape[0]):
+        acc[x] += w * (np.float32(row[x]) - dark[x]) * gain[x]
+
+# perform stage scanning reconstruction by applying a precomputed interpolation plan
+# data is (channels, frames, ny, nx) and output (channels, nz, ny, nx). All channels share the plan, so the tap
+# lookups of every output row are done once and reused for each channel.
+# output planes are binned by z_bin on the fly, matching block_reduce(block_size=(z_bin,1,1), func=np.mean)
+# if corrected, every gathered camera value is replaced by (value - dark) * gain for its camera pixel and channel
+# finished rows are multiplied by scale and, if rounded, rounded to nearest and clipped to [clip_lo, clip_hi]
+# as they are written, so uint16 output needs no float32 volume and no separate conversion pass
+#
+# the taps of a plan row (raw planes x camera rows, see DeskewPlan) are gathered four camera rows at a time,
+# so orthogonal interpolation is one fused pass over its 4 rows, cubic two, and nearest neighbour a single row.
+#
+# the work is cache blocked: each parallel task owns one binned output plane and one tile of x_tile camera
+# columns. Within a task, y is the outer loop and the z_bin deskewed planes the inner loop, so a binned output row
+# is accumulated in a small buffer and written exactly once, and consecutive y rows reuse the same raw camera rows
+# (the scan advances only 1/step raw planes per output row) while they are still in cache.
+# the GIL is released, so the read and write threads of opm_pipeline keep running during the deskew.
+# http://numba.pydata.org/numba-doc/latest/user/parallel.html#numba-parallel
+@njit(parallel=True, nogil=True, cache=True)
+def _apply_plan(data, y_start, row_ptr, planes, rows, weights, z_bin, x_tile, corrected, dark, gain,
+                scale, clip_lo, clip_hi, rounded, output):
+
+    num_channels = data.shape[0]
+    nx = data.shape[3]
+    final_nz = y_start.shape[0]
+    num_x_tiles = (nx + x_tile - 1)//x_tile
+    num_rows = weights.shape[2]
+    num_taps = planes.shape[1]*num_rows
+
+    # each deskewed plane contributes 1/z_bin of its value to the binned output plane
+    bin_scale = np.float32(1.0/z_bin)
+
+    # loop through (binned output z plane, x tile) tasks
+    # defined as parallel loop in numba, each thread owns whole tasks so no output pixel is shared
+    for task in prange(0,output.shape[1]*num_x_tiles):
+        z_out = task // num_x_tiles
+        x_begin = (task % num_x_tiles) * x_tile
+        x_end = min(x_begin + x_tile, nx)
+        z_first = z_out*z_bin
+        z_last = min(z_first+z_bin, final_nz)
+
+        # output rows touched by any of the deskewed planes in this bin
+        y_lo = output.shape[2]
+        y_hi = 0
+        for z in range(z_first,z_last):
+            if row_ptr[z+1] > row_ptr[z]:
+                y_lo = min(y_lo, y_start[z])
+                y_hi = max(y_hi, y_start[z] + row_ptr[z+1] - row_ptr[z])
+
+        num_x = x_end - x_begin
+        acc = np.zeros((num_channels, num_x), dtype=np.float32)
+
+        for y in range(y_lo,y_hi):
+            filled = False
+
+            for z in range(z_first,z_last):
+
+                # skip deskewed planes with no raw data at this output row
+                i = row_ptr[z] + y - y_start[z]
+                if (i < row_ptr[z]) or (i >= row_ptr[z+1]):
+                    continue
+                if planes[i,0] < 0:
+                    continue
+
+                # x tile of four raw camera rows at a time around the interpolated point.
+                # taking contiguous row views first lets numba vectorise the x loop.
+                tap = 0
+                while tap + 4 <= num_taps:
+                    p_0 = planes[i,tap//num_rows]
+                    r_0 = rows[i,tap//num_rows] + tap%num_rows
+                    p_1 = planes[i,(tap+1)//num_rows]
+                    r_1 = rows[i,(tap+1)//num_rows] + (tap+1)%num_rows
+                    p_2 = planes[i,(tap+2)//num_rows]
+                    r_2 = rows[i,(tap+2)//num_rows] + (tap+2)%num_rows
+                    p_3 = planes[i,(tap+3)//num_rows]
+                    r_3 = rows[i,(tap+3)//num_rows] + (tap+3)%num_rows
+                    w_0 = weights[i,tap//num_rows,tap%num_rows] * bin_scale
+                    w_1 = weights[i,(tap+1)//num_rows,(tap+1)%num_rows] * bin_scale
+                    w_2 = weights[i,(tap+2)//num_rows,(tap+2)%num_rows] * bin_scale
+                    w_3 = weights[i,(tap+3)//num_rows,(tap+3)%num_rows] * bin_scale
+
+                    # accumulate final image row of every channel from the same sample positions
+                    for c in range(num_channels):
+                        if corrected:
+                            c_dark = min(c, dark.shape[0]-1)
+                            c_gain = min(c, gain.shape[0]-1)
+                            _accumulate_row_corrected(acc[c], data[c,p_0,r_0,x_begin:x_end], data[c,p_1,r_1,x_begin:x_end],
+                                                      data[c,p_2,r_2,x_begin:x_end], data[c,p_3,r_3,x_begin:x_end],
+                                                      w_0, w_1, w_2, w_3,
+                                                      dark[c_dark,r_0,x_begin:x_end], dark[c_dark,r_1,x_begin:x_end],
+                                                      dark[c_dark,r_2,x_begin:x_end], dark[c_dark,r_3,x_begin:x_end],
+                                                      gain[c_gain,r_0,x_begin:x_end], gain[c_gain,r_1,x_begin:x_end],
+                                                      gain[c_gain,r_2,x_begin:x_end], gain[c_gain,r_3,x_begin:x_end])
+                        else:
+                            _accumulate_row(acc[c], data[c,p_0,r_0,x_begin:x_end], data[c,p_1,r_1,x_begin:x_end],
+                                            data[c,p_2,r_2,x_begin:x_end], data[c,p_3,r_3,x_begin:x_end],
+                                            w_0, w_1, w_2, w_3)
+                    tap = tap + 4
+
+                # remaining taps one camera row at a time
+                while tap < num_taps:
+                    p_0 = planes[i,tap//num_rows]
+                    r_0 = rows[i,tap//num_rows] + tap%num_rows
+                    w_0 = weights[i,tap//num_rows,tap%num_rows] * bin_scale
+                    for c in range(num_channels):
+                        if corrected:
+                            c_dark = min(c, dark.shape[0]-1)
+                            c_gain = min(c, gain.shape[0]-1)
+                            _accumulate_tap_corrected(acc[c], data[c,p_0,r_0,x_begin:x_end], w_0,
+                                                      dark[c_dark,r_0,x_begin:x_end], gain[c_gain,r_0,x_begin:x_end])
+                        else:
+                            _accumulate_tap(acc[c], data[c,p_0,r_0,x_begin:x_end], w_0)
+                    tap = tap + 1
+
+                filled = True
+
+            # write the finished binned row of every channel once in the output dtype and reset the accumulator
+            if filled:
+                for c in range(num_channels):
+                    output_row = output[c,z_out,y,x_begin:x_end]
+                    acc_row = acc[c]
+                    if rounded:
+                        for x in range(num_x):
+                            output_row[x] = min(max(np.floor(acc_row[x]*scale + np.float32(0.5)), clip_lo), clip_hi)
+                            acc_row[x] = 0
+                    else:
+                        for x in range(num_x):
+                            output_row[x] = acc_row[x]*scale
+                            acc_row[x] = 0
+
+    return output
+
+# scatter one deskewed x tile back onto four raw camera rows, reading the deskewed row once
+@njit(cache=True)
+def _scatter_row(raw_0, raw_1, raw_2, raw_3, deskewed_row, w_0, w_1, w_2, w_3):
+    for x in range(deskewed_row.shape[0]):
+        value = np.float32(deskewed_row[x])
+        raw_0[x] += w_0 * value
+        raw_1[x] += w_1 * value
+        raw_2[x] += w_2 * value
+        raw_3[x] += w_3 * value
+
+# scatter one deskewed x tile back onto a single raw camera row
+@njit(cache=True)
+def _scatter_tap(raw_row, deskewed_row, w):
+    for x in range(deskewed_row.shape[0]):
+        raw_row[x] += w * np.float32(deskewed_row[x])
+
+# exact adjoint (transpose) of _apply_plan for the same plan, z_bin, and gain.
+# every plan tap that gathered w * raw[plane,row,x] into deskewed[z_out,y,x] here scatters w * deskewed[z_out,y,x]
+# back into raw[plane,row,x]. The camera offset is an affine shift and has no adjoint, so only the gain is applied.
+#
+# raw pixels receive contributions from many output rows, so parallel tasks own whole x tiles of the raw stack
+# (interpolation never mixes camera columns) and no raw pixel is ever written by two threads.
+@njit(parallel=True, cache=True)
+def _apply_plan_adjoint(deskewed, y_start, row_ptr, planes, rows, weights, z_bin, x_tile, corrected, gain, raw):
+
+    nx = raw.shape[2]
+    final_nz = y_start.shape[0]
+    num_x_tiles = (nx + x_tile - 1)//x_tile
+    num_rows = weights.shape[2]
+    num_taps = planes.shape[1]*num_rows
+
+    # each deskewed plane received 1/z_bin of its value in the binned output plane
+    bin_scale = np.float32(1.0/z_bin)
+
+    for tile in prange(0,num_x_tiles):
+        x_begin = tile * x_tile
+        x_end = min(x_begin + x_tile, nx)
+
+        # walk the plan in storage order. Deskewed rows are read and raw planes written as sequential streams.
+        for z in range(0,final_nz):
+            z_out = z // z_bin
+            for i in range(row_ptr[z],row_ptr[z+1]):
+                if planes[i,0] < 0:
+                    continue
+                y = y_start[z] + i - row_ptr[z]
+                deskewed_row = deskewed[z_out,y,x_begin:x_end]
+
+                # same tap order as _apply_plan, four raw camera rows at a time
+                tap = 0
+                while tap + 4 <= num_taps:
+                    j_0, k_0 = tap//num_rows, tap%num_rows
+                    j_1, k_1 = (tap+1)//num_rows, (tap+1)%num_rows
+                    j_2, k_2 = (tap+2)//num_rows, (tap+2)%num_rows
+                    j_3, k_3 = (tap+3)//num_rows, (tap+3)%num_rows
+                    _scatter_row(raw[planes[i,j_0],rows[i,j_0]+k_0,x_begin:x_end], raw[planes[i,j_1],rows[i,j_1]+k_1,x_begin:x_end],
+                                 raw[planes[i,j_2],rows[i,j_2]+k_2,x_begin:x_end], raw[planes[i,j_3],rows[i,j_3]+k_3,x_begin:x_end],
+                                 deskewed_row, weights[i,j_0,k_0]*bin_scale, weights[i,j_1,k_1]*bin_scale,
+                                 weights[i,j_2,k_2]*bin_scale, weights[i,j_3,k_3]*bin_scale)
+                    tap = tap + 4
+                while tap < num_taps:
+                    j_0, k_0 = tap//num_rows, tap%num_rows
+                    _scatter_tap(raw[planes[i,j_0],rows[i,j_0]+k_0,x_begin:x_end], deskewed_row, weights[i,j_0,k_0]*bin_scale)
+                    tap = tap + 1
+
+        # transpose of the per camera pixel gain
+        if corrected:
+            for plane in range(raw.shape[0]):
+                for row in range(raw.shape[1]):
+                    raw_row = raw[plane,row,x_begin:x_end]
+                    gain_row = gain[row,x_begin:x_end]
+                    for x in range(x_end-x_begin):
+                        raw_row[x] *= gain_row[x]
+
+    return raw
+
+# camera columns per kernel task. Sized so the raw row segments reused between neighbouring output rows, the
+# accumulator, and the output row fit in l2_bytes, then shrunk until there are enough tasks for every thread.
+def _auto_x_tile(nx, itemsize, z_bin, binned_nz, num_taps=4, num_channels=1, l2_bytes=L2_CACHE_BYTES):
+
+    # num_taps raw rows per deskewed plane for this and the next output row, plus float32 accumulator and output,
+    # for every channel processed together
+    bytes_per_column = (2*num_taps*z_bin*itemsize + 4 + 4)*num_channels
+    x_tile = max(64, (l2_bytes//bytes_per_column)//64*64)
+
+    min_tasks = 4*numba.get_num_threads()
+    while (x_tile > 64) and (binned_nz*(-(-nx//x_tile)) < min_tasks):
+        x_tile = max(64, (x_tile//2)//64*64)
+
+    return int(min(x_tile, nx))
+
+# interpolation quality a plan was built with, from its taps per output row
+def _plan_quality(plan):
+    return QUALITY_MODES[_QUALITY_TAPS.index(plan.weights.shape[1]*plan.weights.shape[2])]
+
+def register_backend(name, function, exact=True, threaded=False):
+    '''make a deskew backend available to every entry point by name.
+    Args:
+        name: backend name passed as backend= to stage_deskew and friends
+        function: function(data, parameters, plan, z_bin, x_tile, corrected, dark, gain, scale, clip_lo, clip_hi, rounded, output)
+                  filling and returning output (num_channels, binned_nz, ny, nx) like _apply_plan
+        exact: True if function implements the plan interpolation. Only exact backends are autotuned.
+        threaded: True if its speed depends on the numba thread count
+    '''
+    DESKEW_BACKENDS[name] = DeskewBackend(function, exact, threaded)
+
+# registered backend of a name
+def _backend_spec(backend):
+    if backend not in DESKEW_BACKENDS:
+        raise ValueError('Unknown deskew backend '+repr(backend)+'. Use auto or one of '+', '.join(DESKEW_BACKENDS)+'.')
+    return DESKEW_BACKENDS[backend]
+
+# run one backend with a given numba thread count (None keeps the current one). x_tile is sized after the thread
+# count is set, so it matches the number of tasks the kernel will see.
+def _run_backend(backend, threads, data, parameters, plan, z_bin, x_tile, corrected, dark, gain, scale, clip_lo, clip_hi, rounded, output):
+    previous_threads = numba.get_num_threads()
+    if threads is not None:
+        numba.set_num_threads(min(int(threads), numba.config.NUMBA_NUM_THREADS))
+    try:
+        if x_tile is None:
+            x_tile = _auto_x_tile(data.shape[3], data.dtype.itemsize, z_bin, output.shape[1],
+                                  plan.weights.shape[1]*plan.weights.shape[2], data.shape[0])
+        return DESKEW_BACKENDS[backend].function(data, parameters, plan, z_bin, x_tile, corrected, dark, gain,
+                                                 scale, clip_lo, clip_hi, rounded, output)
+    finally:
+        numba.set_num_threads(previous_threads)
+
+# numba thread counts tried by the autotuner: all threads, half, and a quarter
+def _autotune_threads():
+    max_threads = numba.config.NUMBA_NUM_THREADS
+    return sorted(set([max(max_threads//divisor, 1) for divisor in (1, 2, 4)]), reverse=True)
+
+# key of one autotuned configuration in the per-machine autotune file. Only the channel count and camera rows of the
+# stack shape are part of it, so blocks, slabs, and strips of any length and width share one choice.
+def _autotune_key(num_channels, ny, dtype, parameters, quality, z_bin, output_dtype, corrected):
+    theta, distance, pixel_size = [float(p) for p in parameters[:3]]
+    return 'c{}_y{}_{}_t{:.4f}_d{:.4f}_p{:.4f}_{}_b{}_{}{}'.format(int(num_channels), int(ny), np.dtype(dtype).name,
+                                                                theta, distance, pixel_size, quality, z_bin,
+                                                                np.dtype(output_dtype).name, '_corrected' if corrected else '')
+
+# per-machine autotune file. The host name keeps machines sharing a home directory from overwriting each other.
+def _autotune_path(cache_dir):
+    return Path(cache_dir) / ('deskew_autotune_' + platform.node() + '.json')
+
+def select_deskew_backend(data, parameters, z_bin=1, quality='orthogonal', output_dtype=np.float32, plan=None, repeats=1,
+                          cache_dir=DEFAULT_CACHE_DIR, retune=False, corrected=False):
+    '''fastest exact deskew backend and numba thread count for a raw stack on this machine.
+    The first call for a channel count, camera rows, dtype, geometry, quality, z_bin, output dtype, and camera
+    correction times every exact backend (threaded ones at several thread counts) on the first AUTOTUNE_FRAMES frames
+    and AUTOTUNE_COLUMNS camera columns of data. The winner is remembered in memory and in a JSON file in cache_dir,
+    so later calls and later runs only look it up, whatever the length and width of their stacks.
+    Args:
+        data: raw stack (num_images, ny, nx) or stacks (num_channels, num_images, ny, nx)
+        parameters: [theta, stage move distance, camera pixel size] in [degrees,nm,nm]
+        z_bin: z binning factor
+        quality: interpolation quality, one of QUALITY_MODES
+        output_dtype: dtype of the deskewed stack
+        plan: DeskewPlan the caller deskews data with. Only its quality is used, overriding quality.
+        repeats: number of timed runs per candidate after one untimed warm-up run. The fastest is used.
+        cache_dir: directory of the autotune file. None keeps the choice in memory only.
+        retune: time the candidates again even if a choice is cached
+        corrected: True if the caller applies dark offset / flat-field correction, which is then timed too
+    Returns:
+        dict with the chosen 'backend', its numba 'threads' (None for unthreaded backends), and the
+        'timings' (s) of every candidate, keyed 'backend' or 'backend/threads'
+    '''
+    if data.ndim == 3:
+        data = data[np.newaxis]
+    parameters = np.asarray(parameters, dtype=np.float32)
+    if plan is not None:
+        quality = _plan_quality(plan)
+    key = _autotune_key(data.shape[0], data.shape[2], data.dtype, parameters, quality, z_bin, output_dtype, corrected)
+
+    # choice already made by this process or by a previous run on this machine
+    if not retune:
+        if key in _backend_cache:
+            return _backend_cache[key]
+        if cache_dir is not None and _autotune_path(cache_dir).exists():
+            try:
+                with open(_autotune_path(cache_dir)) as cached:
+                    choice = json.load(cached).get(key)
+            except Exception:
+                # unreadable file (e.g. interrupted write). Tune again below.
+                choice = None
+            if (choice is not None) and (choice['backend'] in DESKEW_BACKENDS):
+                _backend_cache[key] = choice
+                return choice
+
+    # time every candidate on a fixed size, contiguous crop of the real stack, with a plan of its own that is not
+    # kept in the plan cache
+    trial = np.ascontiguousarray(data[:, :AUTOTUNE_FRAMES, :, :AUTOTUNE_COLUMNS])
+    final_nz, final_ny = _output_shape(parameters[0], parameters[1], parameters[2], trial.shape[1], trial.shape[2])
+    plan = DeskewPlan(*_build_plan(parameters[0], parameters[1], parameters[2], trial.shape[1], trial.shape[2], 0, final_ny, 0, 0,
+                                   final_nz, 0, _quality_code(quality)))
+    binned_nz = -(-plan.final_nz // z_bin)
+    output_dtype, scale, clip_lo, clip_hi, rounded = _output_conversion(output_dtype, 1.0)
+    if corrected:
+        dark, gain = _camera_correction(trial.shape[2:], np.zeros(trial.shape[2:]), np.ones(trial.shape[2:]))
+    else:
+        dark, gain = _camera_correction(trial.shape[2:], None, None)
+
+    timings = {}
+    candidates = []
+    for backend in DESKEW_BACKENDS:
+        spec = DESKEW_BACKENDS[backend]
+        if not spec.exact:
+            continue
+        for threads in (_autotune_threads() if spec.threaded else [None]):
+            times = []
+            for i in range(repeats+1):
+                output = np.zeros((trial.shape[0], binned_nz, plan.final_ny, trial.shape[3]), dtype=output_dtype)
+                start = time.perf_counter()
+                _run_backend(backend, threads, trial, parameters, plan, z_bin, None, corrected, dark, gain,
+                             scale, clip_lo, clip_hi, rounded, output)
+                times.append(time.perf_counter() - start)
+            label = backend if threads is None else backend+'/'+str(threads)
+            timings[label] = min(times[1:])
+            candidates.append((timings[label], backend, threads))
+
+    _, backend, threads = min(candidates, key=lambda candidate: candidate[0])
+    choice = {'backend': backend, 'threads': threads, 'timings': timings}
+    _backend_cache[key] = choice
+
+    if cache_dir is not None:
+        # merge into the file written by other runs, then replace it in one step like the plans
+        autotune_path = _autotune_path(cache_dir)
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        choices = {}
+        if autotune_path.exists():
+            try:
+                with open(autotune_path) as cached:
+                    choices = json.load(cached)
+            except Exception:
+                choices = {}
+        choices[key] = choice
+        tmp_path = autotune_path.with_name(autotune_path.stem + '.' + str(os.getpid()) + '.tmp.json')
+        with open(tmp_path, 'w') as tmp_file:
+            json.dump(choices, tmp_file, indent=1)
+        os.replace(tmp_path, autotune_path)
+
+    return choice
+
+# backend and numba thread count for a backend argument. 'auto' asks the autotuner.
+# sub-plans (stream slabs, ROIs) only run on exact backends.
+def _resolve_backend(backend, data, parameters, plan, z_bin, output_dtype, quality='orthogonal', cache_dir=DEFAULT_CACHE_DIR, exact_only=False,
+                     corrected=False):
+    if backend == 'auto':
+        choice = select_deskew_backend(data, parameters, z_bin=z_bin, quality=quality, output_dtype=output_dtype, plan=plan, cache_dir=cache_dir,
+                                       corrected=corrected)
+        return choice['backend'], choice['threads']
+    if exact_only and not _backend_spec(backend).exact:
+        raise ValueError('Deskew backend '+repr(backend)+' only deskews whole stacks. Use one of '+
+                         ', '.join([name for name in DESKEW_BACKENDS if DESKEW_BACKENDS[name].exact])+'.')
+    _backend_spec(backend)
+    return backend, None
+
+# 'numba' backend: the parallel, cache blocked plan kernel
+def _deskew_numba(data, parameters, plan, z_bin, x_tile, corrected, dark, gain, scale, clip_lo, clip_hi, rounded, output):
+    return _apply_plan(data, plan.y_start, plan.row_ptr, plan.planes, plan.rows, plan.weights, z_bin, x_tile, corrected, dark, gain,
+                       scale, clip_lo, clip_hi, rounded, output)
+
+# 'numpy' backend: the plan applied with vectorised NumPy. Every tap of every output row of a deskewed plane is
+# gathered as whole camera rows with one fancy-index read per tap and channel. Single threaded and never compiled,
+# so it is the fallback where numba threading is slow or unavailable.
+def _deskew_numpy(data, parameters, plan, z_bin, x_tile, corrected, dark, gain, scale, clip_lo, clip_hi, rounded, output):
+    num_channels = data.shape[0]
+    num_rows = plan.weights.shape[2]
+    num_taps = plan.planes.shape[1]*num_rows
+    bin_scale = np.float32(1.0/z_bin)
+
+    acc = np.zeros((num_channels,)+output.shape[2:], dtype=np.float32)
+    filled = np.zeros(output.shape[2], dtype=bool)
+    for z_out in range(output.shape[1]):
+        acc[:] = 0
+        filled[:] = False
+
+        for z in range(z_out*z_bin, min(z_out*z_bin+z_bin, plan.final_nz)):
+            # plan rows of this deskewed plane with raw data, and their output y rows
+            i = np.arange(plan.row_ptr[z], plan.row_ptr[z+1])
+            i = i[plan.planes[i,0] >= 0]
+            if i.size == 0:
+                continue
+            y = plan.y_start[z] + i - plan.row_ptr[z]
+
+            for tap in range(num_taps):
+                p = plan.planes[i,tap//num_rows]
+                r = plan.rows[i,tap//num_rows] + tap%num_rows
+                w = (plan.weights[i,tap//num_rows,tap%num_rows]*bin_scale)[:,np.newaxis]
+                for c in range(num_channels):
+                    if corrected:
+                        c_dark = min(c, dark.shape[0]-1)
+                        c_gain = min(c, gain.shape[0]-1)
+                        acc[c,y] += w*((data[c,p,r].astype(np.float32) - dark[c_dark,r])*gain[c_gain,r])
+                    else:
+                        acc[c,y] += w*data[c,p,r]
+            filled[y] = True
+
+        # same conversion as the kernel: scale, then round to nearest and clip for integer outputs
+        values = acc[:,filled]*scale
+        if rounded:
+            values = np.clip(np.floor(values + np.float32(0.5)), clip_lo, clip_hi)
+        output[:,z_out,filled] = values
+
+    return output
+
+# 'scipy' backend: scipy.ndimage.affine_transform of every channel from the deskewed grid back to
+# (frame, camera row, column), spline order 0 / 1 / 3 for nearest / orthogonal / cubic, on the same voxel footprint
+# as the plan. This is trilinear / tricubic resampling of the raw grid, not the orthogonal interpolation scheme,
+# so it is not exact: an independent reference, never picked by the autotuner. Needs a float32 copy of each channel.
+def _deskew_scipy(data, parameters, plan, z_bin, x_tile, corrected, dark, gain, scale, clip_lo, clip_hi, rounded, output):
+    theta, distance, pixel_size = float(parameters[0]), float(parameters[1]), float(parameters[2])
+    num_channels, num_images, ny, nx = data.shape
+    if (plan.final_nz, plan.final_ny) != tuple(_output_shape(theta, distance, pixel_size, num_images, ny)):
+        raise ValueError('The scipy deskew backend only deskews whole stacks.')
+
+    # deskewed (z, y, x) -> raw (frame, row, column). A raw pixel at frame p and row r sits at
+    # y = p*step + r*cos(theta), z = r*sin(theta), as in deskew_affine.
+    pixel_step = distance/pixel_size
+    tantheta = np.tan(theta*np.pi/180)
+    sintheta = np.sin(theta*np.pi/180)
+    matrix = np.array(((-1.0/(tantheta*pixel_step), 1.0/pixel_step, 0.0),
+                       (1.0/sintheta,               0.0,            0.0),
+                       (0.0,                        0.0,            1.0)))
+    order = {'nearest': 0, 'orthogonal': 1, 'cubic': 3}[_plan_quality(plan)]
+
+    # output voxels the plan fills. Everything else stays zero like in the kernel.
+    plan_z = np.repeat(np.arange(plan.final_nz), np.diff(plan.row_ptr))
+    plan_y = plan.y_start[plan_z] + np.arange(plan_z.shape[0]) - plan.row_ptr[plan_z]
+    valid = plan.planes[:,0] >= 0
+    footprint = np.zeros((plan.final_nz, plan.final_ny), dtype=np.float32)
+    footprint[plan_z[valid], plan_y[valid]] = 1.0
+
+    binned_nz = output.shape[1]
+    for c in range(num_channels):
+        raw = data[c].astype(np.float32)
+        if corrected:
+            raw = (raw - dark[min(c, dark.shape[0]-1)])*gain[min(c, gain.shape[0]-1)]
+        deskewed = ndimage.affine_transform(raw, matrix, output_shape=(plan.final_nz, plan.final_ny, nx), order=order, cval=0.0)
+        deskewed *= footprint[:,:,np.newaxis]
+
+        # sum z bins (the last one may be partial) and divide by z_bin like the kernel
+        binned = np.zeros((binned_nz*z_bin, plan.final_ny, nx), dtype=np.float32)
+        binned[:plan.final_nz] = deskewed
+        values = binned.reshape(binned_nz, z_bin, plan.final_ny, nx).sum(axis=1)*np.float32(scale/z_bin)
+        if rounded:
+            values = np.clip(np.floor(values + np.float32(0.5)), clip_lo, clip_hi)
+        output[c] = values
+
+    return output
+
+register_backend('numba', _deskew_numba, exact=True, threaded=True)
+register_backend('numpy', _deskew_numpy, exact=True, threaded=False)
+register_backend('scipy', _deskew_scipy, exact=False, threaded=False)
+
+def stage_deskew(data, parameters, z_bin=1, dark_offset=None, flat_field=None, quality='orthogonal', output_dtype=np.float32, scale=1.0,
+                 x_tile=None, plan=None, cache_dir=DEFAULT_CACHE_DIR, backend=DEFAULT_BACKEND):
+    '''deskew a stage scan stack using orthogonal interpolation.
+    Args:
+        data: raw stack (num_images, ny, nx). Camera dtype (uint16) is used directly, no float copy needed.
+        parameters: [theta, stage move distance, camera pixel size] in [degrees,nm,nm]
+        z_bin: number of deskewed z planes averaged into each output plane. Replaces
+               block_reduce(deskewed, block_size=(z_bin,1,1), func=np.mean) without the full size intermediate.
+        dark_offset: optional camera offset image (ny, nx) subtracted from every raw frame
+        flat_field: optional flat-field image (ny, nx). Offset corrected raw frames are divided by it.
+        quality: 'nearest' (fast preview), 'orthogonal' (default), or 'cubic' along the tilted axis
+        output_dtype: dtype of the deskewed stack. Integer types (np.uint16 for BDV H5) are rounded and clipped in the kernel.
+        scale: factor applied to every deskewed value before conversion, e.g. to fit flat-field corrected data in uint16
+        x_tile: camera columns per kernel task. Sized from the L2 cache if not provided.
+        plan: precomputed DeskewPlan. Looked up from the plan cache if not provided. Overrides quality.
+        cache_dir: directory for on-disk plans and the autotune file. None keeps both in memory only.
+        backend: 'auto' (fastest on this machine) or one of DESKEW_BACKENDS
+    Returns:
+        deskewed stack (ceil(final_nz/z_bin), final_ny, nx) in output_dtype
+    '''
+    return stage_deskew_channels(data[np.newaxis], parameters, z_bin=z_bin, dark_offset=dark_offset, flat_field=flat_field,
+                                 quality=quality, output_dtype=output_dtype, scale=scale, x_tile=x_tile, plan=plan, cache_dir=cache_dir,
+                                 backend=backend)[0]
+
+def stage_deskew_channels(data, parameters, z_bin=1, dark_offset=None, flat_field=None, quality='orthogonal', output_dtype=np.float32, scale=1.0,
+                          x_tile=None, plan=None, cache_dir=DEFAULT_CACHE_DIR, backend=DEFAULT_BACKEND):
+    '''deskew every channel of one tile in a single pass over the interpolation geometry.
+    Each sample position and weight is looked up once and applied to all channels, instead of once per channel.
+    Args:
+        data: raw stacks (num_channels, num_images, ny, nx) acquired with the same scan
+        parameters: [theta, stage move distance, camera pixel size] in [degrees,nm,nm]
+        z_bin: number of deskewed z planes averaged into each output plane
+        dark_offset: optional camera offset image (ny, nx), or one per channel (num_channels, ny, nx)
+        flat_field: optional flat-field image (ny, nx), or one per channel (num_channels, ny, nx)
+        quality: interpolation quality, one of QUALITY_MODES
+        output_dtype: dtype of the deskewed stacks. Integer types are rounded and clipped in the kernel.
+        scale: factor applied to every deskewed value before conversion
+        x_tile: camera columns per kernel task. Sized from the L2 cache if not provided.
+        plan: precomputed DeskewPlan. Looked up from the plan cache if not provided. Overrides quality.
+        cache_dir: directory for on-disk plans and the autotune file. None keeps both in memory only.
+        backend: 'auto' (fastest on this machine) or one of DESKEW_BACKENDS
+    Returns:
+        deskewed stacks (num_channels, ceil(final_nz/z_bin), final_ny, nx) in output_dtype
+    '''
+    num_channels = data.shape[0]
+    parameters = np.asarray(parameters, dtype=np.float32)
+    if plan is None:
+        plan = get_deskew_plan(parameters, data.shape[1:], quality=quality, cache_dir=cache_dir)
+
+    # per camera pixel correction, applied inside the kernel as (raw - dark) * gain
+    corrected = (dark_offset is not None) or (flat_field is not None)
+    dark, gain = _camera_correction(data.shape[2:], dark_offset, flat_field)
+    backend, threads = _resolve_backend(backend, data, parameters, plan, z_bin, output_dtype, cache_dir=cache_dir, corrected=corrected)
+
+    # create final image
+    binned_nz = -(-plan.final_nz // z_bin)
+    output_dtype, scale, clip_lo, clip_hi, rounded = _output_conversion(output_dtype, scale)
+    output = np.zeros((num_channels, binned_nz, plan.final_ny, data.shape[3]), dtype=output_dtype)
+
+    return _run_backend(backend, threads, data, parameters, plan, z_bin, x_tile, corrected, dark, gain,
+                        scale, clip_lo, clip_hi, rounded, output)
+
+def deskew_output_shape(parameters, shape, z_bin=1):
+    '''shape of the stage_deskew output for a raw stack.
+    Args:
+        parameters: [theta, stage move distance, camera pixel size] in [degrees,nm,nm]
+        shape: shape of the raw stack (num_images, ny, nx)
+        z_bin: z binning factor passed to stage_deskew
+    Returns:
+        (nz, ny, nx) of the deskewed output
+    '''
+    parameters = np.asarray(parameters, dtype=np.float32)
+    final_nz, final_ny = _output_shape(parameters[0], parameters[1], parameters[2], int(shape[0]), int(shape[1]))
+    return (-(-int(final_nz) // z_bin), int(final_ny), int(shape[2]))
+
+def deskew_affine(parameters, translation_xyz=(0.0, 0.0, 0.0)):
+    '''affine transformation that places a raw strip in the deskewed coordinate system without resampling it.
+    Maps a raw voxel (x = camera column, y = camera row, z = frame) to the (x, y = scan, z = height) position,
+    in camera pixels, of the same point in the stage_deskew output. Use it as the BDV view registration
+    (npy2bdv append_view m_affine) of raw uint16 strips so resampling only happens once, at fusion time.
+    Args:
+        parameters: [theta, stage move distance, camera pixel size] in [degrees,nm,nm]
+        translation_xyz: offset of the strip in deskewed camera pixels, e.g. the stage position of the tile
+    Returns:
+        (3,4) affine matrix in the npy2bdv m_affine layout
+    '''
+    parameters = np.asarray(parameters, dtype=np.float32)
+    theta, distance, pixel_size = float(parameters[0]), float(parameters[1]), float(parameters[2])
+
+    # a raw pixel at frame p and camera row r sits at y = p*step + r*cos(theta), z = r*sin(theta)
+    pixel_step = distance/pixel_size
+    costheta = np.cos(theta*np.pi/180)
+    sintheta = np.sin(theta*np.pi/180)
+
+    return np.array(((1.0, 0.0,      0.0,        translation_xyz[0]),
+                     (0.0, costheta, pixel_step, translation_xyz[1]),
+                     (0.0, sintheta, 0.0,        translation_xyz[2])))
+
+def stage_deskew_stream(frames, num_images, parameters, slab_ny=4096, z_bin=1, dark_offset=None, flat_field=None, quality='orthogonal',
+                        output_dtype=np.float32, scale=1.0, backend=DEFAULT_BACKEND):
+    '''deskew a stage scan of any length with bounded memory.
+    Frames are held in a window covering one output slab plus the halo the shear needs
+    (about ny*cos(theta)/step frames). Output slabs are seamless: concatenated along y they equal stage_deskew
+    of the whole scan, and no frame is deskewed twice.
+    Args:
+        frames: iterable of raw frames (ny, nx) in acquisition order, e.g. a generator reading TIFF files.
+                Frames of shape (num_channels, ny, nx) deskew all channels together, as in stage_deskew_channels.
+        num_images: total number of frames in the scan
+        parameters: [theta, stage move distance, camera pixel size] in [degrees,nm,nm]
+        slab_ny: number of deskewed y rows per output slab
+        z_bin: number of deskewed z planes averaged into each output plane
+        dark_offset: optional camera offset image (ny, nx), or one per channel
+        flat_field: optional flat-field image (ny, nx), or one per channel
+        quality: interpolation quality, one of QUALITY_MODES
+        output_dtype: dtype of the deskewed slabs. Integer types are rounded and clipped in the kernel.
+        scale: factor applied to every deskewed value before conversion
+        backend: 'auto' (fastest on this machine, tuned on the first slab window) or one of the exact DESKEW_BACKENDS
+    Yields:
+        (y_offset, slab): first output y row of the slab and the deskewed slab (nz, <=slab_ny, nx) in output_dtype,
+                          or (num_channels, nz, <=slab_ny, nx) for multi-channel frames
+    '''
+    parameters = np.asarray(parameters, dtype=np.float32)
+    theta, distance, pixel_size = parameters[0], parameters[1], parameters[2]
+    quality_code = _quality_code(quality)
+    output_dtype, scale, clip_lo, clip_hi, rounded = _output_conversion(output_dtype, scale)
+
+    frames = iter(frames)
+    first_frame = np.asarray(next(frames))
+    multichannel = first_frame.ndim == 3
+    if not multichannel:
+        first_frame = first_frame[np.newaxis]
+    num_channels, ny, nx = first_frame.shape
+    final_nz, final_ny = _output_shape(theta, distance, pixel_size, num_images, ny)
+    binned_nz = -(-final_nz // z_bin)
+
+    # raw frame window [first, last] for every output slab
+    slab_starts = list(range(0, final_ny, slab_ny))
+    windows = [_frame_window(theta, distance, pixel_size, num_images, ny, y_begin, min(y_begin+slab_ny, final_ny)) for y_begin in slab_starts]
+
+    # one (channels, frames, ny, nx) buffer sized for the largest window is reused for the whole scan
+    buffer = np.empty((num_channels, max([last-first+1 for first, last in windows]), ny, nx), dtype=first_frame.dtype)
+    buffer_first = 0     # scan index of buffer[0]
+    buffer_count = 0     # number of valid frames in buffer
+    next_frame = 0       # scan index of the next frame to pull from the iterator
+
+    corrected = (dark_offset is not None) or (flat_field is not None)
+    dark, gain = _camera_correction((ny, nx), dark_offset, flat_field)
+    threads = None
+
+    for y_begin, (first, last) in zip(slab_starts, windows):
+        y_end = min(y_begin+slab_ny, final_ny)
+
+        # drop frames no longer needed and move the retained halo to the front of the buffer
+        drop = min(max(first - buffer_first, 0), buffer_count)
+        if drop > 0:
+            buffer[:,:buffer_count-drop] = buffer[:,drop:buffer_count]
+            buffer_count = buffer_count - drop
+            buffer_first = buffer_first + drop
+
+        # pull new frames until the window is complete
+        while next_frame <= last:
+            if next_frame == 0:
+                frame = first_frame
+            else:
+                frame = next(frames)
+            if next_frame >= first:
+                if buffer_count == 0:
+                    buffer_first = next_frame
+                buffer[:,buffer_count] = frame
+                buffer_count = buffer_count + 1
+            next_frame = next_frame + 1
+
+        # geometry for this slab, with raw plane indices relative to the buffer
+        plan = DeskewPlan(*_build_plan(theta, distance, pixel_size, num_images, ny, y_begin, y_end, buffer_first, 0, final_nz, 0, quality_code))
+
+        # backend chosen once, from the first full window
+        if y_begin == 0:
+            backend, threads = _resolve_backend(backend, buffer[:,:buffer_count], parameters, None, z_bin, output_dtype,
+                                                quality=quality, exact_only=True, corrected=corrected)
+
+        slab = np.zeros((num_channels, binned_nz, plan.final_ny, nx), dtype=output_dtype)
+        _run_backend(backend, threads, buffer[:,:buffer_count], parameters, plan, z_bin, None, corrected, dark, gain,
+                     scale, clip_lo, clip_hi, rounded, slab)
+
+        # release this slab's plan before the next one is built, so only one slab plan is ever alive
+        del plan
+
+        if multichannel:
+            yield y_begin, slab
+        else:
+            yield y_begin, slab[0]
+
+def stage_deskew_roi(files, parameters, scan_range_um, height_range_um, x_range_um=None, z_bin=1, dark_offset=None, flat_field=None, quality='orthogonal',
+                     output_dtype=np.float32, scale=1.0, read_frame=None, frame_shape=None, backend=DEFAULT_BACKEND, read_frames=None):
+    '''deskew a physical sub-volume of one strip, reading only the raw frames and camera rows it needs.
+    Args:
+        files: ordered list of single-frame TIFF files for the strip, or anything read_frame takes, e.g. frame indices
+        parameters: [theta, stage move distance, camera pixel size] in [degrees,nm,nm]
+        scan_range_um: (start, end) along the stage scan axis, measured from the first frame
+        height_range_um: (start, end) above the bottom of the deskewed volume
+        x_range_um: (start, end) along the camera x axis. None keeps the full camera width.
+        z_bin: number of deskewed z planes averaged into each output plane
+        dark_offset: optional camera offset image (ny, nx)
+        flat_field: optional flat-field image (ny, nx)
+        quality: interpolation quality, one of QUALITY_MODES
+        output_dtype: dtype of the deskewed ROI. Integer types are rounded and clipped in the kernel.
+        scale: factor applied to every deskewed value before conversion
+        read_frame: function returning one frame from a file. skimage.io.imread if not provided.
+        frame_shape: camera frame shape (ny, nx). Read from the TIFF header of the first file if not provided.
+        backend: 'auto' (fastest on this machine) or one of the exact DESKEW_BACKENDS
+        read_frames: function(first, last, rows, cols) returning frames first to last (inclusive) cropped to the
+                     camera rows and columns [first, end), as (frames, rows, cols). Replaces read_frame, so chunked
+                     sources read the ROI in one go.
+    Returns:
+        (deskewed, origin, raw_roi): deskewed ROI in output_dtype, the (z, y, x) index of its first voxel in the full
+        stage_deskew output, and the raw ((first frame, last frame), (first row, last row)) that were read
+    '''
+    parameters = np.asarray(parameters, dtype=np.float32)
+    theta, distance, pixel_size = parameters[0], parameters[1], parameters[2]
+    quality_code = _quality_code(quality)
+    output_dtype, scale, clip_lo, clip_hi, rounded = _output_conversion(output_dtype, scale)
+    if read_frame is None:
+        read_frame = io.imread
+
+    # camera frame size from the TIFF header only
+    if frame_shape is None:
+        with tifffile.TiffFile(str(files[0])) as tif:
+            frame_shape = tif.pages[0].shape[-2:]
+    ny, nx = frame_shape
+    num_images = len(files)
+    final_nz, final_ny = _output_shape(theta, distance, pixel_size, num_images, ny)
+
+    # physical box to deskewed pixel ranges. Deskewed voxels are one camera pixel on a side before binning.
+    um_to_px = 1000./float(pixel_size)
+    def _px_range(range_um, size, align=1):
+        start = int(np.floor(range_um[0]*um_to_px))//align*align
+        end = int(np.ceil(np.ceil(range_um[1]*um_to_px)/align))*align
+        return min(max(start, 0), size), min(max(end, 0), size)
+
+    y_begin, y_end = _px_range(scan_range_um, final_ny)
+    z_begin, z_end = _px_range(height_range_um, final_nz, align=z_bin)
+    if x_range_um is None:
+        x_begin, x_end = 0, nx
+    else:
+        x_begin, x_end = _px_range(x_range_um, nx)
+
+    # geometry of the ROI against the whole strip
+    plan_nz, plan_ny, y_start, row_ptr, planes, rows, weights = _build_plan(theta, distance, pixel_size, num_images, ny,
+                                                                            y_begin, y_end, 0, z_begin, z_end, 0, quality_code)
+    output = np.zeros((1, -(-plan_nz // z_bin), plan_ny, x_end-x_begin), dtype=output_dtype)
+    origin = (z_begin//z_bin, y_begin, x_begin)
+
+    valid = planes[:,0] >= 0
+    if not np.any(valid):
+        return output[0], origin, None
+
+    # minimal set of raw frames and camera rows touched by the ROI
+    first_frame = int(planes[valid,0].min())
+    last_frame = int(planes[valid].max())
+    first_row = int(rows[valid].min())
+    last_row = int(rows[valid].max()) + weights.shape[2] - 1
+    planes[valid] -= first_frame
+    rows[valid] -= first_row
+
+    # read only those frames, keeping only the needed camera rows and columns
+    if read_frames is not None:
+        data = np.ascontiguousarray(read_frames(first_frame, last_frame, (first_row, last_row+1), (x_begin, x_end)))[np.newaxis]
+    else:
+        data = None
+        for i in range(first_frame, last_frame+1):
+            frame = read_frame(files[i])[first_row:last_row+1, x_begin:x_end]
+            if data is None:
+                data = np.empty((1, last_frame-first_frame+1)+frame.shape, dtype=frame.dtype)
+            data[0,i-first_frame] = frame
+
+    corrected = (dark_offset is not None) or (flat_field is not None)
+    dark, gain = _camera_correction((ny, nx), dark_offset, flat_field)
+    if corrected:
+        dark = np.ascontiguousarray(dark[:, first_row:last_row+1, x_begin:x_end])
+        gain = np.ascontiguousarray(gain[:, first_row:last_row+1, x_begin:x_end])
+
+    backend, threads = _resolve_backend(backend, data, parameters, None, z_bin, output_dtype, quality=quality, exact_only=True,
+                                        corrected=corrected)
+    _run_backend(backend, threads, data, parameters, DeskewPlan(plan_nz, plan_ny, y_start, row_ptr, planes, rows, weights), z_bin, None,
+                 corrected, dark, gain, scale, clip_lo, clip_hi, rounded, output)
+
+    return output[0], origin, ((first_frame, last_frame), (first_row, last_row))
+
+def stage_reskew(deskewed, parameters, raw_shape, z_bin=1, flat_field=None, quality='orthogonal', x_tile=None, plan=None, cache_dir=DEFAULT_CACHE_DIR):
+    '''map a deskewed volume back onto the raw oblique frames with the exact adjoint of stage_deskew.
+    For any raw stack a and deskewed volume b, sum(stage_deskew(a) * b) == sum(a * stage_reskew(b)) up to float32 rounding,
+    which is what iterative deconvolution and forward-model checks in skewed space need.
+    Args:
+        deskewed: deskewed volume with the shape stage_deskew returns for raw_shape and z_bin
+        parameters: [theta, stage move distance, camera pixel size] in [degrees,nm,nm]
+        raw_shape: shape of the raw stack (num_images, ny, nx)
+        z_bin: z binning factor used for the deskewed volume
+        flat_field: optional flat-field image (ny, nx) used in the forward deskew. The camera offset is a constant
+                    shift, not part of the linear operator, so it has no counterpart here.
+        quality: interpolation quality, one of QUALITY_MODES
+        x_tile: camera columns per kernel task. Sized from the L2 cache if not provided.
+        plan: precomputed DeskewPlan. Looked up from the plan cache if not provided. Overrides quality.
+        cache_dir: directory for on-disk plans. None keeps plans in memory only.
+    Returns:
+        raw space stack (num_images, ny, nx) as float32
+    '''
+    raw_shape = tuple(int(size) for size in raw_shape)
+    expected_shape = deskew_output_shape(parameters, raw_shape, z_bin=z_bin)
+    if tuple(deskewed.shape) != expected_shape:
+        raise ValueError('Deskewed volume has shape '+str(tuple(deskewed.shape))+', expected '+str(expected_shape)+ \
+                         ' for raw shape '+str(raw_shape)+' and z bin '+str(z_bin)+'.')
+
+    if plan is None:
+        plan = get_deskew_plan(parameters, raw_shape, quality=quality, cache_dir=cache_dir)
+
+    raw = np.zeros(raw_shape, dtype=np.float32)
+
+    # the adjoint of dividing by the flat field is the same per camera pixel gain
+    corrected = flat_field is not None
+    gain = _camera_correction(raw_shape[1:], None, flat_field)[1][0]
+
+    # the scatter streams through both volumes, so wide tiles are fastest. One tile per thread.
+    # (a y-outer, cache blocked order like _apply_plan measured slower for every tile width)
+    if x_tile is None:
+        x_tile = -(-raw_shape[2] // numba.get_num_threads())
+
+    return _apply_plan_adjoint(np.ascontiguousarray(deskewed), plan.y_start, plan.row_ptr, plan.planes, plan.rows, plan.weights,
+                               z_bin, x_tile, corrected, gain, raw)
+
+# read every element of a stack once across all threads. Used as the memory bandwidth reference.
+@njit(parallel=True, cache=True)
+def _read_bandwidth_kernel(data):
+    total = 0.0
+    for i in prange(data.shape[0]):
+        plane_total = 0.0
+        for j in range(data.shape[1]):
+            for k in range(data.shape[2]):
+                plane_total += data[i,j,k]
+        total += plane_total
+    return total
+
+def measure_deskew_throughput(shape=(2000,256,1600), parameters=(30,200,116), z_bin=2, dtype=np.uint16, output_dtype=np.float32, x_tile=None, repeats=3,
+                              backend=DEFAULT_BACKEND):
+    '''time the deskew kernel on a synthetic stack and compare it with the memory read bandwidth of this machine.
+    Args:
+        shape: raw stack shape (num_images, ny, nx)
+        parameters: [theta, stage move distance, camera pixel size] in [degrees,nm,nm]
+        z_bin: z binning factor
+        dtype: raw stack dtype
+        output_dtype: deskewed stack dtype
+        x_tile: camera columns per kernel task. Sized from the L2 cache if not provided.
+        repeats: number of timed runs. The fastest is reported.
+        backend: 'auto' (autotuned before the timed runs) or one of DESKEW_BACKENDS
+    Returns:
+        dict with backend, kernel time (s), input GB/s, output GB/s, memory read GB/s, and input GB/s as a fraction of it
+    '''
+    parameters = np.asarray(parameters, dtype=np.float32)
+    rng = np.random.default_rng(0)
+    data = rng.integers(100, 4000, size=shape).astype(dtype)
+
+    # build the plan, pick the backend, and compile the kernels outside of the timed runs
+    plan = get_deskew_plan(parameters, shape, cache_dir=None)
+    if backend == 'auto':
+        choice = select_deskew_backend(data, parameters, z_bin=z_bin, output_dtype=output_dtype, plan=plan)
+        backend_name, threads = choice['backend'], choice['threads']
+    else:
+        backend_name, threads = backend, None
+    if threads is None:
+        threads = numba.get_num_threads()
+    stage_deskew(data[:min(shape[0], 8)], parameters, z_bin=z_bin, output_dtype=output_dtype, x_tile=x_tile, cache_dir=None, backend=backend_name)
+    _read_bandwidth_kernel(data[:1])
+
+    deskew_times = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        output = stage_deskew(data, parameters, z_bin=z_bin, output_dtype=output_dtype, x_tile=x_tile, plan=plan, backend=backend)
+        deskew_times.append(time.perf_counter() - start)
+
+    read_times = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        _read_bandwidth_kernel(data)
+        read_times.append(time.perf_counter() - start)
+
+    deskew_s = min(deskew_times)
+    input_gbs = data.nbytes/deskew_s/1e9
+    read_gbs = data.nbytes/min(read_times)/1e9
+
+    return {'backend': backend_name,
+            'threads': threads,
+            'x_tile': x_tile if x_tile is not None else _auto_x_tile(shape[2], data.dtype.itemsize, z_bin, output.shape[0]),
+            'deskew_s': deskew_s,
+            'input_GBps': input_gbs,
+            'output_GBps': output.nbytes/deskew_s/1e9,
+            'memory_read_GBps': read_gbs,
+            'fraction_of_memory_read': input_gbs/read_gbs}
+
+# add Gaussian beads (z, y, x, amplitude per row of beads) to a volume sampled at the given (z, y) coordinates.
+# coordinates are in camera pixels, with y along the stage scan and z above the coverslip.
+@njit(parallel=True, cache=True)
+def _render_beads(beads, sigma, z_coords, y_coords, volume):
+    radius = 4.0*sigma
+    for i in prange(volume.shape[0]):
+        for j in range(volume.shape[1]):
+            z = z_coords[i,j]
+            y = y_coords[i,j]
+            for b in range(beads.shape[0]):
+                dz = z - beads[b,0]
+                dy = y - beads[b,1]
+                if (abs(dz) > radius) or (abs(dy) > radius):
+                    continue
+                x_lo = max(0, np.int64(np.floor(beads[b,2]-radius)))
+                x_hi = min(volume.shape[2], np.int64(np.ceil(beads[b,2]+radius))+1)
+                for x in range(x_lo,x_hi):
+                    dx = x - beads[b,2]
+                    volume[i,j,x] += beads[b,3]*np.exp(-(dz*dz+dy*dy+dx*dx)/(2.0*sigma*sigma))
+    return volume
+
+def measure_quality_comparison(shape=(600,128,256), parameters=(30,200,116), num_beads=300, sigma=1.5, repeats=3):
+    '''compare speed and accuracy of every deskew quality on a bead phantom with a known deskewed ground truth.
+    Args:
+        shape: raw stack shape (num_images, ny, nx)
+        parameters: [theta, stage move distance, camera pixel size] in [degrees,nm,nm]
+        num_beads: number of Gaussian beads in the phantom
+        sigma: bead standard deviation in camera pixels
+        repeats: number of timed runs per quality. The fastest is reported.
+    Returns:
+        dict per quality with kernel time (s), speed relative to orthogonal, and RMS / max error relative to the bead peak
+    '''
+    parameters = np.asarray(parameters, dtype=np.float32)
+    theta, distance, pixel_size = parameters[0], parameters[1], parameters[2]
+    num_images, ny, nx = shape
+    final_nz, final_ny = _output_shape(theta, distance, pixel_size, num_images, ny)
+    pixel_step = distance/pixel_size
+
+    # random beads inside the deskewed volume
+    rng = np.random.default_rng(0)
+    beads = np.stack((rng.uniform(0, final_nz, num_beads), rng.uniform(0, final_ny, num_beads),
+                      rng.uniform(0, nx, num_beads), np.full(num_beads, 1000.0)), axis=1)
+
+    # raw frames sample the beads on the tilted planes, deskewed voxels sample them on the coverslip grid
+    plane, row = np.meshgrid(np.arange(num_images), np.arange(ny), indexing='ij')
+    raw = _render_beads(beads, sigma, row*np.sin(theta*np.pi/180), plane*pixel_step + row*np.cos(theta*np.pi/180),
+                        np.zeros(shape, dtype=np.float32))
+    z, y = np.meshgrid(np.arange(final_nz), np.arange(final_ny), indexing='ij')
+    truth = _render_beads(beads, sigma, z.astype(np.float64), y.astype(np.float64), np.zeros((final_nz, final_ny, nx), dtype=np.float32))
+
+    # compare only voxels every quality fills (they share one footprint)
+    footprint = stage_deskew(np.ones((num_images, ny, 1), dtype=np.float32), parameters, cache_dir=None, backend='numba')[:,:,0] > 0.5
+
+    results = {}
+    for quality in QUALITY_MODES:
+        plan = get_deskew_plan(parameters, shape, quality=quality, cache_dir=None)
+        stage_deskew(raw[:8], parameters, quality=quality, cache_dir=None, backend='numba')
+
+        times = []
+        for i in range(repeats):
+            start = time.perf_counter()
+            deskewed = stage_deskew(raw, parameters, plan=plan, backend='numba')
+            times.append(time.perf_counter() - start)
+
+        error = (deskewed - truth)[footprint]
+        results[quality] = {'deskew_s': min(times),
+                            'rms_error': float(np.sqrt(np.mean(error**2)))/1000.0,
+                            'max_error': float(np.abs(error).max())/1000.0}
+
+    for quality in QUALITY_MODES:
+        results[quality]['speedup'] = results['orthogonal']['deskew_s']/results[quality]['deskew_s']
+
+    return results
+
+def compile_kernels(verbose=False):
+    '''compile and cache the kernel specialisations used by the recon scripts, so no run pays JIT time.
+    Covers uint16 camera data and float32 data, float32 and uint16 output, single and multi-channel stacks
+    (which reach the kernel with different array layouts), and the re-skew operator.
+    Args:
+        verbose: print each specialisation as it is compiled
+    Returns:
+        number of compiled specialisations of the deskew kernel
+    '''
+    parameters = (30,200,116)
+    count = 0
+    for dtype in (np.uint16, np.float32):
+        for output_dtype in (np.float32, np.uint16):
+            # contiguous single-channel stacks, and the channel-strided window of a streamed multi-channel scan
+            data = np.zeros((2,8,8,8), dtype=dtype)
+            stage_deskew(data[0], parameters, output_dtype=output_dtype, cache_dir=None, backend='numba')
+            for _ in stage_deskew_stream(iter(data.transpose(1,0,2,3)), 8, parameters, slab_ny=4, output_dtype=output_dtype, backend='numba'):
+                pass
+            count = count + 2
+            if verbose:
+                print('Compiled '+np.dtype(dtype).name+' -> '+np.dtype(output_dtype).name)
+    stage_reskew(np.zeros(deskew_output_shape(parameters, (8,8,8)), dtype=np.float32), parameters, (8,8,8), cache_dir=None)
+
+    return count
+
+def measure_startup(repeats=2):
+    '''time a fresh interpreter deskewing a small stack, with an empty kernel cache (cold) and a filled one (warm).
+    Args:
+        repeats: number of warm launches. The fastest is reported.
+    Returns:
+        dict with cold and warm launch times (s), both including interpreter start and imports
+    '''
+    script = 'import numpy as np; import deskew_engine as de; ' + \
+             'de.stage_deskew(np.zeros((64,64,64), dtype=np.uint16), (30,200,116), z_bin=2, output_dtype=np.uint16, cache_dir=None, backend="numba")'
+    module_dir = str(Path(__file__).resolve().parent)
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        env = dict(os.environ, NUMBA_CACHE_DIR=cache_dir)
+        times = []
+        for i in range(repeats+1):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, '-c', script], cwd=module_dir, env=env, check=True)
+            times.append(time.perf_counter() - start)
+
+    return {'cold_s': times[0], 'warm_s': min(times[1:])}
+
+# print a deskew throughput report for this machine
+def main(argv):
+
+    shape = [None,None,None]
+    params = [30,200,116]
+    z_bin = 2
+    x_tile = None
+    output_dtype = np.float32
+    compare_quality = False
+    warm_up = False
+    startup = False
+    backend = DEFAULT_BACKEND
+    autotune = False
+
+    try:
+        arguments, values = getopt.getopt(argv,"hn:y:x:b:t:uqwsk:a",["help","frames=","ny=","nx=","zbin=","xtile=","uint16","quality","warmup","startup","backend=","autotune"])
+    except getopt.GetoptError:
+        print('Error. deskew_engine.py -n <frames> -y <camera rows> -x <camera columns> -b <z bin> -t <x tile> -k <backend> [-u] [-q] [-w] [-s] [-a]')
+        sys.exit(2)
+    for current_argument, current_value in arguments:
+        if current_argument in ('-h', '--help'):
+            print('Usage. deskew_engine.py -n <frames> -y <camera rows> -x <camera columns> -b <z bin> -t <x tile> -k <backend> [-u] [-q] [-w] [-s] [-a]')
+            print('       -u writes uint16 instead of float32 output')
+            print('       -q compares speed and accuracy of the interpolation qualities on a bead phantom')
+            print('       -w compiles and caches the deskew kernels for every dtype used by the recon scripts')
+            print('       -s measures cold vs warm startup of a recon process')
+            print('       -k times one backend ('+', '.join(DESKEW_BACKENDS)+') instead of the autotuned one')
+            print('       -a re-runs the backend autotuner for the stack shape and stores its choice')
+            sys.exit()
+        elif current_argument in ("-n", "--frames"):
+            shape[0] = int(current_value)
+        elif current_argument in ("-y", "--ny"):
+            shape[1] = int(current_value)
+        elif current_argument in ("-x", "--nx"):
+            shape[2] = int(current_value)
+        elif current_argument in ("-b", "--zbin"):
+            z_bin = int(current_value)
+        elif current_argument in ("-t", "--xtile"):
+            x_tile = int(current_value)
+        elif current_argument in ("-u", "--uint16"):
+            output_dtype = np.uint16
+        elif current_argument in ("-q", "--quality"):
+            compare_quality = True
+        elif current_argument in ("-w", "--warmup"):
+            warm_up = True
+        elif current_argument in ("-s", "--startup"):
+            startup = True
+        elif current_argument in ("-k", "--backend"):
+            backend = current_value
+        elif current_argument in ("-a", "--autotune"):
+            autotune = True
+
+    if warm_up:
+        start = time.perf_counter()
+        count = compile_kernels(verbose=True)
+        print('Compiled and cached '+str(count)+' deskew kernel specialisations in {:.1f} s.'.format(time.perf_counter()-start))
+        return
+
+    if startup:
+        report = measure_startup()
+        print('Cold start (empty kernel cache): {:.2f} s'.format(report['cold_s']))
+        print('Warm start (cached kernels): {:.2f} s'.format(report['warm_s']))
+        return
+
+    # default stack sizes: a full camera frame for throughput, a smaller stack for the phantom comparison
+    default_shape = [600,128,256] if compare_quality else [2000,256,1600]
+    shape = [default if size is None else size for size, default in zip(shape, default_shape)]
+
+    if compare_quality:
+        results = measure_quality_comparison(shape=tuple(shape), parameters=params)
+        print('Bead phantom: '+str(tuple(shape))+', '+str(numba.get_num_threads())+' threads. Errors relative to bead peak.')
+        for quality in QUALITY_MODES:
+            print('{:>10}: {:.3f} s ({:.2f}x orthogonal), RMS error {:.4f}, max error {:.4f}'.format(
+                quality, results[quality]['deskew_s'], results[quality]['speedup'],
+                results[quality]['rms_error'], results[quality]['max_error']))
+        return
+
+    if backend != 'auto':
+        _backend_spec(backend)
+
+    if autotune:
+        data = np.random.default_rng(0).integers(100, 4000, size=tuple(shape)).astype(np.uint16)
+        choice = select_deskew_backend(data, params, z_bin=z_bin, output_dtype=output_dtype, retune=True)
+        print('Autotuned '+str(tuple(shape))+' uint16, output '+np.dtype(output_dtype).name+', z bin '+str(z_bin)+ \
+              ' on '+str(min(shape[0], AUTOTUNE_FRAMES))+' frames x '+str(min(shape[2], AUTOTUNE_COLUMNS))+' camera columns:')
+        for label in choice['timings']:
+            print('{:>10}: {:.3f} s'.format(label, choice['timings'][label]))
+        print('Chosen: '+choice['backend']+('' if choice['threads'] is None else ' with '+str(choice['threads'])+' threads'))
+        return
+
+    report = measure_deskew_throughput(shape=tuple(shape), parameters=params, z_bin=z_bin, output_dtype=output_dtype, x_tile=x_tile,
+                                       backend=backend)
+
+    print('Raw stack: '+str(tuple(shape))+' uint16, output '+np.dtype(output_dtype).name+', z bin '+str(z_bin)+ \
+          ', '+report['backend']+' backend, x tile '+str(report['x_tile'])+', '+str(report['threads'])+' threads')
+    print('Deskew time: {:.3f} s'.format(report['deskew_s']))
+    print('Deskew input throughput: {:.2f} GB/s'.format(report['input_GBps']))
+    print('Deskew output throughput: {:.2f} GB/s'.format(report['output_GBps']))
+    print('Memory read bandwidth: {:.2f} GB/s'.format(report['memory_read_GBps']))
+    print('Deskew input / memory read: {:.0%}'.format(report['fraction_of_memory_read']))
+
+# run
+if __name__ == "__main__":
+    main(sys.argv[1:])
+
+
+# The MIT License
+#
+# Copyright (c) 2020 Douglas Shepherd, Arizona State University
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
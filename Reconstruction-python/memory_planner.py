@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+
+'''
+Memory planner for the stage scanning OPM reconstruction scripts.
+
+Predicts the peak memory of reconstructing one strip from the raw stack shape, dtype, and scan geometry,
+and picks block boundaries that fit a RAM budget instead of hand-tuned split counts.
+Four buffers are modelled:
+    read buffers    raw frames held for the deskew (camera dtype), including the halo copy of streamed windows
+    deskew          interpolation plan and camera correction images. z binning happens in the kernel,
+                    so no unbinned deskewed copy is ever allocated.
+    binned output   deskewed, z binned stack in the output dtype, from deskew_output_shape (final_nz, final_ny)
+    writer staging  temporary copies npy2bdv makes while writing one view: an int16 copy of the view for the
+                    full resolution level, and the padded copy plus float64 block means for each subsampled level
+Blocks either split the raw frames of a strip (with a small overlap for alignment in BigStitcher, deskewed and
+written as separate BDV tiles), or split the output scan axis into slabs for stage_deskew_stream.
+'''
+
+# imports
+import numpy as np
+from collections import namedtuple
+import os
+from deskew_engine import deskew_output_shape, _frame_window, _output_shape, QUALITY_MODES, PLAN_CACHE_BYTES, plan_cache_bytes, \
+    _plan_nbytes_estimate, _quality_code
+
+# fraction of the available memory used when no budget is given, leaving room for the OS and page cache
+DEFAULT_BUDGET_FRACTION = 0.8
+
+# num_blocks: number of blocks per strip
+# block_axis: 'frames' (blocks are raw frame ranges) or 'y' (blocks are output slabs along the scan axis)
+# blocks: list of [start, end) frame ranges or output row ranges
+# block_frames: raw frames held in memory for the largest block
+# read_bytes, deskew_bytes, binned_bytes, writer_bytes: predicted size of each buffer for the largest block,
+#     counting both buffers of a double-buffered stage when the blocks are pipelined
+# peak_bytes: predicted peak, from the buffers that are alive at the same time
+# budget_bytes: RAM budget the plan was made for
+MemoryPlan = namedtuple('MemoryPlan', ['num_blocks', 'block_axis', 'blocks', 'block_frames', 'read_bytes', 'deskew_bytes',
+                                       'binned_bytes', 'writer_bytes', 'peak_bytes', 'budget_bytes'])
+
+def available_memory_bytes():
+    '''memory that can be used without swapping, in bytes.
+    Uses psutil if installed, /proc/meminfo on Linux, and free physical pages elsewhere.
+    '''
+    try:
+        import psutil
+        return int(psutil.virtual_memory().available)
+    except ImportError:
+        pass
+
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+
+    return int(os.sysconf('SC_AVPHYS_PAGES')*os.sysconf('SC_PAGE_SIZE'))
+
+# temporary memory of npy2bdv append_view for one (nz, ny, nx) uint16 view. Levels are written one after the other,
+# and each level's int16 data stays referenced while the next level is computed.
+# checked against VmHWM with npy2bdv / skimage block_reduce / h5py, rounded up.
+def _writer_staging_bytes(view_shape, subsamp):
+    voxels = int(np.prod(view_shape))
+    peak = 0
+    previous_voxels = 0
+    for level in subsamp:
+        factor = int(np.prod(level))
+        level_voxels = -(-voxels // factor)
+        if factor == 1:
+            # astype('int16') copy of the whole view, plus HDF5 chunking buffers of up to 3/4 of a view
+            level_bytes = 2*previous_voxels + (2*voxels*7)//4
+        else:
+            # downscale_local_mean pads to a multiple of the block size (a copy unless it already is one), and
+            # returns float64 block means, which are then converted to uint16 and int16
+            padded = 0 if all([size % step == 0 for size, step in zip(view_shape, level)]) else 2*voxels
+            level_bytes = 2*previous_voxels + padded + (8+2+2)*level_voxels
+        peak = max(peak, level_bytes)
+        previous_voxels = level_voxels
+    return peak
+
+# plan arrays of a deskew covering num_y output rows in each of the final_nz planes, sized as get_deskew_plan does
+def _plan_bytes(final_nz, num_y, quality):
+    return _plan_nbytes_estimate(final_nz, num_y, _quality_code(quality))
+
+# deskew plans held by get_deskew_plan while the blocks are reconstructed: the plan of every distinct block length
+# and the plans already cached by this process, capped at PLAN_CACHE_BYTES but never below the plan in use
+def _cached_plan_bytes(plan_bytes):
+    return max(max(plan_bytes), min(sum(plan_bytes) + plan_cache_bytes(), PLAN_CACHE_BYTES))
+
+def block_ranges(num_images, num_blocks, overlap=0.05):
+    '''raw frame ranges of a strip split into blocks that overlap for alignment in BigStitcher.
+    Args:
+        num_images: number of frames in the strip
+        num_blocks: number of blocks
+        overlap: frames shared with each neighbouring block, as a fraction of the block length
+    Returns:
+        list of [start, end) frame ranges
+    '''
+    split = num_images//num_blocks
+    overlap_frames = int(np.floor(split*overlap))
+    blocks = []
+    for block_id in range(num_blocks):
+        start = max(block_id*split - overlap_frames, 0)
+        end = num_images if block_id == num_blocks-1 else min((block_id+1)*split + overlap_frames, num_images)
+        blocks.append((start, end))
+    return blocks
+
+def plan_frame_blocks(num_images, frame_shape, parameters, num_channels=1, dtype=np.uint16, z_bin=2, output_dtype=np.uint16,
+                      quality='orthogonal', corrected=False, subsamp=((1,1,1),), overlap=0.05, budget_bytes=None, max_blocks=None,
+                      pipelined=False):
+    '''fewest raw frame blocks per strip whose reconstruction fits a RAM budget.
+    Each block of frames is read, deskewed for all num_channels at once, freed, and written one channel view at a time.
+    The deskew plans of all block lengths stay in the in-memory plan cache (up to PLAN_CACHE_BYTES) and are counted.
+    Args:
+        num_images: number of frames in the strip
+        frame_shape: camera frame shape (ny, nx)
+        parameters: [theta, stage move distance, camera pixel size] in [degrees,nm,nm]
+        num_channels: channels read and deskewed together
+        dtype: raw frame dtype
+        z_bin: z binning factor
+        output_dtype: deskewed stack dtype
+        quality: interpolation quality, one of QUALITY_MODES
+        corrected: True if dark offset / flat-field images are applied
+        subsamp: npy2bdv subsampling levels of the output file
+        overlap: frames shared with each neighbouring block, as a fraction of the block length
+        budget_bytes: RAM budget. DEFAULT_BUDGET_FRACTION of the available memory if not provided.
+        max_blocks: largest number of blocks to consider. Every block keeps at least 64 frames if not provided.
+        pipelined: blocks run through opm_pipeline with double buffering, so the next raw block is read and the previous
+                   deskewed block is written while the current one is deskewed
+    Returns:
+        MemoryPlan with block_axis 'frames'
+    '''
+    if quality not in QUALITY_MODES:
+        raise ValueError('Unknown deskew quality '+repr(quality)+'. Use one of '+', '.join(QUALITY_MODES)+'.')
+    if budget_bytes is None:
+        budget_bytes = int(DEFAULT_BUDGET_FRACTION*available_memory_bytes())
+    if max_blocks is None:
+        max_blocks = max(num_images//64, 1)
+    parameters = np.asarray(parameters, dtype=np.float32)
+    ny, nx = frame_shape
+    itemsize = np.dtype(dtype).itemsize
+    output_itemsize = np.dtype(output_dtype).itemsize
+    correction_bytes = 2*num_channels*ny*nx*4 if corrected else 0
+
+    for num_blocks in range(1, max_blocks+1):
+        blocks = block_ranges(num_images, num_blocks, overlap)
+        block_frames = max([end-start for start, end in blocks])
+
+        view_shape = deskew_output_shape(parameters, (block_frames, ny, nx), z_bin=z_bin)
+        final_nz, final_ny = _output_shape(parameters[0], parameters[1], parameters[2], block_frames, ny)
+        read_bytes = num_channels*block_frames*ny*nx*itemsize
+        plan_bytes = [_plan_bytes(*_output_shape(parameters[0], parameters[1], parameters[2], frames, ny), quality=quality)
+                      for frames in set([end-start for start, end in blocks])]
+        deskew_bytes = _cached_plan_bytes(plan_bytes) + correction_bytes
+        binned_bytes = num_channels*int(np.prod(view_shape))*output_itemsize
+        writer_bytes = _writer_staging_bytes(view_shape, subsamp)
+
+        # the raw block is freed after the deskew, before the views are written. After append_view returns, the C heap
+        # (HDF5 buffers, malloc arenas) keeps about half of the writer staging, which the next deskew then sits on top of.
+        peak_bytes = max(read_bytes + deskew_bytes + binned_bytes + writer_bytes//2, deskew_bytes + binned_bytes + writer_bytes)
+        if pipelined:
+            # the next raw block and the previous deskewed block (with its writer staging) are alive during every deskew
+            read_bytes = 2*read_bytes
+            binned_bytes = 2*binned_bytes
+            peak_bytes = read_bytes + deskew_bytes + binned_bytes + writer_bytes
+        if peak_bytes <= budget_bytes:
+            break
+
+    return MemoryPlan(num_blocks, 'frames', blocks, block_frames, read_bytes, deskew_bytes, binned_bytes, writer_bytes, peak_bytes, budget_bytes)
+
+def plan_stream_slabs(num_images, frame_shape, parameters, num_channels=1, dtype=np.uint16, z_bin=2, output_dtype=np.uint16,
+                      quality='orthogonal', corrected=False, subsamp=((1,1,1),), budget_bytes=None, min_slab_ny=64,
+                      prefetch_frames=0):
+    '''widest output slab for stage_deskew_stream whose reconstruction fits a RAM budget.
+    The frame window, the slab of every channel, the plan of one slab, and the writer staging of one channel view are
+    alive together, on top of the plans already held in the in-memory plan cache.
+    Args:
+        num_images: number of frames in the strip
+        frame_shape: camera frame shape (ny, nx)
+        parameters: [theta, stage move distance, camera pixel size] in [degrees,nm,nm]
+        num_channels: channels streamed together
+        dtype: raw frame dtype
+        z_bin: z binning factor
+        output_dtype: deskewed stack dtype
+        quality: interpolation quality, one of QUALITY_MODES
+        corrected: True if dark offset / flat-field images are applied
+        subsamp: npy2bdv subsampling levels of the output file
+        budget_bytes: RAM budget. DEFAULT_BUDGET_FRACTION of the available memory if not provided.
+        min_slab_ny: narrowest slab considered, in output rows
+        prefetch_frames: frames read ahead by opm_pipeline.prefetch. Non-zero also means slabs are written in the
+                         background, so the previous slab is alive while the next one is deskewed.
+    Returns:
+        MemoryPlan with block_axis 'y'. Pass blocks[0][1]-blocks[0][0] as slab_ny.
+    '''
+    if quality not in QUALITY_MODES:
+        raise ValueError('Unknown deskew quality '+repr(quality)+'. Use one of '+', '.join(QUALITY_MODES)+'.')
+    if budget_bytes is None:
+        budget_bytes = int(DEFAULT_BUDGET_FRACTION*available_memory_bytes())
+    parameters = np.asarray(parameters, dtype=np.float32)
+    ny, nx = frame_shape
+    itemsize = np.dtype(dtype).itemsize
+    output_itemsize = np.dtype(output_dtype).itemsize
+    correction_bytes = 2*num_channels*ny*nx*4 if corrected else 0
+    final_nz, final_ny = _output_shape(parameters[0], parameters[1], parameters[2], num_images, ny)
+    binned_nz = -(-int(final_nz) // z_bin)
+
+    # slab plans are built per slab and never cached, so plans cached earlier in this process stay as they are
+    cached_bytes = plan_cache_bytes()
+
+    # predicted buffers for one slab width
+    def _slab_memory(slab_ny):
+        slab_ny = min(slab_ny, final_ny)
+        windows = [_frame_window(parameters[0], parameters[1], parameters[2], num_images, ny, y_begin, min(y_begin+slab_ny, final_ny))
+                   for y_begin in range(0, final_ny, slab_ny)]
+        block_frames = max([last-first+1 for first, last in windows])
+
+        # frames kept between slabs are moved to the front of the window through a temporary copy
+        halo_frames = max([0] + [max(last-next_first+1, 0) for (first, last), (next_first, next_last) in zip(windows[:-1], windows[1:])])
+        read_bytes = num_channels*(block_frames + halo_frames + prefetch_frames)*ny*nx*itemsize
+        deskew_bytes = _plan_bytes(final_nz, slab_ny, quality) + cached_bytes + correction_bytes
+        binned_bytes = num_channels*binned_nz*slab_ny*nx*output_itemsize*(2 if prefetch_frames > 0 else 1)
+        writer_bytes = _writer_staging_bytes((binned_nz, slab_ny, nx), subsamp)
+        return block_frames, read_bytes, deskew_bytes, binned_bytes, writer_bytes, read_bytes + deskew_bytes + binned_bytes + writer_bytes
+
+    # peak grows with the slab width. Bisect for the widest multiple of min_slab_ny that fits.
+    lo, hi = 1, -(-int(final_ny) // min_slab_ny)
+    while lo < hi:
+        mid = (lo + hi + 1)//2
+        if _slab_memory(mid*min_slab_ny)[-1] <= budget_bytes:
+            lo = mid
+        else:
+            hi = mid - 1
+    slab_ny = int(min(lo*min_slab_ny, final_ny))
+
+    block_frames, read_bytes, deskew_bytes, binned_bytes, writer_bytes, peak_bytes = _slab_memory(slab_ny)
+    blocks = [(y_begin, min(y_begin+slab_ny, int(final_ny))) for y_begin in range(0, int(final_ny), slab_ny)]
+
+    return MemoryPlan(len(blocks), 'y', blocks, block_frames, read_bytes, deskew_bytes, binned_bytes, writer_bytes, peak_bytes, budget_bytes)
+
+def print_memory_plan(plan):
+    '''print a memory plan before a reconstruction starts.
+    Args:
+        plan: MemoryPlan from plan_frame_blocks or plan_stream_slabs
+    '''
+    if plan.block_axis == 'frames':
+        print('Memory plan: '+str(plan.num_blocks)+' block(s) of raw frames per strip, up to '+str(plan.block_frames)+' frames each.')
+        print('  blocks (frames): '+', '.join([str(start)+'-'+str(end-1) for start, end in plan.blocks]))
+    else:
+        print('Memory plan: '+str(plan.num_blocks)+' slab(s) of '+str(plan.blocks[0][1]-plan.blocks[0][0])+ \
+              ' output rows per strip, up to '+str(plan.block_frames)+' frames in memory.')
+    print('  read buffers:   {:8.2f} GB'.format(plan.read_bytes/1e9))
+    print('  deskew plan:    {:8.2f} GB'.format(plan.deskew_bytes/1e9))
+    print('  binned output:  {:8.2f} GB'.format(plan.binned_bytes/1e9))
+    print('  writer staging: {:8.2f} GB'.format(plan.writer_bytes/1e9))
+    print('  predicted peak: {:8.2f} GB of {:.2f} GB budget'.format(plan.peak_bytes/1e9, plan.budget_bytes/1e9))
+    if plan.peak_bytes > plan.budget_bytes:
+        print('  Warning: the smallest block considered does not fit the budget.')
+
+
+# The MIT License
+#
+# Copyright (c) 2020 Douglas Shepherd, Arizona State University
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
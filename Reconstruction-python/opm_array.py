@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+
+'''
+Lazy array view of a stage scanning OPM acquisition.
+
+AcquisitionArray opens an experiment from its acquisition manifest alone and exposes it as one
+(channel, tile, frame, y, x) array, whatever the raw frames are stored in: single-frame TIFF directories, pycromanager
+NDTiff datasets, BDV H5 files written during acquisition, or packed raw containers. Tiles are the (height, tile)
+positions of the strips in manifest order. Opening a terabyte experiment takes one small file read.
+
+Frames are only read when a slice touches them, a consecutive run of frames at a time, and decoded frames are kept
+in a least recently used cache bounded by a byte budget. Paging back and forth through a tile, or taking several
+crops of the same frames, reads them from disk once.
+
+    data = AcquisitionArray(experiment_dir, skip_frames=10)
+    preview = data[0, 3, ::10, 512:1024].max(axis=0)
+
+Run as a script to save the maximum projection of a range of frames of one tile:
+    python opm_array.py -i <inputdirectory> -c <channel index> -t <tile index> -f <first,last> -o <preview.tif>
+'''
+
+# imports
+import numpy as np
+import os
+import sys
+import getopt
+import threading
+from collections import OrderedDict, namedtuple
+from pathlib import Path
+import tifffile
+from opm_io import open_strip, read_strip
+from opm_manifest import load_manifest, manifest_strips, manifest_tiles, strip_channel_indices
+
+# default byte budget of the decoded frame cache. Override with the OPM_ARRAY_CACHE_GB environment variable.
+DEFAULT_CACHE_BYTES = int(float(os.environ.get('OPM_ARRAY_CACHE_GB', 1))*1e9)
+
+# longest run of frames read at once. Bounds the transient memory of a slice that misses the cache.
+_MAX_RUN_FRAMES = 256
+
+# hits, misses: frames found in and read into the cache
+# frames, nbytes: frames and bytes held by the cache
+# max_bytes: byte budget of the cache
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'frames', 'nbytes', 'max_bytes'])
+
+# indices of one of the channel, tile, and frame axes, and whether the axis is dropped from the result
+def _axis_indices(key, size):
+    if isinstance(key, slice):
+        return list(range(*key.indices(size))), False
+    if isinstance(key, (int, np.integer)):
+        index = int(key)
+        if not -size <= index < size:
+            raise IndexError('Index '+str(index)+' is out of bounds for an axis of size '+str(size)+'.')
+        return [index % size], True
+    key = np.asarray(key)
+    if key.dtype == bool:
+        if key.shape != (size,):
+            raise IndexError('Boolean index of shape '+str(key.shape)+' does not match an axis of size '+str(size)+'.')
+        return [int(index) for index in np.nonzero(key)[0]], False
+    if key.ndim != 1 or not np.issubdtype(key.dtype, np.integer):
+        raise IndexError('Only integers, slices, and 1D integer or boolean arrays index the channel, tile, and frame axes.')
+    if np.any((key < -size) | (key >= size)):
+        raise IndexError('Index out of bounds for an axis of size '+str(size)+'.')
+    return [int(index) % size for index in key], False
+
+# y, x crop of one frame. Integers drop the axis, as in numpy.
+def _crop(frame, key_y, key_x):
+    frame = frame[key_y]
+    if isinstance(key_y, (int, np.integer)):
+        return frame[key_x]
+    return frame[:, key_x]
+
+# consecutive runs of sorted frame indices, at most max_frames long
+def _frame_runs(frames, max_frames):
+    runs = []
+    for frame in frames:
+        if runs and frame == runs[-1][1] and frame-runs[-1][0] < max_frames:
+            runs[-1][1] = frame+1
+        else:
+            runs.append([frame, frame+1])
+    return runs
+
+class AcquisitionArray:
+    '''lazy, sliceable (channel, tile, frame, y, x) view of an acquisition.
+    Indexing with integers, slices, and integer or boolean lists returns a numpy array. Indices of y and x are
+    applied to every frame one after the other, so two lists select a grid rather than points. Tiles without a strip
+    of a channel, and frames past the end of a short strip, read as zeros.
+    Args:
+        experiment_dir: experiment directory. Indexed and given a manifest if it has none.
+        skip_frames: lead-in frames at the start of every strip (stage speed up) left out of the frame axis
+        cache_bytes: byte budget of the decoded frame cache. 0 disables the cache.
+        manifest: manifest dict of the experiment, or None to load it
+    '''
+    def __init__(self, experiment_dir, skip_frames=0, cache_bytes=DEFAULT_CACHE_BYTES, manifest=None):
+        self.experiment_dir = Path(experiment_dir)
+        self.manifest = load_manifest(self.experiment_dir) if manifest is None else manifest
+        self.skip_frames = int(skip_frames)
+        self.cache_bytes = int(cache_bytes)
+
+        self._sources = {}
+        self._cache = OrderedDict()
+        self._cache_nbytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+        strips = manifest_strips(self.manifest)
+        self._strip_list = strips
+        if not strips:
+            raise ValueError('No strips in the manifest of '+str(self.experiment_dir)+'.')
+        self.channels = list(self.manifest['channels'])
+        self.tiles = manifest_tiles(self.manifest)
+
+        # (channel index, tile index) to (strip index, channel of the strip's source)
+        self._strips = {}
+        for strip_index, strip in enumerate(strips):
+            tile_index = self.tiles.index((strip['height'], strip['tile']))
+            for source_channel, channel_index in enumerate(strip_channel_indices(self.manifest, strip)):
+                self._strips[(channel_index, tile_index)] = (strip_index, source_channel)
+
+        if self.manifest['frame_shape'] is None or self.manifest['dtype'] is None:
+            source = self._source(0)
+            frame_shape, self.dtype = tuple(source.frame_shape), np.dtype(source.dtype)
+        else:
+            frame_shape, self.dtype = tuple(self.manifest['frame_shape']), np.dtype(self.manifest['dtype'])
+        num_frames = max([strip['frames'] for strip in strips]) - self.skip_frames
+        self.shape = (len(self.channels), len(self.tiles), max(num_frames, 0)) + frame_shape
+        self.ndim = len(self.shape)
+
+    def __repr__(self):
+        return 'AcquisitionArray('+str(self.experiment_dir)+', shape='+str(self.shape)+', dtype='+self.dtype.name+ \
+            ', layout='+self.manifest['layout']+')'
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.size*self.dtype.itemsize
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[...]
+        return data if dtype is None else data.astype(dtype, copy=False)
+
+    # opened source of a strip. Opening reads its header or index, so it is done once and only when first read.
+    def _source(self, strip_index):
+        with self._lock:
+            source = self._sources.get(strip_index)
+        if source is None:
+            source = open_strip(self.experiment_dir, self._strip_list[strip_index])
+            with self._lock:
+                self._sources[strip_index] = source
+        return source
+
+    def _cache_get(self, key):
+        with self._lock:
+            frame = self._cache.get(key)
+            if frame is None:
+                self._misses = self._misses + 1
+            else:
+                self._cache.move_to_end(key)
+                self._hits = self._hits + 1
+            return frame
+
+    def _cache_put(self, key, frame):
+        if frame.nbytes > self.cache_bytes:
+            return
+        with self._lock:
+            if key in self._cache:
+                return
+            self._cache[key] = frame
+            self._cache_nbytes = self._cache_nbytes + frame.nbytes
+            while self._cache_nbytes > self.cache_bytes:
+                _, evicted = self._cache.popitem(last=False)
+                self._cache_nbytes = self._cache_nbytes - evicted.nbytes
+
+    def cache_info(self):
+        '''hits, misses, and size of the decoded frame cache.'''
+        with self._lock:
+            return CacheInfo(self._hits, self._misses, len(self._cache), self._cache_nbytes, self.cache_bytes)
+
+    def clear_cache(self):
+        '''drop every cached frame.'''
+        with self._lock:
+            self._cache.clear()
+            self._cache_nbytes = 0
+
+    # copy the requested frames of one strip channel into out, reading the ones not in the cache
+    def _read_frames(self, strip_index, source_channel, frames, out, key_y, key_x):
+        positions = {}
+        for position, frame in enumerate(frames):
+            positions.setdefault(frame, []).append(position)
+        strip_frames = self._strip_list[strip_index]['frames'] - self.skip_frames
+
+        missing = []
+        for frame in sorted(positions):
+            if frame >= strip_frames:
+                continue
+            cached = self._cache_get((strip_index, source_channel, frame))
+            if cached is None:
+                missing.append(frame)
+            else:
+                for position in positions[frame]:
+                    out[position] = _crop(cached, key_y, key_x)
+        if not missing:
+            return
+
+        source = self._source(strip_index)
+        for run_start, run_end in _frame_runs(missing, _MAX_RUN_FRAMES):
+            # chunked sources decompress whole chunks, so the rest of the chunk is cached on the way
+            if source.layout in ('container', 'bdv'):
+                chunk = source.chunk_frames
+                run_start = max(((self.skip_frames+run_start)//chunk)*chunk-self.skip_frames, 0)
+                run_end = min(-((-(self.skip_frames+run_end))//chunk)*chunk-self.skip_frames, strip_frames)
+            block = read_strip(source, run_start, run_end, skip_frames=self.skip_frames)[source_channel]
+            for frame in range(run_start, run_end):
+                # a copy, so the cache does not keep the whole block alive
+                decoded = block[frame-run_start].copy()
+                self._cache_put((strip_index, source_channel, frame), decoded)
+                for position in positions.get(frame, ()):
+                    out[position] = _crop(decoded, key_y, key_x)
+            del block
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any([k is Ellipsis for k in key]):
+            ellipsis = [i for i, k in enumerate(key) if k is Ellipsis][0]
+            key = key[:ellipsis] + (slice(None),)*(self.ndim-len(key)+1) + key[ellipsis+1:]
+        if len(key) > self.ndim:
+            raise IndexError('Too many indices for an array of '+str(self.ndim)+' dimensions.')
+        key = key + (slice(None),)*(self.ndim-len(key))
+
+        channels, drop_channel = _axis_indices(key[0], self.shape[0])
+        tiles, drop_tile = _axis_indices(key[1], self.shape[1])
+        frames, drop_frame = _axis_indices(key[2], self.shape[2])
+        key_y, key_x = key[3], key[4]
+        crop_shape = _crop(np.empty(self.shape[3:], dtype=self.dtype), key_y, key_x).shape
+
+        out = np.zeros((len(channels), len(tiles), len(frames))+crop_shape, dtype=self.dtype)
+        for i, channel in enumerate(channels):
+            for j, tile in enumerate(tiles):
+                entry = self._strips.get((channel, tile))
+                if entry is not None and frames:
+                    self._read_frames(entry[0], entry[1], frames, out[i, j], key_y, key_x)
+
+        return out[(0 if drop_channel else slice(None), 0 if drop_tile else slice(None), 0 if drop_frame else slice(None))]
+
+# save a maximum projection preview of one tile of an experiment
+def main(argv):
+
+    input_dir_string = ''
+    output_string = ''
+    channel = 0
+    tile = 0
+    first_frame = 0
+    last_frame = None
+    skip_frames = 0
+
+    try:
+        arguments, values = getopt.getopt(argv,"hi:c:t:f:s:o:",["help","ipath=","channel=","tile=","frames=","skip=","opath="])
+    except getopt.GetoptError:
+        print('Error. opm_array.py -i <inputdirectory> -c <channel index> -t <tile index> -f <first,last> -s <lead-in frames to skip> -o <preview.tif>')
+        sys.exit(2)
+    for current_argument, current_value in arguments:
+        if current_argument == '-h':
+            print('Usage. opm_array.py -i <inputdirectory> -c <channel index> -t <tile index> -f <first,last> -s <lead-in frames to skip> -o <preview.tif>')
+            print('       -f frames to project (default: all)')
+            print('       -o output TIFF (default: print the array shape only)')
+            sys.exit()
+        elif current_argument in ("-i", "--ipath"):
+            input_dir_string = current_value
+        elif current_argument in ("-c", "--channel"):
+            channel = int(current_value)
+        elif current_argument in ("-t", "--tile"):
+            tile = int(current_value)
+        elif current_argument in ("-f", "--frames"):
+            first_frame, last_frame = [int(value) for value in current_value.split(',')]
+        elif current_argument in ("-s", "--skip"):
+            skip_frames = int(current_value)
+        elif current_argument in ("-o", "--opath"):
+            output_string = current_value
+
+    if (input_dir_string == ''):
+        print('Input parse error.')
+        sys.exit(2)
+
+    data = AcquisitionArray(input_dir_string, skip_frames=skip_frames)
+    print(data)
+    if output_string == '':
+        return
+
+    # the projection is built a run of frames at a time, so previews of long strips fit in memory
+    last_frame = data.shape[2] if last_frame is None else min(last_frame, data.shape[2])
+    preview = np.zeros(data.shape[3:], dtype=data.dtype)
+    for start in range(first_frame, last_frame, _MAX_RUN_FRAMES):
+        np.maximum(preview, data[channel, tile, start:min(start+_MAX_RUN_FRAMES, last_frame)].max(axis=0, initial=0), out=preview)
+    tifffile.imwrite(output_string, preview)
+    print('Saved maximum projection of frames '+str(first_frame)+' to '+str(last_frame-1)+' to '+output_string+'.')
+
+
+# run
+if __name__ == "__main__":
+    main(sys.argv[1:])
+
+
+# The MIT License
+#
+# Copyright (c) 2020 Douglas Shepherd, Arizona State University
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
@@ -0,0 +1,743 @@
+#!/usr/bin/env python
+
+'''
+Raw data loading helpers for stage scanning OPM reconstruction.
+Frames are kept in the camera dtype (uint16) all the way into the deskew kernel.
+
+Single-frame TIFF directories are read by a pool of threads that decode every frame straight into its slot of one
+preallocated (frames, y, x) array. File reads and TIFF decoding release the GIL, so a few workers keep a local NVMe
+array busy, and more workers hide the per-file latency of network storage.
+
+Acquisition TIFFs are uncompressed and hold their pixels in one contiguous block. The byte offset of that block is
+parsed once per file and cached in a small index per directory, after which every frame is a single readinto straight
+into the stack buffer with no TIFF parsing or decoding. The index records the size and modification time of every file,
+and a file that no longer matches is decoded with tifffile and indexed again. Repeated reconstructions of the same data then run from the
+page cache at memory bandwidth. Compressed or fragmented files fall back to tifffile decoding.
+
+pycromanager NDTiff datasets are read from their NDTiff.index alone: the index gives the file and pixel offset of
+every frame, so a block of frames is read with a few large sequential reads per stack file instead of one
+Dataset.read_image call per frame.
+
+Strips can be packed once into a chunked single-file raw container (pack_strips.py), which open_strip prefers over
+the original frames. Views of the BDV H5 files written during acquisition (run_opm_mmcore.py) are read straight from
+their full resolution datasets. Reconstruction scripts read strips of an acquisition manifest with open_strip and
+read_strip, whatever they are stored in.
+'''
+
+# imports
+import numpy as np
+import os
+import time
+import hashlib
+import json
+import struct
+from pathlib import Path
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import tifffile
+import h5py
+from deskew_engine import DEFAULT_CACHE_DIR
+
+# default number of concurrent frame reads. Override with the OPM_READ_WORKERS environment variable,
+# e.g. 4-8 for local NVMe and 16-32 for network storage.
+DEFAULT_READ_WORKERS = int(os.environ.get('OPM_READ_WORKERS', min(8, os.cpu_count() or 1)))
+
+# frames handed to a worker at a time. Large enough to amortise the task overhead, small enough to balance the pool.
+_READ_CHUNK_FRAMES = 32
+
+# bump when the layout of the on-disk strip offset index changes
+TIFF_INDEX_VERSION = 2
+
+# names: file names in the directory
+# offsets: byte offset of the pixel data of each file, -1 if the file has to be decoded
+# nbytes: bytes of pixel data of each file
+# byteswap: True for big-endian files
+# sizes, mtimes: st_size and st_mtime_ns of each file when it was indexed
+# lookup: file name to position in the arrays above
+TiffIndex = namedtuple('TiffIndex', ['names', 'offsets', 'nbytes', 'byteswap', 'sizes', 'mtimes', 'lookup'])
+
+# strip offset indexes already loaded in this process, by directory
+_TIFF_INDEXES = {}
+
+def tiff_frame_shape(file):
+    '''shape and dtype of a single-frame TIFF from its header, without decoding the pixels.
+    Args:
+        file: TIFF file path
+    Returns:
+        (shape, dtype) of the frame
+    '''
+    with tifffile.TiffFile(str(file)) as tif:
+        page = tif.pages[0]
+        return tuple(page.shape), page.dtype
+
+# byte offset, size, and byte order of the pixel data of one TIFF. Offset is -1 unless the file is a single
+# uncompressed page whose pixels are one contiguous block that can be copied as-is.
+def _tiff_pixel_block(file):
+    with tifffile.TiffFile(str(file)) as tif:
+        page = tif.pages[0]
+        nbytes = int(np.prod(page.shape))*page.dtype.itemsize
+        raw = (len(tif.pages) == 1 and page.compression == 1 and page.is_contiguous and page.is_final and
+               int(sum(page.databytecounts)) == nbytes)
+        return (int(page.dataoffsets[0]) if raw else -1), nbytes, tif.byteorder == '>'
+
+def _tiff_index_path(directory, cache_dir):
+    key = hashlib.sha1(str(Path(directory).resolve()).encode()).hexdigest()[:16]
+    return Path(cache_dir) / 'tiff_index' / ('tiff_index_v'+str(TIFF_INDEX_VERSION)+'_'+key+'.npz')
+
+def tiff_strip_index(files, cache_dir=None, num_workers=None):
+    '''pixel data offsets of single-frame TIFFs, parsed once and cached on disk per directory.
+    Files not yet in the index of their directory are parsed and added, so a strip that is still being acquired,
+    or read block by block, is indexed incrementally. Files whose size or modification time changed since they were
+    indexed are parsed again.
+    Args:
+        files: TIFF file paths, all in the same directory
+        cache_dir: directory of the on-disk indexes. DEFAULT_CACHE_DIR if not provided.
+        num_workers: number of concurrent header reads. DEFAULT_READ_WORKERS if not provided.
+    Returns:
+        TiffIndex of the directory
+    '''
+    if cache_dir is None:
+        cache_dir = DEFAULT_CACHE_DIR
+    if num_workers is None:
+        num_workers = DEFAULT_READ_WORKERS
+    directory = Path(files[0]).parent
+    index_path = _tiff_index_path(directory, cache_dir)
+
+    index = _TIFF_INDEXES.get(index_path)
+    if index is None and index_path.exists():
+        try:
+            with np.load(index_path) as cached:
+                names = [str(name) for name in cached['names']]
+                index = TiffIndex(names, cached['offsets'], cached['nbytes'], cached['byteswap'], cached['sizes'],
+                                  cached['mtimes'], {name: i for i, name in enumerate(names)})
+        except (OSError, ValueError, KeyError):
+            index = None
+
+    with ThreadPoolExecutor(max_workers=max(int(num_workers), 1)) as pool:
+        # files not in the index yet, or changed since they were indexed. The stat is taken before the header is
+        # parsed, so a file still being written while it is parsed does not match on the next call.
+        stats = list(pool.map(os.stat, files))
+        missing = []
+        for file, stat in zip(files, stats):
+            position = None if index is None else index.lookup.get(Path(file).name)
+            if (position is None or int(index.sizes[position]) != stat.st_size or
+                    int(index.mtimes[position]) != stat.st_mtime_ns):
+                missing.append((file, stat))
+        if missing:
+            blocks = list(pool.map(_tiff_pixel_block, [file for file, stat in missing]))
+
+    if missing:
+        entries = {} if index is None else {name: (index.offsets[i], index.nbytes[i], index.byteswap[i], index.sizes[i], index.mtimes[i])
+                                            for i, name in enumerate(index.names)}
+        for (file, stat), block in zip(missing, blocks):
+            entries[Path(file).name] = block + (stat.st_size, stat.st_mtime_ns)
+        names = list(entries)
+        offsets = np.array([entries[name][0] for name in names], dtype=np.int64)
+        nbytes = np.array([entries[name][1] for name in names], dtype=np.int64)
+        byteswap = np.array([entries[name][2] for name in names], dtype=bool)
+        sizes = np.array([entries[name][3] for name in names], dtype=np.int64)
+        mtimes = np.array([entries[name][4] for name in names], dtype=np.int64)
+        index = TiffIndex(names, offsets, nbytes, byteswap, sizes, mtimes, {name: i for i, name in enumerate(names)})
+
+        # write to a temporary file and rename so readers never see a partial index
+        try:
+            index_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = index_path.with_suffix('.tmp'+str(os.getpid())+'.npz')
+            np.savez(tmp_path, names=np.array(names), offsets=offsets, nbytes=nbytes, byteswap=byteswap, sizes=sizes, mtimes=mtimes)
+            os.replace(tmp_path, index_path)
+        except OSError:
+            pass
+
+    _TIFF_INDEXES[index_path] = index
+    return index
+
+# read files[start:end] into out[start:end], copying indexed pixel blocks with readinto and decoding the rest.
+# A file whose size or modification time no longer matches its index entry is decoded. Returns the number of bytes read.
+def _read_tiff_range(files, out, start, end, indexes):
+    for i in range(start, end):
+        name = Path(files[i]).name
+        index = indexes[i]
+        position = None if index is None else index.lookup.get(name)
+        if (position is not None and index.offsets[position] >= 0 and index.nbytes[position] == out[i].nbytes and
+                out[i].flags.c_contiguous):
+            with open(files[i], 'rb', buffering=0) as fh:
+                stat = os.fstat(fh.fileno())
+                copied = 0
+                if stat.st_size == int(index.sizes[position]) and stat.st_mtime_ns == int(index.mtimes[position]):
+                    fh.seek(int(index.offsets[position]))
+                    copied = fh.readinto(memoryview(out[i]).cast('B'))
+            if copied == out[i].nbytes:
+                if index.byteswap[position]:
+                    out[i].byteswap(inplace=True)
+                continue
+        # file is not indexed, not a raw pixel block, or changed since it was indexed
+        tifffile.imread(str(files[i]), out=out[i])
+    return out[start:end].nbytes
+
+def read_tiff_stack(files, num_workers=None, out=None, report=False, use_index=True, cache_dir=None):
+    '''read single-frame TIFF files into one (frames, y, x) stack in the camera dtype.
+    Args:
+        files: ordered list of TIFF file paths
+        num_workers: number of concurrent frame reads. DEFAULT_READ_WORKERS if not provided. 1 reads serially.
+        out: preallocated (len(files), y, x) array to decode into. Allocated from the first frame header if not provided.
+        report: print the number of frames, MB read, and MB/s when done
+        use_index: copy uncompressed pixel data with readinto from the cached strip offset index instead of decoding
+        cache_dir: directory of the on-disk strip offset indexes. DEFAULT_CACHE_DIR if not provided.
+    Returns:
+        stack with the dtype of the first frame (uint16 for our cameras)
+    '''
+    if num_workers is None:
+        num_workers = DEFAULT_READ_WORKERS
+    num_workers = max(int(num_workers), 1)
+
+    # size the stack from the first frame header, every frame is decoded straight into its slot
+    if out is None:
+        frame_shape, frame_dtype = tiff_frame_shape(files[0])
+        out = np.empty((len(files),)+frame_shape, dtype=frame_dtype)
+    elif out.shape[0] != len(files):
+        raise ValueError('Output stack holds '+str(out.shape[0])+' frames, but '+str(len(files))+' files were given.')
+
+    start_time = time.perf_counter()
+
+    # strip offset index of every directory the files come from
+    indexes = [None]*len(files)
+    if use_index:
+        directories = {}
+        for i, file in enumerate(files):
+            directories.setdefault(Path(file).parent, []).append(i)
+        for directory_files in directories.values():
+            index = tiff_strip_index([files[i] for i in directory_files], cache_dir=cache_dir, num_workers=num_workers)
+            for i in directory_files:
+                indexes[i] = index
+
+    chunks = [(start, min(start+_READ_CHUNK_FRAMES, len(files))) for start in range(0, len(files), _READ_CHUNK_FRAMES)]
+    if num_workers == 1 or len(chunks) == 1:
+        nbytes = sum([_read_tiff_range(files, out, start, end, indexes) for start, end in chunks])
+    else:
+        with ThreadPoolExecutor(max_workers=min(num_workers, len(chunks))) as pool:
+            futures = [pool.submit(_read_tiff_range, files, out, start, end, indexes) for start, end in chunks]
+            # result() re-raises the first read error in the caller
+            nbytes = sum([future.result() for future in futures])
+    elapsed = time.perf_counter() - start_time
+
+    if report:
+        print('Read {} frames, {:.0f} MB in {:.2f} s ({:.0f} MB/s, {} workers).'.format(
+              len(files), nbytes/1e6, elapsed, nbytes/1e6/max(elapsed, 1e-9), num_workers))
+
+    return out
+
+
+# NDTiff pixel type codes to numpy dtypes. 10 to 14 bit cameras are stored in 16 bit words.
+_NDTIFF_PIXEL_TYPES = {0: np.uint8, 1: np.uint16, 3: np.uint16, 4: np.uint16, 5: np.uint16, 6: np.uint16}
+
+# largest single read from an NDTiff stack file, and largest gap (per-frame TIFF tags and metadata) read through
+# rather than seeked over between the pixels of consecutive frames
+_NDTIFF_READ_BYTES = 64*1024*1024
+_NDTIFF_MAX_GAP = 1024*1024
+
+# directory: folder holding NDTiff.index and the stack files
+# files: stack file name of every (channel, frame), shape (num_channels, num_frames)
+# offsets: byte offset of the pixels of every (channel, frame), -1 where the frame is missing from the index
+# byteswap: stack file name to True for big-endian files
+# channels: channel axis values, in channel index order
+# frame_shape: camera frame shape (ny, nx)
+# dtype: pixel dtype
+NDTiffStrip = namedtuple('NDTiffStrip', ['directory', 'files', 'offsets', 'byteswap', 'channels', 'frame_shape', 'dtype'])
+
+def read_ndtiff_index(dataset_dir):
+    '''entries of the NDTiff.index of a pycromanager dataset, without opening any image file.
+    An entry cut short by an acquisition that is still running is ignored.
+    Args:
+        dataset_dir: dataset directory, holding NDTiff.index directly or in its 'Full resolution' folder
+    Returns:
+        (directory of the stack files, list of (axes, file name, pixel offset, width, height, pixel type, compression))
+    '''
+    directory = None
+    for candidate in (Path(dataset_dir), Path(dataset_dir) / 'Full resolution'):
+        if (candidate / 'NDTiff.index').exists():
+            directory = candidate
+            break
+    if directory is None:
+        raise FileNotFoundError('No NDTiff.index in '+str(dataset_dir)+'.')
+
+    with open(directory / 'NDTiff.index', 'rb') as index_file:
+        data = index_file.read()
+
+    # every entry is: axes JSON length and string, file name length and string, then eight uint32 (pixel offset,
+    # width, height, pixel type, pixel compression, metadata offset, metadata length, metadata compression)
+    entries = []
+    position = 0
+    try:
+        while position < len(data):
+            axes_length = struct.unpack_from('<I', data, position)[0]
+            axes = json.loads(data[position+4:position+4+axes_length].decode('utf-8'))
+            position = position + 4 + axes_length
+            name_length = struct.unpack_from('<I', data, position)[0]
+            name = data[position+4:position+4+name_length].decode('utf-8')
+            position = position + 4 + name_length
+            pixel_offset, width, height, pixel_type, compression = struct.unpack_from('<5I', data, position)
+            position = position + 32
+            entries.append((axes, name, pixel_offset, width, height, pixel_type, compression))
+    except (struct.error, ValueError):
+        pass
+
+    return directory, entries
+
+def open_ndtiff_strip(dataset_dir, scan_axis='x', channel_axis='channel', axes=None):
+    '''file and pixel offset of every frame of a stage scan in an NDTiff dataset, sized from the dataset's own index.
+    Args:
+        dataset_dir: pycromanager dataset directory
+        scan_axis: axis that counts the frames of the stage scan
+        channel_axis: axis of the channels
+        axes: values of the other axes to select, e.g. {'y': 0, 'z': 0}. Axes missing from an entry count as 0.
+    Returns:
+        NDTiffStrip
+    '''
+    directory, entries = read_ndtiff_index(dataset_dir)
+    if axes is None:
+        axes = {}
+    entries = [entry for entry in entries if all([entry[0].get(key, 0) == value for key, value in axes.items()])]
+    if not entries:
+        raise ValueError('No frames with axes '+str(axes)+' in '+str(dataset_dir)+'.')
+
+    # channels in index order (integers) or in acquisition order (names)
+    channels = []
+    for entry in entries:
+        channel = entry[0].get(channel_axis, 0)
+        if channel not in channels:
+            channels.append(channel)
+    if all([isinstance(channel, int) for channel in channels]):
+        channels = sorted(channels)
+    channel_lookup = {channel: i for i, channel in enumerate(channels)}
+
+    width, height, pixel_type, compression = entries[0][3:7]
+    if compression != 0 or pixel_type not in _NDTIFF_PIXEL_TYPES:
+        raise ValueError('Unsupported NDTiff pixel type '+str(pixel_type)+' or compression '+str(compression)+'.')
+    if any([entry[3:7] != (width, height, pixel_type, compression) for entry in entries]):
+        raise ValueError('Frames of different size or pixel type in '+str(dataset_dir)+'.')
+
+    num_frames = max([int(entry[0].get(scan_axis, 0)) for entry in entries]) + 1
+    files = np.full((len(channels), num_frames), '', dtype=object)
+    offsets = np.full((len(channels), num_frames), -1, dtype=np.int64)
+    for entry_axes, name, pixel_offset, _, _, _, _ in entries:
+        channel_id = channel_lookup[entry_axes.get(channel_axis, 0)]
+        frame = int(entry_axes.get(scan_axis, 0))
+        files[channel_id, frame] = name
+        offsets[channel_id, frame] = pixel_offset
+
+    # byte order from the TIFF header of every stack file
+    byteswap = {}
+    for name in set(files[offsets >= 0]):
+        with open(directory / name, 'rb') as stack_file:
+            byteswap[name] = stack_file.read(2) == b'MM'
+
+    return NDTiffStrip(directory, files, offsets, byteswap, channels, (int(height), int(width)), np.dtype(_NDTIFF_PIXEL_TYPES[pixel_type]))
+
+def read_ndtiff_stack(strip, start=0, end=None, skip_frames=0, out=None, report=False):
+    '''read a block of frames of every channel of an NDTiff strip into one (channels, frames, y, x) stack.
+    Frames are sorted by stack file and offset, and runs of neighbouring frames are read with single sequential
+    reads of up to 64 MB, the per-frame tags and metadata in between included.
+    Args:
+        strip: NDTiffStrip from open_ndtiff_strip
+        start: first frame of the block, counted after the skipped frames
+        end: frame after the last one of the block. Up to the end of the scan if not provided.
+        skip_frames: lead-in frames at the start of the scan (stage speed up) that are not part of the strip
+        out: preallocated (channels, end-start, y, x) array to read into. Allocated if not provided.
+        report: print the number of frames, MB read, and MB/s when done
+    Returns:
+        stack in the camera dtype
+    '''
+    num_channels = strip.offsets.shape[0]
+    if end is None:
+        end = strip.offsets.shape[1] - skip_frames
+    offsets = strip.offsets[:, skip_frames+start:skip_frames+end]
+    files = strip.files[:, skip_frames+start:skip_frames+end]
+    if offsets.shape[1] != end-start or np.any(offsets < 0):
+        raise ValueError('Frames '+str(skip_frames+start)+' to '+str(skip_frames+end-1)+' are not all in the NDTiff index.')
+    if out is None:
+        out = np.empty((num_channels, end-start)+strip.frame_shape, dtype=strip.dtype)
+    frame_bytes = int(np.prod(strip.frame_shape))*strip.dtype.itemsize
+
+    # group the frames into runs that are read in one go
+    order = sorted([(files[c, f], int(offsets[c, f]), c, f) for c in range(num_channels) for f in range(end-start)])
+    runs = []
+    for name, offset, c, f in order:
+        if runs and runs[-1][0] == name and offset - runs[-1][2] <= _NDTIFF_MAX_GAP and \
+                offset + frame_bytes - runs[-1][1] <= _NDTIFF_READ_BYTES:
+            runs[-1][2] = offset + frame_bytes
+            runs[-1][3].append((offset, c, f))
+        else:
+            runs.append([name, offset, offset + frame_bytes, [(offset, c, f)]])
+
+    start_time = time.perf_counter()
+    nbytes = 0
+    scratch = bytearray(max([run[2] - run[1] for run in runs]))
+    stack_file = None
+    open_name = None
+    try:
+        for name, run_start, run_end, frames in runs:
+            if name != open_name:
+                if stack_file is not None:
+                    stack_file.close()
+                stack_file = open(strip.directory / name, 'rb', buffering=0)
+                open_name = name
+            stack_file.seek(run_start)
+            view = memoryview(scratch)[:run_end-run_start]
+            if stack_file.readinto(view) != run_end-run_start:
+                raise IOError('NDTiff stack file '+name+' ends before frame data at offset '+str(run_start)+'.')
+            dtype = strip.dtype.newbyteorder('>') if strip.byteswap[name] else strip.dtype
+            for offset, c, f in frames:
+                out[c, f] = np.frombuffer(scratch, dtype=dtype, count=frame_bytes//strip.dtype.itemsize,
+                                          offset=offset-run_start).reshape(strip.frame_shape)
+            nbytes = nbytes + run_end - run_start
+            del view
+    finally:
+        if stack_file is not None:
+            stack_file.close()
+    elapsed = time.perf_counter() - start_time
+
+    if report:
+        print('Read {} frames x {} channels, {:.0f} MB in {:.2f} s ({:.0f} MB/s, {} reads).'.format(
+              end-start, num_channels, nbytes/1e6, elapsed, nbytes/1e6/max(elapsed, 1e-9), len(runs)))
+
+    return out
+
+
+# raw strip containers. One HDF5 file per strip with a (channels, frames, y, x) 'data' dataset in the camera dtype,
+# chunked along the frames with one chunk per channel per window of frames. A block of frames is then a few large
+# chunk reads from one open file instead of one open, stat, and close per frame.
+RAW_CONTAINER_SUFFIX = '.raw.h5'
+
+# lossless filters of the container. zstd needs the hdf5plugin package, here and wherever the container is read.
+RAW_COMPRESSIONS = ('none', 'lzf', 'gzip', 'zstd')
+
+# HDF5 chunk cache of an open container. Holds a few chunks, so frame-by-frame reads decompress every chunk once.
+_RAW_CHUNK_CACHE_BYTES = 256*1024*1024
+
+# path: container file
+# num_channels, num_frames: size of the strip
+# frame_shape: camera frame shape (ny, nx)
+# dtype: pixel dtype
+# chunk_frames: frames per chunk
+# channels: channel IDs or names of the source, in channel index order
+RawContainer = namedtuple('RawContainer', ['path', 'num_channels', 'num_frames', 'frame_shape', 'dtype', 'chunk_frames', 'channels'])
+
+# h5py.File.create_dataset filter arguments of a compression
+def _raw_filters(compression):
+    if compression is None or compression == 'none':
+        return {}
+    if compression == 'lzf':
+        return {'compression': 'lzf', 'shuffle': True}
+    if compression == 'gzip':
+        return {'compression': 'gzip', 'compression_opts': 1, 'shuffle': True}
+    if compression == 'zstd':
+        import hdf5plugin
+        return dict(hdf5plugin.Zstd(clevel=1), shuffle=True)
+    raise ValueError('Unknown container compression '+repr(compression)+'. Use one of '+', '.join(RAW_COMPRESSIONS)+'.')
+
+def write_raw_container(path, blocks, num_channels, num_frames, frame_shape, dtype=np.uint16, chunk_frames=64,
+                        compression=None, channels=None):
+    '''pack the frames of one strip into a chunked raw container.
+    The file is written under a temporary name and renamed when complete, so readers never see a partial container.
+    Args:
+        path: container file
+        blocks: iterable of (first frame, (channels, frames, y, x) block), together covering every frame
+        num_channels, num_frames: size of the strip
+        frame_shape: camera frame shape (ny, nx)
+        dtype: pixel dtype
+        chunk_frames: frames per chunk. Blocks that start and end on chunk boundaries are written without re-chunking.
+        compression: one of RAW_COMPRESSIONS, or None
+        channels: channel IDs or names to record, or None
+    Returns:
+        RawContainer
+    '''
+    path = Path(path)
+    chunk_frames = int(min(max(chunk_frames, 1), num_frames))
+    tmp_path = path.with_name(path.name+'.tmp'+str(os.getpid()))
+    try:
+        with h5py.File(tmp_path, 'w') as container:
+            data = container.create_dataset('data', shape=(num_channels, num_frames)+tuple(frame_shape), dtype=dtype,
+                                            chunks=(1, chunk_frames)+tuple(frame_shape), **_raw_filters(compression))
+            if channels is not None:
+                data.attrs['channels'] = json.dumps(list(channels))
+            written = 0
+            for start, block in blocks:
+                data[:, start:start+block.shape[1]] = block
+                written = written + block.shape[1]
+            if written != num_frames:
+                raise ValueError('Wrote '+str(written)+' of '+str(num_frames)+' frames to '+str(path)+'.')
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+    return open_raw_container(path)
+
+def open_raw_container(path):
+    '''size, pixel type, and chunking of a raw container, from its header.'''
+    with h5py.File(path, 'r') as container:
+        data = container['data']
+        channels = json.loads(data.attrs['channels']) if 'channels' in data.attrs else list(range(data.shape[0]))
+        return RawContainer(Path(path), int(data.shape[0]), int(data.shape[1]), tuple([int(size) for size in data.shape[2:]]),
+                            np.dtype(data.dtype), int(data.chunks[1]), channels)
+
+def read_raw_container(container, start=0, end=None, skip_frames=0, out=None, report=False):
+    '''read a block of frames of every channel of a raw container into one (channels, frames, y, x) stack.
+    Args:
+        container: RawContainer from open_raw_container
+        start: first frame of the block, counted after the skipped frames
+        end: frame after the last one of the block. Up to the end of the strip if not provided.
+        skip_frames: lead-in frames at the start of the scan (stage speed up) that are not part of the strip
+        out: preallocated (channels, end-start, y, x) array to read into. Allocated if not provided.
+        report: print the number of frames, MB read, and MB/s when done
+    Returns:
+        stack in the camera dtype
+    '''
+    if end is None:
+        end = container.num_frames - skip_frames
+    if skip_frames+end > container.num_frames:
+        raise ValueError('Frames '+str(skip_frames+start)+' to '+str(skip_frames+end-1)+' are not all in '+str(container.path)+'.')
+    if out is None:
+        out = np.empty((container.num_channels, end-start)+container.frame_shape, dtype=container.dtype)
+
+    start_time = time.perf_counter()
+    with h5py.File(container.path, 'r', rdcc_nbytes=_RAW_CHUNK_CACHE_BYTES) as raw:
+        raw['data'].read_direct(out, source_sel=np.s_[:, skip_frames+start:skip_frames+end])
+    elapsed = time.perf_counter() - start_time
+
+    if report:
+        print('Read {} frames x {} channels, {:.0f} MB in {:.2f} s ({:.0f} MB/s, container).'.format(
+              end-start, container.num_channels, out.nbytes/1e6, elapsed, out.nbytes/1e6/max(elapsed, 1e-9)))
+
+    return out
+
+
+# BDV H5 files written by npy2bdv (run_opm_mmcore.py). Every view is one setup of the file, and its full resolution
+# frames are one dataset, stored as int16 whatever the camera dtype. The setups are listed in the XML next to the file.
+_BDV_DATASET = 't00000/s{:02d}/0/cells'
+
+# path: H5 file
+# dataset: full resolution dataset of the view
+# num_frames, frame_shape: size of the view (frames, (ny, nx))
+# dtype: pixel dtype of the stored data, as read back
+# chunk_frames: frames per chunk of the dataset
+BdvView = namedtuple('BdvView', ['path', 'dataset', 'num_frames', 'frame_shape', 'dtype', 'chunk_frames'])
+
+def bdv_view_setups(xml_path):
+    '''view setups of a BDV XML file.
+    Returns:
+        list of (setup id, channel index, tile index, (frames, ny, nx))
+    '''
+    import xml.etree.ElementTree as ElementTree
+
+    setups = []
+    for setup in ElementTree.parse(xml_path).getroot().iter('ViewSetup'):
+        attributes = setup.find('attributes')
+        # npy2bdv sizes are x y z, with the scan (frames) along z
+        nx, ny, nz = [int(size) for size in setup.find('size').text.split()]
+        setups.append((int(setup.find('id').text), int(attributes.find('channel').text), int(attributes.find('tile').text),
+                       (nz, ny, nx)))
+    return setups
+
+def open_bdv_view(h5_path, channel, tile):
+    '''find the full resolution frames of one view of a BDV H5 file.
+    Args:
+        h5_path: BDV H5 file. Its XML must have been written.
+        channel, tile: channel and tile index of the view in the file
+    Returns:
+        BdvView
+    '''
+    h5_path = Path(h5_path)
+    xml_path = h5_path.with_suffix('.xml')
+    if not xml_path.exists():
+        raise ValueError('No BDV XML next to '+str(h5_path)+'. The file is still being written, or was not closed.')
+    for setup_id, setup_channel, setup_tile, size in bdv_view_setups(xml_path):
+        if setup_channel == channel and setup_tile == tile:
+            break
+    else:
+        raise ValueError('No view of channel '+str(channel)+', tile '+str(tile)+' in '+str(xml_path)+'.')
+    dataset = _BDV_DATASET.format(setup_id)
+    with h5py.File(h5_path, 'r') as bdv:
+        data = bdv[dataset]
+        # npy2bdv stores uint16 camera frames bit for bit as int16
+        dtype = np.dtype(np.uint16) if data.dtype == np.int16 else np.dtype(data.dtype)
+        chunk_frames = _READ_CHUNK_FRAMES if data.chunks is None else int(data.chunks[0])
+        return BdvView(h5_path, dataset, int(data.shape[0]), tuple([int(n) for n in data.shape[1:]]), dtype, chunk_frames)
+
+def read_bdv_view(view, start=0, end=None, skip_frames=0, out=None, report=False):
+    '''read a block of frames of one BDV view into a (1, frames, y, x) stack, as read_raw_container.'''
+    if end is None:
+        end = view.num_frames - skip_frames
+    if skip_frames+end > view.num_frames:
+        raise ValueError('Frames '+str(skip_frames+start)+' to '+str(skip_frames+end-1)+' are not all in '+str(view.path)+'.')
+    if out is None:
+        out = np.empty((1, end-start)+view.frame_shape, dtype=view.dtype)
+
+    start_time = time.perf_counter()
+    with h5py.File(view.path, 'r', rdcc_nbytes=_RAW_CHUNK_CACHE_BYTES) as bdv:
+        data = bdv[view.dataset]
+        target = out.view(data.dtype) if data.dtype.itemsize == out.dtype.itemsize else out
+        data.read_direct(target[0], source_sel=np.s_[skip_frames+start:skip_frames+end])
+    elapsed = time.perf_counter() - start_time
+
+    if report:
+        print('Read {} frames, {:.0f} MB in {:.2f} s ({:.0f} MB/s, BDV).'.format(
+              end-start, out.nbytes/1e6, elapsed, out.nbytes/1e6/max(elapsed, 1e-9)))
+
+    return out
+
+
+# one strip of an acquisition manifest, ready to read
+# layout: 'container', 'tiff', 'ndtiff', or 'bdv'
+# source: RawContainer, frame file paths, NDTiffStrip, or BdvView
+# num_channels, num_frames: size of the strip, lead-in frames included
+# frame_shape, dtype: camera frame shape (ny, nx) and pixel dtype
+# chunk_frames: frames read at a time when streaming the strip
+StripSource = namedtuple('StripSource', ['layout', 'source', 'num_channels', 'num_frames', 'frame_shape', 'dtype', 'chunk_frames'])
+
+def open_strip(experiment_dir, strip):
+    '''open one strip of an acquisition manifest for reading, from its packed raw container if it has one.
+    Args:
+        experiment_dir: experiment directory
+        strip: strip dict of the manifest
+    Returns:
+        StripSource
+    '''
+    from opm_manifest import strip_files
+
+    experiment_dir = Path(experiment_dir)
+    if strip.get('container') is not None and (experiment_dir / strip['container']).exists():
+        container = open_raw_container(experiment_dir / strip['container'])
+        return StripSource('container', container, container.num_channels, container.num_frames, container.frame_shape,
+                           container.dtype, container.chunk_frames)
+    if 'files' in strip:
+        files = strip_files(experiment_dir, strip)
+        frame_shape, frame_dtype = tiff_frame_shape(files[0])
+        return StripSource('tiff', files, 1, len(files), frame_shape, np.dtype(frame_dtype), _READ_CHUNK_FRAMES)
+    strip_dir = experiment_dir / strip['path']
+    if (strip_dir / 'NDTiff.index').exists() or (strip_dir / 'Full resolution' / 'NDTiff.index').exists():
+        ndtiff_strip = open_ndtiff_strip(strip_dir, axes={'y': 0, 'z': 0})
+        return StripSource('ndtiff', ndtiff_strip, len(ndtiff_strip.channels), ndtiff_strip.offsets.shape[1],
+                           ndtiff_strip.frame_shape, ndtiff_strip.dtype, _READ_CHUNK_FRAMES)
+    if strip.get('view') is not None:
+        bdv_view = open_bdv_view(experiment_dir / strip['path'], *strip['view'])
+        return StripSource('bdv', bdv_view, 1, bdv_view.num_frames, bdv_view.frame_shape, bdv_view.dtype, bdv_view.chunk_frames)
+    raise ValueError('No raw frames to read for strip '+str(strip['path'])+'.')
+
+def read_strip(source, start=0, end=None, skip_frames=0, reverse=False, out=None, report=False, num_workers=None):
+    '''read a block of frames of every channel of a strip into one (channels, frames, y, x) stack.
+    Args:
+        source: StripSource from open_strip
+        start: first frame of the block, counted after the skipped frames
+        end: frame after the last one of the block. Up to the end of the strip if not provided.
+        skip_frames: lead-in frames at the start of the scan (stage speed up) that are not part of the strip
+        reverse: count frames from the end of the strip, and return them in reverse scan order
+        out: preallocated (channels, end-start, y, x) array to read into. Allocated if not provided.
+        report: print the number of frames, MB read, and MB/s when done
+        num_workers: number of concurrent frame reads of TIFF strips. DEFAULT_READ_WORKERS if not provided.
+    Returns:
+        stack in the camera dtype
+    '''
+    num_frames = source.num_frames - skip_frames
+    if end is None:
+        end = num_frames
+    if reverse:
+        start, end = num_frames-end, num_frames-start
+    if out is None:
+        out = np.empty((source.num_channels, end-start)+tuple(source.frame_shape), dtype=source.dtype)
+
+    if source.layout == 'container':
+        read_raw_container(source.source, start, end, skip_frames=skip_frames, out=out, report=report)
+    elif source.layout == 'ndtiff':
+        read_ndtiff_stack(source.source, start, end, skip_frames=skip_frames, out=out, report=report)
+    elif source.layout == 'bdv':
+        read_bdv_view(source.source, start, end, skip_frames=skip_frames, out=out, report=report)
+    else:
+        files = source.source[skip_frames+start:skip_frames+end]
+        read_tiff_stack(files[::-1] if reverse else files, num_workers=num_workers, out=out[0], report=report)
+        return out
+
+    if reverse:
+        out[:] = out[:, ::-1]
+    return out
+
+def read_strip_region(source, start, end, rows=None, cols=None, channel=None):
+    '''read a block of frames of a strip cropped to camera rows and columns, e.g. the raw frames under a deskew ROI.
+    Packed containers and BDV views read only the requested rows and columns from their chunked datasets, in one read
+    from one open file. TIFF and NDTiff frames are read a chunk at a time and cropped.
+    Args:
+        source: StripSource from open_strip
+        start: first frame of the block
+        end: frame after the last one of the block
+        rows: (first, end) camera rows. All rows if not provided.
+        cols: (first, end) camera columns. All columns if not provided.
+        channel: channel index of the source to read. All channels if not provided.
+    Returns:
+        (channels, frames, rows, cols) stack in the camera dtype
+    '''
+    row_sel = slice(None) if rows is None else slice(*rows)
+    col_sel = slice(None) if cols is None else slice(*cols)
+    channel_sel = slice(None) if channel is None else slice(channel, channel+1)
+
+    if source.layout == 'container':
+        with h5py.File(source.source.path, 'r', rdcc_nbytes=_RAW_CHUNK_CACHE_BYTES) as raw:
+            return raw['data'][channel_sel, start:end, row_sel, col_sel]
+    if source.layout == 'bdv':
+        with h5py.File(source.source.path, 'r', rdcc_nbytes=_RAW_CHUNK_CACHE_BYTES) as bdv:
+            block = bdv[source.source.dataset][start:end, row_sel, col_sel]
+        # int16 as stored by npy2bdv, read back as the camera dtype like read_bdv_view
+        return block.view(source.dtype)[np.newaxis] if block.dtype.itemsize == source.dtype.itemsize else block.astype(source.dtype)[np.newaxis]
+
+    out = None
+    for chunk_start in range(start, end, source.chunk_frames):
+        chunk_end = min(chunk_start+source.chunk_frames, end)
+        chunk = read_strip(source, chunk_start, chunk_end)[channel_sel, :, row_sel, col_sel]
+        if out is None:
+            out = np.empty((chunk.shape[0], end-start)+chunk.shape[2:], dtype=chunk.dtype)
+        out[:, chunk_start-start:chunk_end-start] = chunk
+        del chunk
+    return out
+
+def iter_strip_frames(sources, start=0, end=None, skip_frames=0, chunk_frames=None, num_workers=None):
+    '''frames of one or more strips of the same scan, read a chunk at a time.
+    Args:
+        sources: StripSource of every strip, e.g. one per channel. Their channels are stacked in this order.
+        start, end, skip_frames: frames to read, as in read_strip
+        chunk_frames: frames read at a time. The largest chunk of the sources if not provided.
+        num_workers: number of concurrent frame reads of TIFF strips
+    Yields:
+        (channels, y, x) frames in scan order
+    '''
+    if end is None:
+        end = min([source.num_frames for source in sources]) - skip_frames
+    if chunk_frames is None:
+        chunk_frames = max([source.chunk_frames for source in sources])
+    for chunk_start in range(start, end, chunk_frames):
+        chunk_end = min(chunk_start+chunk_frames, end)
+        blocks = [read_strip(source, chunk_start, chunk_end, skip_frames=skip_frames, num_workers=num_workers) for source in sources]
+        block = blocks[0] if len(blocks) == 1 else np.concatenate(blocks)
+        del blocks
+        for i in range(chunk_end-chunk_start):
+            yield block[:, i]
+
+
+# The MIT License
+#
+# Copyright (c) 2020 Douglas Shepherd, Arizona State University
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
@@ -0,0 +1,436 @@
+#!/usr/bin/env python
+
+'''
+Acquisition manifest for stage scanning OPM experiments.
+
+One small JSON file in the experiment directory lists every strip of the experiment: the directory or file it is
+stored in, its channel, tile (y) and height (z) position, number of frames, stage position, and the names of its
+frame files. Geometry parameters, camera frame shape, and pixel type are stored once for the experiment.
+
+The acquisition scripts write the manifest as they go. For older data, build_manifest walks the experiment directory
+once, parses channel and tile IDs from the directory names, and saves the result, so every later reconstruction
+starts from a single small file read instead of globbing, sorting, and parsing thousands of paths.
+
+Every load checks the strips and frame counts of the manifest against the experiment directory, so an index built
+while an acquisition was still writing, or before strips were added or removed, is never used as is. Manifests
+built by build_manifest are rebuilt, manifests written by the acquisition raise an error instead.
+
+Frame files are numbered, so the names of a strip are stored as a format pattern and a first index whenever they
+follow one. A strip of 100k frames then takes the same space in the manifest as a strip of ten.
+
+pack_strips.py records the chunked raw container of every strip it packs under the strip's 'container' key, and
+opm_io.open_strip reads from it instead of the original frames.
+
+Run as a script to (re)build the manifest of an existing experiment:
+    python opm_manifest.py -i <inputdirectory> [-p <theta,stage step nm,pixel size nm>] [-r]
+'''
+
+# imports
+import numpy as np
+import os
+import sys
+import getopt
+import json
+import re
+from pathlib import Path
+from natsort import natsorted, ns
+
+# file name of the manifest in the experiment directory
+MANIFEST_NAME = 'acquisition_manifest.json'
+
+# bump when the layout of the manifest changes. Older manifests are rebuilt.
+MANIFEST_VERSION = 1
+
+# storage layouts of the raw data
+#   tiff: one directory of single-frame TIFFs per channel and tile (QI2lab MM script, ch<c>_y<t> directories)
+#   ndtiff: one pycromanager dataset per tile and height, holding all channels (<name>_y<t>_z<h> directories)
+#   bdv: one BDV H5 file per tile, with heights as views and channels as channels (run_opm_mmcore.py)
+MANIFEST_LAYOUTS = ('tiff', 'ndtiff', 'bdv')
+
+def new_manifest(layout, params=None, channels=(), channel_names=None, frame_shape=None, dtype=None):
+    '''empty manifest of an experiment, to add strips to as they are acquired.
+    Args:
+        layout: one of MANIFEST_LAYOUTS
+        params: [theta, stage move distance, camera pixel size] in [degrees, nm, nm], or None if not known
+        channels: acquisition channel IDs, e.g. the laser index or the ch<c> number of the directories
+        channel_names: name of every channel, e.g. the Coherent-State config, or None
+        frame_shape: camera frame shape (ny, nx), or None if not known
+        dtype: camera pixel type, or None if not known
+    Returns:
+        manifest dict
+    '''
+    if layout not in MANIFEST_LAYOUTS:
+        raise ValueError('Unknown manifest layout '+str(layout)+'. Use one of '+', '.join(MANIFEST_LAYOUTS)+'.')
+    return {'version': MANIFEST_VERSION,
+            'layout': layout,
+            'params': None if params is None else [float(value) for value in params],
+            'channels': [int(channel) for channel in channels],
+            'channel_names': None if channel_names is None else [str(name) for name in channel_names],
+            'frame_shape': None if frame_shape is None else [int(size) for size in frame_shape],
+            'dtype': None if dtype is None else np.dtype(dtype).name,
+            'strips': []}
+
+# frame file names as {'pattern': ..., 'start': ...} when they differ only by one consecutive frame number,
+# as an explicit list otherwise
+def _compact_names(names):
+    names = [str(name) for name in names]
+    if len(names) < 2:
+        return names
+    first = re.split(r'(\d+)', names[0])
+    last = re.split(r'(\d+)', names[-1])
+    if len(first) != len(last):
+        return names
+    varying = [i for i in range(1, len(first), 2) if first[i] != last[i]]
+    if len(varying) != 1:
+        return names
+    field = varying[0]
+    literal = [token.replace('{', '{{').replace('}', '}}') for token in first]
+    # zero padded to the width of the first number, or plain
+    for number in ('{:0'+str(len(first[field]))+'d}', '{:d}'):
+        pattern = ''.join(literal[:field])+number+''.join(literal[field+1:])
+        start = int(first[field])
+        if all([pattern.format(start+i) == name for i, name in enumerate(names)]):
+            return {'pattern': pattern, 'start': start}
+    return names
+
+def add_strip(manifest, path, tile, frames, channel=None, height=0, files=None, position_um=None, view=None):
+    '''add one strip to a manifest.
+    Args:
+        manifest: manifest dict from new_manifest or read_manifest
+        path: directory or file of the strip, relative to the experiment directory
+        tile: tile (y) index of the strip
+        frames: number of frames of the strip
+        channel: acquisition channel ID, or None if the strip holds every channel (ndtiff)
+        height: height (z) index of the strip
+        files: frame file names in scan order (tiff), or None
+        position_um: stage position (scan, tile, height) in um at the start of the strip, or None
+        view: (channel, tile) of the strip's view in its BDV H5 file (bdv), or None
+    Returns:
+        the strip dict
+    '''
+    strip = {'path': Path(path).as_posix(),
+             'channel': None if channel is None else int(channel),
+             'tile': int(tile),
+             'height': int(height),
+             'frames': int(frames)}
+    if files is not None:
+        strip['files'] = _compact_names(files)
+    if position_um is not None:
+        strip['position_um'] = [float(value) for value in position_um]
+    if view is not None:
+        strip['view'] = [int(value) for value in view]
+    manifest['strips'].append(strip)
+    if channel is not None and int(channel) not in manifest['channels']:
+        manifest['channels'] = sorted(manifest['channels']+[int(channel)])
+    return strip
+
+def manifest_path(experiment_dir):
+    '''path of the manifest of an experiment directory.'''
+    return Path(experiment_dir) / MANIFEST_NAME
+
+def write_manifest(experiment_dir, manifest):
+    '''save a manifest in its experiment directory. Written to a temporary file and renamed, so a reconstruction that
+    starts while the acquisition is still running never sees a partial manifest.'''
+    path = manifest_path(experiment_dir)
+    tmp_path = path.with_suffix('.tmp'+str(os.getpid()))
+    if manifest.get('params_fallback'):
+        # script defaults filled in by load_manifest are not the recorded geometry of the acquisition
+        manifest = dict(manifest, params=None)
+        del manifest['params_fallback']
+    with open(tmp_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+def read_manifest(experiment_dir):
+    '''manifest of an experiment directory, or None if it has none or it was written by an older version.'''
+    try:
+        with open(manifest_path(experiment_dir)) as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('version') != MANIFEST_VERSION:
+        return None
+    return manifest
+
+# first integer after the given prefix at the start of a name or after an underscore, e.g. 'y' in 'ch0_y12'
+def _name_index(name, prefix):
+    m = re.search('(?:^|_)'+prefix+r'(\d+)', name, re.IGNORECASE)
+    return None if m is None else int(m.group(1))
+
+def build_manifest(experiment_dir, params=None):
+    '''index the strips of an experiment acquired without a manifest.
+    Every sub-directory is listed once. Directories holding an NDTiff.index are pycromanager datasets named
+    <name>_y<tile>_z<height>, the others are ch<channel>_y<tile> directories of single-frame TIFFs. Experiments with
+    neither are indexed from the XML of their <name>_y<tile>.h5 BDV files, with the BDV channel index as channel ID.
+    Args:
+        experiment_dir: experiment directory
+        params: [theta, stage move distance, camera pixel size] in [degrees, nm, nm], or None if not known
+    Returns:
+        manifest dict, marked 'indexed' so load_manifest rebuilds it when the experiment changes
+    '''
+    manifest = _index_experiment(experiment_dir, params)
+    manifest['indexed'] = True
+    return manifest
+
+# strips of an experiment directory, for build_manifest
+def _index_experiment(experiment_dir, params):
+    # imported here so the acquisition scripts can write manifests without the reconstruction dependencies
+    from opm_io import tiff_frame_shape, open_ndtiff_strip, bdv_view_setups, open_bdv_view
+
+    experiment_dir = Path(experiment_dir)
+    sub_dirs = natsorted([entry.path for entry in os.scandir(experiment_dir) if entry.is_dir()], alg=ns.PATH)
+    sub_dirs = [Path(sub_dir) for sub_dir in sub_dirs]
+
+    ndtiff_dirs = [sub_dir for sub_dir in sub_dirs if (sub_dir / 'NDTiff.index').exists() or \
+        (sub_dir / 'Full resolution' / 'NDTiff.index').exists()]
+    if ndtiff_dirs:
+        manifest = None
+        for sub_dir in ndtiff_dirs:
+            strip = open_ndtiff_strip(sub_dir, axes={'y': 0, 'z': 0})
+            if manifest is None:
+                manifest = new_manifest('ndtiff', params=params, channel_names=strip.channels, \
+                    frame_shape=strip.frame_shape, dtype=strip.dtype)
+                manifest['channels'] = list(range(len(strip.channels)))
+            tile = _name_index(sub_dir.name, 'y')
+            height = _name_index(sub_dir.name, 'z')
+            add_strip(manifest, sub_dir.name, 0 if tile is None else tile, strip.offsets.shape[1], \
+                height=0 if height is None else height)
+        return manifest
+
+    manifest = new_manifest('tiff', params=params)
+    for sub_dir in sub_dirs:
+
+        # determine the channel and experimental tile this directory corresponds to
+        channel = _name_index(sub_dir.name, 'ch')
+        tile = _name_index(sub_dir.name, 'y')
+        if channel is None or tile is None:
+            continue
+
+        names = natsorted([entry.name for entry in os.scandir(sub_dir) if entry.name.lower().endswith('.tif')], alg=ns.PATH)
+        if not names:
+            continue
+        if manifest['frame_shape'] is None:
+            frame_shape, frame_dtype = tiff_frame_shape(sub_dir / names[0])
+            manifest['frame_shape'] = [int(size) for size in frame_shape]
+            manifest['dtype'] = np.dtype(frame_dtype).name
+        add_strip(manifest, sub_dir.name, tile, len(names), channel=channel, files=names)
+    if manifest['strips']:
+        return manifest
+
+    # BDV H5 files of run_opm_mmcore.py, <name>_y<tile>.h5, with every height a tile of the file
+    bdv_files = natsorted([entry.path for entry in os.scandir(experiment_dir) if entry.name.endswith('.h5')], alg=ns.PATH)
+    for bdv_file in [Path(bdv_file) for bdv_file in bdv_files]:
+        tile = _name_index(bdv_file.stem, 'y')
+        if tile is None or not bdv_file.with_suffix('.xml').exists():
+            continue
+        if manifest['layout'] != 'bdv':
+            manifest = new_manifest('bdv', params=params)
+        for setup_id, channel, height, (frames, ny, nx) in bdv_view_setups(bdv_file.with_suffix('.xml')):
+            if manifest['frame_shape'] is None:
+                manifest['frame_shape'] = [ny, nx]
+                manifest['dtype'] = open_bdv_view(bdv_file, channel, height).dtype.name
+            add_strip(manifest, bdv_file.name, tile, frames, channel=channel, height=height, view=(channel, height))
+
+    return manifest
+
+# strip directories or files of the manifest's layout present in the experiment directory
+def _stored_strip_paths(experiment_dir, layout):
+    experiment_dir = Path(experiment_dir)
+    if layout == 'bdv':
+        return {entry.name for entry in os.scandir(experiment_dir) if entry.name.endswith('.h5') and
+                _name_index(Path(entry.name).stem, 'y') is not None and (experiment_dir / entry.name).with_suffix('.xml').exists()}
+    sub_dirs = [Path(entry.path) for entry in os.scandir(experiment_dir) if entry.is_dir()]
+    if layout == 'ndtiff':
+        return {sub_dir.name for sub_dir in sub_dirs if (sub_dir / 'NDTiff.index').exists() or \
+            (sub_dir / 'Full resolution' / 'NDTiff.index').exists()}
+    return {sub_dir.name for sub_dir in sub_dirs if _name_index(sub_dir.name, 'ch') is not None and \
+        _name_index(sub_dir.name, 'y') is not None and any([entry.name.lower().endswith('.tif') for entry in os.scandir(sub_dir)])}
+
+def manifest_mismatch(experiment_dir, manifest):
+    '''compare the strips of a manifest with the experiment directory, without indexing the experiment again.
+    Args:
+        experiment_dir: experiment directory
+        manifest: manifest dict
+    Returns:
+        description of the first difference found, or None if the manifest matches the directory
+    '''
+    from opm_io import open_ndtiff_strip, bdv_view_setups, open_raw_container
+
+    experiment_dir = Path(experiment_dir)
+    layout = manifest['layout']
+
+    # packed strips are read from their container, whether or not the original frames are still there
+    packed = {id(strip) for strip in manifest['strips'] if strip.get('container') is not None and \
+        (experiment_dir / strip['container']).exists()}
+    recorded = {strip['path'] for strip in manifest['strips']}
+    stored = _stored_strip_paths(experiment_dir, layout)
+    missing = recorded - stored - {strip['path'] for strip in manifest['strips'] if id(strip) in packed}
+    if missing:
+        return 'strips missing from the experiment directory: '+', '.join(sorted(missing))
+    if stored - recorded:
+        return 'strips not in the manifest: '+', '.join(sorted(stored - recorded))
+
+    setups = {}
+    for strip in manifest['strips']:
+        path = experiment_dir / strip['path']
+        try:
+            if id(strip) in packed:
+                frames = open_raw_container(experiment_dir / strip['container']).num_frames
+            elif layout == 'tiff':
+                frames = len([entry for entry in os.scandir(path) if entry.name.lower().endswith('.tif')])
+            elif layout == 'ndtiff':
+                frames = open_ndtiff_strip(path, axes={'y': 0, 'z': 0}).offsets.shape[1]
+            else:
+                if strip['path'] not in setups:
+                    setups[strip['path']] = {(channel, tile): size[0] for setup_id, channel, tile, size in
+                                             bdv_view_setups(path.with_suffix('.xml'))}
+                frames = setups[strip['path']].get(tuple(strip.get('view', (strip['channel'], strip['height']))))
+        except (OSError, ValueError):
+            frames = None
+        if frames != strip['frames']:
+            return strip['path']+' holds '+str(frames)+' frames, the manifest records '+str(strip['frames'])
+    return None
+
+def load_manifest(experiment_dir, params=None, rebuild=False):
+    '''manifest of an experiment directory, indexing the experiment and saving the manifest if it has none.
+    A manifest built by build_manifest that no longer matches the directory is rebuilt.
+    Args:
+        experiment_dir: experiment directory
+        params: geometry parameters of the calling script, used if the acquisition did not record any. They are
+                never saved, so the defaults of one script do not become the geometry of the experiment for the next.
+        rebuild: index the experiment even if it has a manifest
+    Returns:
+        manifest dict
+    Raises:
+        ValueError: the manifest was written by the acquisition and no longer matches the directory
+    '''
+    manifest = None if rebuild else read_manifest(experiment_dir)
+    stale = None
+    if manifest is not None:
+        mismatch = manifest_mismatch(experiment_dir, manifest)
+        if mismatch is not None:
+            if not manifest.get('indexed'):
+                raise ValueError('Acquisition manifest of '+str(experiment_dir)+' does not match the experiment directory ('+
+                                 mismatch+'). Wait for the acquisition to finish, or rebuild it with opm_manifest.py -r.')
+            print('Manifest out of date ('+mismatch+').')
+            stale, manifest = manifest, None
+    if manifest is None:
+        print('Indexing experiment directory: '+str(experiment_dir))
+        manifest = build_manifest(experiment_dir)
+        if stale is not None:
+            # keep the geometry recorded with opm_manifest.py -p, and the containers of unchanged strips
+            containers = {(strip['path'], str(strip.get('view')), strip['frames']): strip['container']
+                          for strip in stale['strips'] if strip.get('container') is not None}
+            for strip in manifest['strips']:
+                container = containers.get((strip['path'], str(strip.get('view')), strip['frames']))
+                if container is not None:
+                    strip['container'] = container
+            manifest['params'] = stale['params']
+        try:
+            write_manifest(experiment_dir, manifest)
+        except OSError:
+            # read-only data. The index is rebuilt on the next run.
+            pass
+    if manifest['params'] is None and params is not None:
+        manifest['params'] = [float(value) for value in params]
+        manifest['params_fallback'] = True
+    return manifest
+
+def manifest_strips(manifest, channel=None):
+    '''strips of a manifest in (height, tile, channel) order, optionally of one channel only.'''
+    strips = [strip for strip in manifest['strips'] if channel is None or strip['channel'] == channel]
+    return sorted(strips, key=lambda strip: (strip['height'], strip['tile'], -1 if strip['channel'] is None else strip['channel']))
+
+def manifest_counts(manifest):
+    '''(number of channels, number of tiles, number of heights) of an experiment.'''
+    strips = manifest['strips']
+    return len(manifest['channels']), len({strip['tile'] for strip in strips}), len({strip['height'] for strip in strips})
+
+def manifest_tiles(manifest, channel=None):
+    '''(height, tile) positions of the strips of a manifest, optionally of one channel only, in order. The index of a
+    position is the tile of its strips in output BDV files, whatever tile and height IDs the acquisition used.'''
+    return sorted({(strip['height'], strip['tile']) for strip in manifest_strips(manifest, channel=channel)})
+
+def strip_channel_indices(manifest, strip):
+    '''index in manifest['channels'] of every channel held by a strip, in the order its source holds them.'''
+    if strip['channel'] is None:
+        return list(range(len(manifest['channels'])))
+    return [manifest['channels'].index(strip['channel'])]
+
+def strip_files(experiment_dir, strip):
+    '''frame file paths of a strip, in scan order.'''
+    directory = Path(experiment_dir) / strip['path']
+    files = strip.get('files', [])
+    if isinstance(files, dict):
+        return [directory / files['pattern'].format(files['start']+i) for i in range(strip['frames'])]
+    return [directory / name for name in files]
+
+# (re)build the manifest of an existing experiment directory
+def main(argv):
+
+    input_dir_string = ''
+    params = None
+    rebuild = False
+
+    try:
+        arguments, values = getopt.getopt(argv,"hi:p:r",["help","ipath=","params=","rebuild"])
+    except getopt.GetoptError:
+        print('Error. opm_manifest.py -i <inputdirectory> -p <theta,stage step nm,pixel size nm> [-r]')
+        sys.exit(2)
+    for current_argument, current_value in arguments:
+        if current_argument == '-h':
+            print('Usage. opm_manifest.py -i <inputdirectory> -p <theta,stage step nm,pixel size nm> [-r]')
+            print('       -r rebuilds the manifest even if the experiment already has one')
+            sys.exit()
+        elif current_argument in ("-i", "--ipath"):
+            input_dir_string = current_value
+        elif current_argument in ("-p", "--params"):
+            params = [float(value) for value in current_value.split(',')]
+        elif current_argument in ("-r", "--rebuild"):
+            rebuild = True
+
+    if (input_dir_string == ''):
+        print('Input parse error.')
+        sys.exit(2)
+    if params is not None and len(params) != 3:
+        print('Parameter parse error. Expected theta,stage step,pixel size in degrees,nm,nm.')
+        sys.exit(2)
+
+    # parameters given here are recorded as the geometry of the acquisition
+    manifest = load_manifest(input_dir_string, rebuild=rebuild)
+    if params is not None and manifest['params'] != params:
+        manifest['params'] = params
+        write_manifest(input_dir_string, manifest)
+
+    num_channels, num_tiles, num_heights = manifest_counts(manifest)
+    print('Layout: '+manifest['layout']+'; channels: '+str(num_channels)+'; tiles: '+str(num_tiles)+ \
+        '; heights: '+str(num_heights)+'; strips: '+str(len(manifest['strips']))+ \
+        '; frames: '+str(sum([strip['frames'] for strip in manifest['strips']]))+'.')
+
+
+# run
+if __name__ == "__main__":
+    main(sys.argv[1:])
+
+
+# The MIT License
+#
+# Copyright (c) 2020 Douglas Shepherd, Arizona State University
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+
+'''
+Synthetic stage scanning OPM data for validating and timing the deskew engine without real acquisitions.
+
+Sub-resolution beads and filaments are placed at known 3D positions in the deskewed coordinate system
+(z above the coverslip, y along the stage scan, x along the camera columns, all in camera pixels) and rendered
+as Gaussians into the raw frames through the same theta / stage step / camera pixel geometry as the
+acquisition: raw frame p, camera row r samples the height z = r*sin(theta) and scan position
+y = p*step + r*cos(theta). The known bead positions are the ground truth for localisation errors.
+'''
+
+# imports
+import numpy as np
+from collections import namedtuple
+from numba import njit
+from scipy.spatial import cKDTree
+from deskew_engine import _output_shape
+
+# raw: uint16 raw stack (num_images, ny, nx) as saved by the camera
+# beads: (num_beads, 4) z, y, x, amplitude of every bead in deskewed camera pixels
+# filaments: list of (num_points, 3) z, y, x polylines sampled every half pixel
+# truth: noise-free, background-free deskewed volume (final_nz, final_ny, nx) or None if not rendered
+Phantom = namedtuple('Phantom', ['raw', 'beads', 'filaments', 'truth'])
+
+# add Gaussian points (z, y, x, amplitude per row of points) to a raw stack. Each point only visits the
+# camera rows and raw frames within 4 sigma of it, so the cost scales with the number of points, not the volume.
+@njit(cache=True)
+def _splat_raw(points, sigma, sintheta, costheta, pixel_step, volume):
+    num_images, ny, nx = volume.shape
+    radius = 4.0*sigma
+    for b in range(points.shape[0]):
+        z, y, x, amplitude = points[b,0], points[b,1], points[b,2], points[b,3]
+        r_lo = max(0, np.int64(np.floor((z-radius)/sintheta)))
+        r_hi = min(ny-1, np.int64(np.ceil((z+radius)/sintheta)))
+        x_lo = max(0, np.int64(np.floor(x-radius)))
+        x_hi = min(nx-1, np.int64(np.ceil(x+radius)))
+        for r in range(r_lo,r_hi+1):
+            dz = r*sintheta - z
+            if abs(dz) > radius:
+                continue
+            y_row = r*costheta
+            p_lo = max(0, np.int64(np.floor((y-radius-y_row)/pixel_step)))
+            p_hi = min(num_images-1, np.int64(np.ceil((y+radius-y_row)/pixel_step)))
+            for p in range(p_lo,p_hi+1):
+                dy = p*pixel_step + y_row - y
+                if abs(dy) > radius:
+                    continue
+                for xi in range(x_lo,x_hi+1):
+                    dx = xi - x
+                    volume[p,r,xi] += amplitude*np.exp(-(dz*dz+dy*dy+dx*dx)/(2.0*sigma*sigma))
+    return volume
+
+# add Gaussian points to a deskewed volume sampled on the (z, y, x) camera pixel grid
+@njit(cache=True)
+def _splat_deskewed(points, sigma, volume):
+    nz, ny, nx = volume.shape
+    radius = 4.0*sigma
+    for b in range(points.shape[0]):
+        z, y, x, amplitude = points[b,0], points[b,1], points[b,2], points[b,3]
+        z_lo = max(0, np.int64(np.floor(z-radius)))
+        z_hi = min(nz-1, np.int64(np.ceil(z+radius)))
+        y_lo = max(0, np.int64(np.floor(y-radius)))
+        y_hi = min(ny-1, np.int64(np.ceil(y+radius)))
+        x_lo = max(0, np.int64(np.floor(x-radius)))
+        x_hi = min(nx-1, np.int64(np.ceil(x+radius)))
+        for zi in range(z_lo,z_hi+1):
+            for yi in range(y_lo,y_hi+1):
+                for xi in range(x_lo,x_hi+1):
+                    d2 = (zi-z)*(zi-z) + (yi-y)*(yi-y) + (xi-x)*(xi-x)
+                    volume[zi,yi,xi] += amplitude*np.exp(-d2/(2.0*sigma*sigma))
+    return volume
+
+# uniform random positions inside the part of the deskewed volume the scan covers, at least margin pixels from
+# its edges. The scan covers z/tan(theta) <= y <= z/tan(theta) + (num_images-1)*step at every height z.
+def _random_positions(rng, count, final_nz, nx, tantheta, pixel_step, num_images, margin):
+    z = rng.uniform(margin, final_nz-margin, count)
+    y = z/tantheta + rng.uniform(margin, (num_images-1)*pixel_step-margin, count)
+    x = rng.uniform(margin, nx-margin, count)
+    return np.stack((z, y, x), axis=1)
+
+# true if a position is inside the covered part of the volume, at least margin pixels from its edges
+def _inside_scan(position, final_nz, nx, tantheta, pixel_step, num_images, margin):
+    z, y, x = position
+    y_scan = y - z/tantheta
+    return (margin <= z <= final_nz-margin) and (margin <= y_scan <= (num_images-1)*pixel_step-margin) and (margin <= x <= nx-margin)
+
+def make_phantom(shape=(1000,256,512), parameters=(30,200,116), num_beads=500, num_filaments=20, sigma=1.2,
+                 bead_amplitude=1000.0, filament_amplitude=300.0, background=100.0, noise=True, render_truth=False, seed=0):
+    '''synthetic skewed stage scan of beads and filaments at known positions.
+    Args:
+        shape: raw stack shape (num_images, ny, nx)
+        parameters: [theta, stage move distance, camera pixel size] in [degrees,nm,nm]
+        num_beads: number of sub-resolution beads
+        num_filaments: number of filaments, random persistent walks 50 to 300 pixels long
+        sigma: Gaussian PSF standard deviation in camera pixels
+        bead_amplitude: bead peak above background in camera counts
+        filament_amplitude: filament peak above background in camera counts
+        background: camera offset plus background in counts
+        noise: add Poisson noise to the raw frames
+        render_truth: also render the noise-free deskewed volume (final_nz x final_ny x nx float32)
+        seed: random seed for positions and noise
+    Returns:
+        Phantom(raw, beads, filaments, truth)
+    '''
+    parameters = np.asarray(parameters, dtype=np.float32)
+    theta, distance, pixel_size = parameters[0], parameters[1], parameters[2]
+    num_images, ny, nx = shape
+    final_nz, final_ny = _output_shape(theta, distance, pixel_size, num_images, ny)
+    pixel_step = float(distance/pixel_size)
+    tantheta = np.tan(theta*np.pi/180)
+    margin = 4.0*sigma
+    rng = np.random.default_rng(seed)
+
+    # beads anywhere inside the scanned volume
+    beads = np.concatenate((_random_positions(rng, num_beads, final_nz, nx, tantheta, pixel_step, num_images, margin),
+                            np.full((num_beads,1), bead_amplitude)), axis=1)
+
+    # filaments as persistent random walks sampled every half pixel, stopped at the edge of the scanned volume.
+    # each sample carries the amplitude that makes the peak of the rendered line about filament_amplitude.
+    spacing = 0.5
+    filaments = []
+    for start in _random_positions(rng, num_filaments, final_nz, nx, tantheta, pixel_step, num_images, margin):
+        direction = rng.normal(size=3)
+        direction /= np.linalg.norm(direction)
+        points = [start]
+        for i in range(int(rng.uniform(50, 300)/spacing)):
+            direction += rng.normal(scale=0.05, size=3)
+            direction /= np.linalg.norm(direction)
+            position = points[-1] + spacing*direction
+            if not _inside_scan(position, final_nz, nx, tantheta, pixel_step, num_images, margin):
+                break
+            points.append(position)
+        filaments.append(np.asarray(points))
+    point_amplitude = filament_amplitude*spacing/(np.sqrt(2*np.pi)*sigma)
+    filament_points = np.concatenate([np.concatenate((points, np.full((len(points),1), point_amplitude)), axis=1) for points in filaments]) \
+                      if filaments else np.zeros((0,4))
+    points = np.concatenate((beads, filament_points))
+
+    # render through the acquisition geometry, add background and noise, and store as the camera would
+    raw = np.full(shape, background, dtype=np.float32)
+    _splat_raw(points, sigma, np.sin(theta*np.pi/180), np.cos(theta*np.pi/180), pixel_step, raw)
+    if noise:
+        # Poisson noise. Above 50 counts the normal approximation is indistinguishable and much faster to draw.
+        low = raw < 50
+        noisy = rng.standard_normal(shape, dtype=np.float32)
+        noisy *= np.sqrt(raw)
+        noisy += raw
+        noisy[low] = rng.poisson(raw[low])
+        raw = noisy
+    raw = np.clip(np.round(raw), 0, 65535).astype(np.uint16)
+
+    truth = None
+    if render_truth:
+        truth = _splat_deskewed(points, sigma, np.zeros((final_nz, final_ny, nx), dtype=np.float32))
+
+    return Phantom(raw, beads, filaments, truth)
+
+def bead_localisation_error(deskewed, phantom, sigma=1.2, z_bin=1, isolation=6.0):
+    '''localise every isolated phantom bead in a deskewed volume and compare with its true position.
+    Each bead is localised by the background subtracted centroid of a +-3 sigma box around its true position.
+    Beads closer than isolation*sigma to another bead or filament, or whose box leaves the filled part of the
+    volume, are skipped.
+    Args:
+        deskewed: stage_deskew output of phantom.raw (nz, ny, nx)
+        phantom: Phantom returned by make_phantom
+        sigma: PSF standard deviation used for the phantom, in camera pixels
+        z_bin: z binning used for the deskew
+        isolation: minimum distance to any other structure, in units of sigma
+    Returns:
+        (num_localised, 3) z, y, x localisation errors in camera pixels
+    '''
+    # structures close to each other bias the centroid. Keep beads far from every other bead and filament.
+    structures = np.concatenate([phantom.beads[:,:3]] + [points for points in phantom.filaments if len(points)])
+    distances, _ = cKDTree(structures).query(phantom.beads[:,:3], k=2)
+    isolated = distances[:,1] > isolation*sigma
+
+    # binned plane k averages deskewed planes k*z_bin to (k+1)*z_bin-1, so its centre is at k*z_bin + (z_bin-1)/2
+    z_scale = np.array((z_bin, 1.0, 1.0))
+    z_shift = np.array(((z_bin-1)/2.0, 0.0, 0.0))
+    radius = np.ceil(3.0*sigma/z_scale).astype(np.int64)
+
+    errors = []
+    for bead in phantom.beads[isolated,:3]:
+        centre = np.round((bead - z_shift)/z_scale).astype(np.int64)
+        lo = centre - radius
+        hi = centre + radius + 1
+        if np.any(lo < 0) or np.any(hi > np.array(deskewed.shape)):
+            continue
+        box = deskewed[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]].astype(np.float64)
+
+        # empty voxels mean the box reaches outside the deskewed parallelogram
+        if np.any(box == 0):
+            continue
+
+        # background from the box surface, then the centroid of what is left
+        surface = np.concatenate((box[[0,-1]].ravel(), box[:,[0,-1]].ravel(), box[:,:,[0,-1]].ravel()))
+        signal = np.clip(box - np.median(surface), 0, None)
+        if signal.sum() <= 0:
+            continue
+        grid = np.meshgrid(*[np.arange(l, h) for l, h in zip(lo, hi)], indexing='ij')
+        centroid = np.array([np.sum(g*signal) for g in grid])/signal.sum()
+        errors.append(centroid*z_scale + z_shift - bead)
+
+    return np.asarray(errors).reshape(-1, 3)
+
+
+# The MIT License
+#
+# Copyright (c) 2020 Douglas Shepherd, Arizona State University
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
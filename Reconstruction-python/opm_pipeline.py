@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+
+'''
+Pipelined execution of the read -> deskew -> write loop of the reconstruction scripts.
+
+Reading block N+1 and writing block N-1 run in background threads while block N is deskewed in the calling thread,
+so the disk works while the CPU deskews and the other way around. prefetch reads ahead through a bounded queue and
+only starts on a new item when one of its depth buffers is free. With depth=1 this is classic double buffering: at
+most two raw blocks are alive at any time, which is what memory_planner assumes with pipelined=True.
+
+BackgroundBdvWriter wraps a npy2bdv.BdvWriter so that append_view only queues the view, with back-pressure against
+a byte budget instead of a number of items. Scripts that deskew or acquire in a plain loop then overlap the HDF5
+writes and pyramid downsampling with their own work without being restructured.
+
+File reads, TIFF decoding, the numba deskew kernels, and HDF5 writes all release the GIL for their heavy lifting.
+
+Busy time is recorded for every stage, so the utilisation report shows which stage is the bottleneck:
+the stage close to 100% sets the pace and the others wait for it.
+'''
+
+# imports
+import collections
+import numpy as np
+import os
+import queue
+import threading
+import time
+
+# end of stream marker passed through the queues
+_DONE = object()
+
+# default bytes of views queued for writing by BackgroundBdvWriter. Override with the OPM_WRITE_QUEUE_GB environment
+# variable.
+DEFAULT_WRITE_QUEUE_BYTES = int(float(os.environ.get('OPM_WRITE_QUEUE_GB', 2))*1e9)
+
+# stage timings are kept in a plain dict shared by every stage of a pipeline: stage name to busy seconds,
+# '<name> wait' to the seconds the calling thread was blocked on that stage, and 'wall' to the elapsed time.
+def _add_time(stats, key, seconds, lock=threading.Lock()):
+    if stats is not None:
+        with lock:
+            stats[key] = stats.get(key, 0.0) + seconds
+
+def prefetch(iterable, depth=1, stats=None, name='read'):
+    '''iterate an iterable in a background thread, producing up to depth items ahead of the consumer.
+    The producer only starts on the next item when the consumer asks for one, so with depth=1 item N+1 is read while
+    item N is processed. Errors raised by the iterable are raised in the consumer.
+    Args:
+        iterable: items to produce, e.g. a generator that reads blocks of frames
+        depth: items produced ahead of the one the consumer is working on
+        stats: stage timing dict, or None
+        name: stage name in stats
+    Yields:
+        items of the iterable, in order
+    '''
+    # one buffer for the item the consumer holds, depth for the items ahead of it
+    depth = max(int(depth), 1)
+    slots = threading.Semaphore(depth+1)
+    items = queue.Queue(maxsize=depth+2)
+    stop = threading.Event()
+
+    def _produce():
+        try:
+            iterator = iter(iterable)
+            while True:
+                slots.acquire()
+                if stop.is_set():
+                    break
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                _add_time(stats, name, time.perf_counter() - start)
+                items.put((item, None))
+                del item
+            items.put((_DONE, None))
+        except BaseException as error:
+            items.put((_DONE, error))
+
+    producer = threading.Thread(target=_produce, name='opm-'+name, daemon=True)
+    producer.start()
+    try:
+        while True:
+            start = time.perf_counter()
+            item, error = items.get()
+            _add_time(stats, name+' wait', time.perf_counter() - start)
+            if item is _DONE:
+                if error is not None:
+                    raise error
+                break
+            yield item
+            # the consumer asks for the next item once it is done with this one, which frees its buffer
+            del item
+            slots.release()
+    finally:
+        stop.set()
+        slots.release()
+        producer.join()
+
+class BackgroundBdvWriter:
+    '''write the views of a npy2bdv.BdvWriter in a dedicated background thread.
+    append_view queues the view and returns at once, so the caller deskews the next block, or acquires the next strip,
+    while HDF5 downsamples and writes the last one. Views are written one at a time, in the order they were appended,
+    and a stack must not be changed after it is appended. append_view blocks while the views queued or being written
+    hold more than max_bytes (back-pressure). A view is always accepted when nothing is pending, so max_bytes=0 writes
+    one view in the background while the caller works on the next. Array keyword arguments (m_affine) are copied when
+    the view is queued, the stack is not. The first error of the writer is raised again by the next append_view, by
+    flush, and by close; views appended after an error are dropped.
+    Args:
+        writer: npy2bdv.BdvWriter to write to. Closed by close.
+        max_bytes: bytes of the views queued or being written before append_view blocks.
+                   DEFAULT_WRITE_QUEUE_BYTES if not provided.
+        stats: stage timing dict, or None
+        name: stage name in stats
+    '''
+    def __init__(self, writer, max_bytes=None, stats=None, name='write'):
+        self.writer = writer
+        self.max_bytes = DEFAULT_WRITE_QUEUE_BYTES if max_bytes is None else int(max_bytes)
+        self.stats = stats
+        self.name = name
+        self.error = None
+        self._views = collections.deque()
+        self._pending_bytes = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._consume, name='opm-'+name, daemon=True)
+        self._thread.start()
+
+    def _consume(self):
+        while True:
+            with self._condition:
+                while not self._views:
+                    self._condition.wait()
+                item = self._views[0]
+            if item is _DONE:
+                break
+            stack, nbytes, args, kwargs = item
+            if self.error is None:
+                start = time.perf_counter()
+                try:
+                    self.writer.append_view(stack, *args, **kwargs)
+                except BaseException as error:
+                    self.error = error
+                _add_time(self.stats, self.name, time.perf_counter() - start)
+            # the view only stops counting against the budget once the writer has let go of it
+            del item, stack, args, kwargs
+            with self._condition:
+                self._views.popleft()
+                self._pending_bytes = self._pending_bytes - nbytes
+                self._condition.notify_all()
+
+    def append_view(self, stack, *args, **kwargs):
+        '''queue one view, blocking while the pending views hold more than max_bytes. Arguments as BdvWriter.append_view.'''
+        nbytes = 0 if stack is None else int(stack.nbytes)
+        # small array arguments such as m_affine are copied, as callers update them in place for the next view
+        kwargs = {key: value.copy() if isinstance(value, np.ndarray) else value for key, value in kwargs.items()}
+        start = time.perf_counter()
+        with self._condition:
+            while self.error is None and self._pending_bytes > 0 and self._pending_bytes+nbytes > self.max_bytes:
+                self._condition.wait()
+            _add_time(self.stats, self.name+' wait', time.perf_counter() - start)
+            if self.error is not None:
+                raise self.error
+            if self._closed:
+                raise ValueError('append_view on a closed writer.')
+            self._views.append((stack, nbytes, args, kwargs))
+            self._pending_bytes = self._pending_bytes + nbytes
+            self._condition.notify_all()
+
+    def flush(self):
+        '''wait for every queued view to be written. Raises the first error of the writer.'''
+        start = time.perf_counter()
+        with self._condition:
+            while self._views and self._views[0] is not _DONE:
+                self._condition.wait()
+        _add_time(self.stats, self.name+' wait', time.perf_counter() - start)
+        if self.error is not None:
+            raise self.error
+
+    def write_xml_file(self, *args, **kwargs):
+        '''write the BDV XML file once every queued view is written. Arguments as BdvWriter.write_xml_file.'''
+        self.flush()
+        return self.writer.write_xml_file(*args, **kwargs)
+
+    def close(self):
+        '''write every queued view, stop the thread, and close the BDV file. Raises the first error of the writer.'''
+        if self._thread.is_alive():
+            start = time.perf_counter()
+            with self._condition:
+                self._closed = True
+                self._views.append(_DONE)
+                self._condition.notify_all()
+            self._thread.join()
+            _add_time(self.stats, self.name+' wait', time.perf_counter() - start)
+            self.writer.close()
+        if self.error is not None:
+            raise self.error
+
+def print_pipeline_report(stats, wall=None, process='deskew'):
+    '''print the busy time and utilisation of every pipeline stage.
+    Args:
+        stats: stage timing dict filled by prefetch and BackgroundBdvWriter
+        wall: elapsed seconds of the pipeline. stats['wall'] if not provided.
+        process: name of the stage run by the calling thread. If it was not timed, its busy time is the wall time
+                 minus the time the calling thread waited on the other stages.
+    '''
+    if wall is None:
+        wall = stats.get('wall', 0.0)
+    wall = max(wall, 1e-9)
+    stats = dict(stats)
+    if process not in stats:
+        stats[process] = max(wall - sum([stats[key] for key in stats if key.endswith(' wait')]), 0.0)
+    stages = [key for key in stats if key != 'wall' and not key.endswith(' wait')]
+    print('Pipeline: {:.1f} s wall.'.format(wall))
+    for stage in stages:
+        print('  {:>8}: {:8.1f} s busy, {:5.1f}% utilised, caller waited {:.1f} s'.format(
+              stage, stats[stage], 100.*stats[stage]/wall, stats.get(stage+' wait', 0.0)))
+    if stages:
+        bottleneck = max(stages, key=lambda stage: stats[stage])
+        print('  bottleneck: '+bottleneck)
+
+
+# The MIT License
+#
+# Copyright (c) 2020 Douglas Shepherd, Arizona State University
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+'''
+Pack the strips of an experiment into chunked single-file raw containers.
+
+Every strip (a directory of single-frame TIFFs, a pycromanager NDTiff dataset, or one view of a BDV H5 file) becomes
+one HDF5 file next to it, <strip>.raw.h5 (<file>_c<channel>_t<tile>.raw.h5 for BDV views), holding its frames in the
+camera dtype, optionally with a lossless filter. Frames are chunked in windows of frames that the streaming deskew
+advances by per minimum output slab, so reconstructions read whole chunks.
+The acquisition manifest records the container of every strip, and open_strip reads from it from then on.
+
+Strips are packed in parallel, one process per strip, and the manifest is saved after every strip, so an interrupted
+run picks up where it stopped. The original frames are left in place.
+
+Usage:
+    python pack_strips.py -i <inputdirectory> -c <none|lzf|gzip|zstd> -f <frames per chunk> -w <processes> [-r]
+'''
+
+# imports
+import numpy as np
+from pathlib import Path
+import sys
+import getopt
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from opm_io import open_strip, read_strip, write_raw_container, RAW_CONTAINER_SUFFIX, RAW_COMPRESSIONS
+from opm_manifest import load_manifest, write_manifest, manifest_strips
+from opm_pipeline import prefetch
+
+# narrowest output slab planned by memory_planner.plan_stream_slabs, in output rows
+_MIN_SLAB_NY = 64
+
+def default_chunk_frames(parameters):
+    '''frames the streaming deskew window advances by per minimum output slab. Slabs planned by plan_stream_slabs
+    are whole multiples of it, so every window reads close to a whole number of chunks.
+    Args:
+        parameters: [theta, stage move distance, camera pixel size] in [degrees,nm,nm]
+    Returns:
+        frames per chunk
+    '''
+    pixel_step = float(parameters[1])/float(parameters[2])
+    return max(int(round(_MIN_SLAB_NY/pixel_step)), 1)
+
+def container_name(strip):
+    '''container path of a strip, relative to the experiment directory. Views of one BDV H5 file share its path, so
+    their container is named after the file and the view.'''
+    path = Path(strip['path']).as_posix().rstrip('/')
+    if strip.get('view') is not None:
+        path = str(Path(path).with_suffix(''))+'_c{:d}_t{:d}'.format(*strip['view'])
+    return path+RAW_CONTAINER_SUFFIX
+
+def pack_strip(experiment_dir, strip, chunk_frames, compression=None, num_workers=None):
+    '''pack one strip into its raw container.
+    Args:
+        experiment_dir: experiment directory
+        strip: strip dict of the manifest
+        chunk_frames: frames per chunk
+        compression: one of RAW_COMPRESSIONS, or None
+        num_workers: number of concurrent frame reads of TIFF strips
+    Returns:
+        (container path relative to the experiment directory, MB packed, seconds)
+    '''
+    start_time = time.perf_counter()
+    source = open_strip(experiment_dir, dict(strip, container=None))
+    container_path = container_name(strip)
+
+    # frames are read one chunk ahead of the (compressing) write
+    windows = [(start, min(start+chunk_frames, source.num_frames)) for start in range(0, source.num_frames, chunk_frames)]
+    blocks = prefetch(((start, read_strip(source, start, end, num_workers=num_workers)) for start, end in windows), depth=1)
+    if source.layout == 'ndtiff':
+        channels = source.source.channels
+    else:
+        channels = [strip['channel']]
+    write_raw_container(Path(experiment_dir) / container_path, blocks, source.num_channels, source.num_frames,
+                        source.frame_shape, dtype=source.dtype, chunk_frames=chunk_frames, compression=compression,
+                        channels=channels)
+
+    nbytes = source.num_channels*source.num_frames*int(np.prod(source.frame_shape))*source.dtype.itemsize
+    return container_path, nbytes/1e6, time.perf_counter()-start_time
+
+# pack every strip of an experiment directory
+def main(argv):
+
+    input_dir_string = ''
+    compression = 'none'
+    chunk_frames = None
+    num_processes = 4
+    repack = False
+
+    try:
+        arguments, values = getopt.getopt(argv,"hi:c:f:w:r",["help","ipath=","compression=","frames=","workers=","repack"])
+    except getopt.GetoptError:
+        print('Error. pack_strips.py -i <inputdirectory> -c <none|lzf|gzip|zstd> -f <frames per chunk> -w <processes> [-r]')
+        sys.exit(2)
+    for current_argument, current_value in arguments:
+        if current_argument == '-h':
+            print('Usage. pack_strips.py -i <inputdirectory> -c <none|lzf|gzip|zstd> -f <frames per chunk> -w <processes> [-r]')
+            print('       -c lossless filter of the containers (default: none)')
+            print('       -f frames per chunk (default: frames per minimum deskew slab)')
+            print('       -w strips packed at the same time (default: 4)')
+            print('       -r repacks strips that already have a container')
+            sys.exit()
+        elif current_argument in ("-i", "--ipath"):
+            input_dir_string = current_value
+        elif current_argument in ("-c", "--compression"):
+            compression = current_value
+        elif current_argument in ("-f", "--frames"):
+            chunk_frames = int(current_value)
+        elif current_argument in ("-w", "--workers"):
+            num_processes = int(current_value)
+        elif current_argument in ("-r", "--repack"):
+            repack = True
+
+    if (input_dir_string == ''):
+        print('Input parse error.')
+        sys.exit(2)
+    if compression not in RAW_COMPRESSIONS:
+        print('Compression parse error. Use one of '+', '.join(RAW_COMPRESSIONS)+'.')
+        sys.exit(2)
+
+    input_dir_path = Path(input_dir_string)
+    manifest = load_manifest(input_dir_path)
+    if chunk_frames is None:
+        chunk_frames = 64 if manifest['params'] is None else default_chunk_frames(manifest['params'])
+
+    strips = [strip for strip in manifest_strips(manifest) if repack or strip.get('container') is None or \
+        not (input_dir_path / strip['container']).exists()]
+    # strips are packed in parallel, so two strips writing the same container would overwrite each other
+    container_names = [container_name(strip) for strip in manifest_strips(manifest)]
+    if len(set(container_names)) != len(container_names):
+        print('Strips of the manifest share a container name. Rebuild the manifest with opm_manifest.py -r.')
+        sys.exit(2)
+    print('Packing '+str(len(strips))+' strips, '+str(chunk_frames)+' frames per chunk, compression: '+compression+'.')
+
+    # every strip is read with a few threads, and packed in its own process
+    start_time = time.perf_counter()
+    total_mb = 0.0
+    with ProcessPoolExecutor(max_workers=max(num_processes, 1)) as pool:
+        futures = {pool.submit(pack_strip, input_dir_path, strip, chunk_frames, compression, 4): strip for strip in strips}
+        for future in as_completed(futures):
+            container_path, mb, seconds = future.result()
+            futures[future]['container'] = container_path
+            write_manifest(input_dir_path, manifest)
+            total_mb = total_mb + mb
+            print('Packed '+container_path+': {:.0f} MB in {:.1f} s ({:.0f} MB/s).'.format(mb, seconds, mb/max(seconds, 1e-9)))
+
+    elapsed = time.perf_counter() - start_time
+    print('Packed {} strips, {:.0f} MB in {:.1f} s ({:.0f} MB/s).'.format(len(strips), total_mb, elapsed, total_mb/max(elapsed, 1e-9)))
+
+
+# run
+if __name__ == "__main__":
+    main(sys.argv[1:])
+
+
+# The MIT License
+#
+# Copyright (c) 2020 Douglas Shepherd, Arizona State University
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
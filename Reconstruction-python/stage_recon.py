@@ -11,102 +11,16 @@ Shepherd 03/20
 # imports
 import numpy as np
 from pathlib import Path
-from natsort import natsorted, ns
 import npy2bdv
 import gc
 import sys
 import getopt
-import re
-import skimage.io as io
-from skimage.measure import block_reduce
 import time
-from numba import njit, prange
-
-# perform stage scanning reconstruction using orthogonal interpolation
-# http://numba.pydata.org/numba-doc/latest/user/parallel.html#numba-parallel
-@njit(parallel=True)
-def stage_deskew(data,parameters):
-
-    # unwrap parameters 
-    theta = parameters[0]             # (degrees)
-    distance = parameters[1]          # (nm)
-    pixel_size = parameters[2]        # (nm)
-    [num_images,ny,nx]=data.shape  # (pixels)
-
-
-    # change step size from physical space (nm) to camera space (pixels)
-    pixel_step = distance/pixel_size    # (pixels)
-
-    # calculate the number of pixels scanned during stage scan 
-    scan_end = num_images * pixel_step  # (pixels)
-
-    # calculate properties for final image
-    final_ny = np.int64(np.ceil(scan_end+ny*np.cos(theta*np.pi/180))) # (pixels)
-    final_nz = np.int64(np.ceil(ny*np.sin(theta*np.pi/180)))          # (pixels)
-    final_nx = np.int64(nx)                                           # (pixels)
-
-    # create final image
-    output = np.zeros((final_nz, final_ny, final_nx),dtype=np.float32)  # (pixels,pixels,pixels - data is float32)
-
-    # precalculate trig functions for scan angle
-    tantheta = np.float32(np.tan(theta * np.pi/180)) # (float32)
-    sintheta = np.float32(np.sin(theta * np.pi/180)) # (float32)
-    costheta = np.float32(np.cos(theta * np.pi/180)) # (float32)
-
-    # perform orthogonal interpolation
-
-    # loop through output z planes
-    # defined as parallel loop in numba
-    # http://numba.pydata.org/numba-doc/latest/user/parallel.html#numba-parallel
-    for z in prange(0,final_nz):
-        # calculate range of output y pixels to populate
-        y_range_min=np.minimum(0,np.int64(np.floor(np.float32(z)/tantheta)))
-        y_range_max=np.maximum(final_ny,np.int64(np.ceil(scan_end+np.float32(z)/tantheta+1)))
-
-        # loop through final y pixels
-        # defined as parallel loop in numba
-        # http://numba.pydata.org/numba-doc/latest/user/parallel.html#numba-parallel
-        for y in prange(y_range_min,y_range_max):
-
-            # find the virtual tilted plane that intersects the interpolated plane 
-            virtual_plane = y - z/tantheta
-
-            # find raw data planes that surround the virtual plane
-            plane_before = np.int64(np.floor(virtual_plane/pixel_step))
-            plane_after = np.int64(plane_before+1)
-
-            # continue if raw data planes are within the data range
-            if ((plane_before>=0) and (plane_after<num_images)):
-                
-                # find distance of a point on the  interpolated plane to plane_before and plane_after
-                l_before = virtual_plane - plane_before * pixel_step
-                l_after = pixel_step - l_before
-                
-                # determine location of a point along the interpolated plane
-                za = z/sintheta
-                virtual_pos_before = za + l_before*costheta
-                virtual_pos_after = za - l_after*costheta
-
-                # determine nearest data points to interpoloated point in raw data
-                pos_before = np.int64(np.floor(virtual_pos_before))
-                pos_after = np.int64(np.floor(virtual_pos_after))
-
-                # continue if within data bounds
-                if ((pos_before>=0) and (pos_after >= 0) and (pos_before<ny-1) and (pos_after<ny-1)):
-                    
-                    # determine points surrounding interpolated point on the virtual plane 
-                    dz_before = virtual_pos_before - pos_before
-                    dz_after = virtual_pos_after - pos_after
-
-                    # compute final image plane using orthogonal interpolation
-                    output[z,y,:] = (l_before * dz_after * data[plane_after,pos_after+1,:] + \
-                                    l_before * (1-dz_after) * data[plane_after,pos_after,:] + \
-                                    l_after * dz_before * data[plane_before,pos_before+1,:] + \
-                                    l_after * (1-dz_before) * data[plane_before,pos_before,:]) /pixel_step
-
-
-    # return output
-    return output
+from deskew_engine import stage_deskew_stream, stage_deskew_roi, deskew_affine, QUALITY_MODES
+from memory_planner import plan_stream_slabs, print_memory_plan
+from opm_io import open_strip, read_strip, read_strip_region, iter_strip_frames
+from opm_pipeline import prefetch, BackgroundBdvWriter, print_pipeline_report
+from opm_manifest import load_manifest, manifest_strips, manifest_counts, manifest_tiles, strip_channel_indices
 
 # parse experimental directory, load data, perform orthogonal deskew, and save as BDV H5 file
 def main(argv):
@@ -114,24 +28,45 @@ def main(argv):
     # parse directory name from command line argument 
     input_dir_string = ''
     output_dir_string = ''
+    quality = 'orthogonal'
+    output_scale = 1.0
+    roi_string = ''
+    affine_export = False
+    memory_budget = None
 
     try:
-        arguments, values = getopt.getopt(argv,"hi:o:n:c:",["help","ipath=","opath="])
+        arguments, values = getopt.getopt(argv,"hi:o:n:c:r:q:s:m:a",["help","ipath=","opath=","roi=","quality=","scale=","memory=","affine"])
     except getopt.GetoptError:
-        print('Error. stage_recon.py -i <inputdirectory> -o <outputdirectory>')
+        print('Error. stage_recon.py -i <inputdirectory> -o <outputdirectory> -r <scan0,scan1,height0,height1,x0,x1> -q <nearest|orthogonal|cubic> -s <output scale> -m <RAM budget in GB> [-a]')
         sys.exit(2)
     for current_argument, current_value in arguments:
         if current_argument == '-h':
-            print('Usage. stage_recon.py -i <inputdirectory> -o <outputdirectory>')
+            print('Usage. stage_recon.py -i <inputdirectory> -o <outputdirectory> -r <scan0,scan1,height0,height1,x0,x1> -q <nearest|orthogonal|cubic> -s <output scale> -m <RAM budget in GB> [-a]')
+            print('       -r deskews only the given box (in um) of every strip for a quick look')
+            print('       -m sets the RAM budget used to size slabs (default: 80% of available memory)')
+            print('       -a writes raw strips with the deskew as an affine registration, no resampling')
             sys.exit()
         elif current_argument in ("-i", "--ipath"):
             input_dir_string = current_value
         elif current_argument in ("-o", "--opath"):
             output_dir_string = current_value
+        elif current_argument in ("-r", "--roi"):
+            roi_string = current_value
+        elif current_argument in ("-q", "--quality"):
+            quality = current_value
+        elif current_argument in ("-s", "--scale"):
+            output_scale = float(current_value)
+        elif current_argument in ("-m", "--memory"):
+            memory_budget = int(float(current_value)*1e9)
+        elif current_argument in ("-a", "--affine"):
+            affine_export = True
         
     if (input_dir_string == ''):
         print('Input parse error.')
         sys.exit(2)
+    if quality not in QUALITY_MODES:
+        print('Quality parse error. Use one of '+', '.join(QUALITY_MODES)+'.')
+        sys.exit(2)
 
     # Load data
     # this approach assumes data is generated by QI2lab MM script
@@ -143,135 +78,130 @@ def main(argv):
     # Create Path object to directory
     input_dir_path=Path(input_dir_string)
 
-    # Parse directory for number of channels and strip positions then sort
-    sub_dirs = [x for x in input_dir_path.iterdir() if x.is_dir()]
-    sub_dirs = natsorted(sub_dirs, alg=ns.PATH)
-
-    # TO DO: automatically determine number of channels and tile positions
-    num_channels=1
-    num_tiles=1
-
     # create parameter array
     # [theta, stage move distance, camera pixel size]
     # units are [degrees,nm,nm]
+    # used unless the acquisition recorded its own
     params=np.array([30,100,116],dtype=np.float32)
 
+    # channels, tiles, and frame files of every strip come from the acquisition manifest.
+    # Experiments acquired without one are indexed once and the manifest is saved for the next run.
+    manifest = load_manifest(input_dir_path, params=params)
+    params = np.array(manifest['params'],dtype=np.float32)
+    strips = manifest_strips(manifest)
+    # strips are written to the BDV file by the index of their channel and (height, tile) position, so any channel and
+    # tile IDs map to consecutive BDV channels and tiles
+    num_channels = manifest_counts(manifest)[0]
+    tiles = manifest_tiles(manifest)
+    num_tiles = len(tiles)
+
     # check if user provided output path
     if (output_dir_string==''):
         output_dir_path = input_dir_path
     else:
         output_dir_path = Path(output_dir_string)
 
+    # quick-look mode. only deskew a small box of every strip.
+    if (roi_string != ''):
+        roi_um = [float(value) for value in roi_string.split(',')]
+        if len(roi_um) != 6:
+            print('ROI parse error. Expected scan0,scan1,height0,height1,x0,x1 in um.')
+            sys.exit(2)
+        roi_recon(input_dir_path, manifest, output_dir_path, params, roi_um, quality, output_scale)
+        return
+
+    # export mode. raw data is copied as-is and BigStitcher applies the deskew at fusion time.
+    if affine_export:
+        affine_recon(input_dir_path, manifest, output_dir_path, params)
+        return
+
+    # deskewed strips are streamed in slabs of slab_ny output rows along the scan axis.
+    # memory use is set by slab_ny, not by the length of the strip, so pick the widest slab that fits the RAM budget.
+    # BDV sub-sampling levels are shared by the memory planner and the writer.
+    subsamp = ((1,1,1),(4,8,4),(8,16,8),)
+
+    # frames are read this far ahead of the deskew, and each slab is written while the next one is deskewed
+    prefetch_frames = 256
+
+    # all strips in an experiment have the same camera ROI. Slabs are planned for the longest strip, whose number of
+    # slabs sets the BDV tiles reserved for every strip.
+    memory_plan = plan_stream_slabs(max([strip['frames'] for strip in strips]), tuple(manifest['frame_shape']), params, num_channels=num_channels, dtype=manifest['dtype'], \
+        z_bin=2, output_dtype=np.uint16, quality=quality, subsamp=subsamp, budget_bytes=memory_budget, prefetch_frames=prefetch_frames)
+    print_memory_plan(memory_plan)
+    slab_ny = memory_plan.blocks[0][1]-memory_plan.blocks[0][0]
+    num_slabs = memory_plan.num_blocks
+
     # https://github.com/nvladimus/npy2bdv
     # create BDV H5 file with sub-sampling for BigStitcher
     # TO DO: modify npy2bdv to support B3D compression, https://git.embl.de/balazs/B3D
     #        this may involve change the underlying hdf5 install that h5py is using
+    # views are written by a background thread while the next slab is deskewed. The memory plan counts one slab of
+    # every channel being written, so the writer queues no more than that.
     output_path = output_dir_path / 'deskewed.h5'
-    bdv_writer = npy2bdv.BdvWriter(str(output_path), nchannels=num_channels, ntiles=2*num_tiles+1, \
-        subsamp=((1,1,1),(4,8,4),(8,16,8),),blockdim=((16, 32, 16),))
-
-    # loop over each directory. Each directory will be placed as a "tile" into the BigStitcher file
-    # TO DO: implement directory polling to do this in the background while data is being acquired.
-    for sub_dir in sub_dirs:
+    pipeline_stats = {}
+    bdv_writer = BackgroundBdvWriter(npy2bdv.BdvWriter(str(output_path), nchannels=num_channels, ntiles=num_slabs*num_tiles, \
+        subsamp=subsamp,blockdim=((16, 32, 16),)), max_bytes=memory_plan.binned_bytes//2, stats=pipeline_stats, name='write')
 
-        # determine the channel this directory corresponds to
-        m = re.search('ch(\d+)', str(sub_dir), re.IGNORECASE)
-        channel_id = int(m.group(1))
-<<<<<<< HEAD
-        if channel_id>0:
-            channel_id=channel_id-2
-=======
->>>>>>> 61b0d296d03490c8c58bce26f17691658e53064e
+    # queue every channel of one deskewed slab for writing
+    def write_slab(tile_id, slab_id, y_offset, channel_ids, deskewed_channels):
 
-        # determine the experimental tile this directory corresponds to
-        m = re.search('y(\d+)', str(sub_dir), re.IGNORECASE)
-        tile_id = int(m.group(1))
+        print('Writing deskewed slab '+str(slab_id+1)+' of '+str(num_slabs)+'.')
 
-        # output metadata information to console
-        print('Channel ID: '+str(channel_id)+'; Experimental tile ID: '+str(tile_id)+ \
-            '; BDV tile IDs: '+str(2*tile_id)+' & '+str(2*tile_id+1))
-        
-        # find all individual tif files in the current channel + tile sub directory and sort 
-        files = natsorted(sub_dir.glob('*.tif'), alg=ns.PATH)
+        # slabs are seamless, so place each one at its exact scan offset instead of relying on overlap
+        affine_matrix = np.array(((1.0, 0.0, 0.0, 0.0),
+                                  (0.0, 1.0, 0.0, float(y_offset)),
+                                  (0.0, 0.0, 1.0, 0.0)))
 
-        # reverse file list so that tilt angle is along reconstruction direction 
-<<<<<<< HEAD
-       # files.reverse()
+        # write BDV tile for every channel
+        # https://github.com/nvladimus/npy2bdv 
+        for channel_id, deskewed_downsample in zip(channel_ids, deskewed_channels):
+            bdv_writer.append_view(deskewed_downsample, time=0, channel=channel_id, tile=num_slabs*tile_id+slab_id, \
+                m_affine=affine_matrix, name_affine='slab translation', \
+                voxel_size_xyz=(.116,.116,.116), voxel_units='um')
 
-        # find middle of tilted plane acquisition
-        split = len(files)//2
-        overlap = np.int64(np.floor(2*split*.1))
+    # group the channel directories of each experimental tile. All channels of a strip share the scan geometry,
+    # so they are deskewed together in one pass over the interpolation plan.
+    tile_strips = {}
+    for strip in strips:
+        tile_strips.setdefault(tiles.index((strip['height'], strip['tile'])), []).append(strip)
 
-        print('Deskew block 1.')
-        # read in first block of data with a small overlap for alignment in BigStitcher
-        #sub_stack = np.asarray([io.imread(file, plugin='pil') for file in files[0:split+overlap]],dtype=np.float32)
-=======
-        files.reverse()
+    # reading, deskewing, and writing overlap. The stage timings show which one limits the reconstruction.
+    pipeline_start = time.perf_counter()
 
-        # find middle of tilted plane acquisition
-        split = len(files)//2
-        overlap = np.int64(np.floor(2*split*.05))
+    # loop over each experimental tile. Each slab of each channel will be placed as a "tile" into the BigStitcher file
+    # TO DO: implement directory polling to do this in the background while data is being acquired.
+    for tile_id, channel_strips in sorted(tile_strips.items()):
 
-        print('Deskew block 1.')
-        # read in first block of data with a small overlap for alignment in BigStitcher
->>>>>>> 61b0d296d03490c8c58bce26f17691658e53064e
-        sub_stack = np.asarray([io.imread(file) for file in files[0:split+overlap]],dtype=np.float32)
+        # determine the BDV channel of every channel of the strips, in the order they are stacked
+        channel_ids = []
+        for strip in channel_strips:
+            channel_ids.extend(strip_channel_indices(manifest, strip))
 
-        # run deskew for the first block of data
-        deskewed = stage_deskew(data=sub_stack,parameters=params)
-        del sub_stack
+        # output metadata information to console
+        print('Channel IDs: '+str(channel_ids)+'; Experimental tile ID: '+str(channel_strips[0]['tile'])+ \
+            '; height ID: '+str(channel_strips[0]['height'])+ \
+            '; BDV tile IDs: '+str(num_slabs*tile_id)+' - '+str(num_slabs*tile_id+num_slabs-1))
+        
+        # raw frames of each channel strip of the current tile, from their packed containers if they have one
+        sources = [open_strip(input_dir_path, strip) for strip in channel_strips]
 
-        # downsample by 2x in z due to oversampling when going from OPM to coverslip geometry
-        deskewed_downsample = block_reduce(deskewed,block_size=(2,1,1),func=np.mean)
-        del deskewed
-        gc.collect()
+        # reverse file list so that tilt angle is along reconstruction direction 
+       # files.reverse()
 
-        print('Writing deskewed block 1.')
-        # write BDV tile
-        # https://github.com/nvladimus/npy2bdv 
-<<<<<<< HEAD
-        bdv_writer.append_view(deskewed_downsample, time=0, channel=channel_id, tile=2*tile_id, \
-            voxel_size_xyz=(.116,.116,.116), voxel_units='um')
-=======
-        bdv_writer.append_view(deskewed_downsample, time=0, channel=0, tile=2*tile_id, \
-            voxel_size_xyz=(.116,.100,.116), voxel_units='um')
->>>>>>> 61b0d296d03490c8c58bce26f17691658e53064e
-
-        # free up memory
-        del deskewed_downsample
-        gc.collect()
-
-        print('Deskew block 2.')
-        # read in second block of data with a small overlap for alignment in BigStitcher
-<<<<<<< HEAD
-        #sub_stack = np.asarray([io.imread(file, plugin='pil') for file in files[split-overlap:]],dtype=np.float32)
-=======
->>>>>>> 61b0d296d03490c8c58bce26f17691658e53064e
-        sub_stack = np.asarray([io.imread(file) for file in files[split-overlap:]],dtype=np.float32)
-
-        # run deskew for the second block of data
-        deskewed = stage_deskew(data=sub_stack,parameters=params)
-        del sub_stack
+        # frames are read in the background, one chunk of the strip at a time, as (channel, y, x) frames
+        frames = prefetch(iter_strip_frames(sources), depth=prefetch_frames, stats=pipeline_stats, name='read')
 
+        # run deskew over the whole strip
         # downsample by 2x in z due to oversampling when going from OPM to coverslip geometry
-        deskewed_downsample = block_reduce(deskewed,block_size=(2,1,1),func=np.mean)
-        del deskewed
-        gc.collect()
+        for y_offset, deskewed_channels in stage_deskew_stream(frames, min([source.num_frames for source in sources]), params, slab_ny=slab_ny, z_bin=2, quality=quality, \
+            output_dtype=np.uint16, scale=output_scale):
 
-        print('Writing deskewed block 2.')
-        # write BDV tile
-        # https://github.com/nvladimus/npy2bdv 
-<<<<<<< HEAD
-        bdv_writer.append_view(deskewed_downsample, time=0, channel=channel_id, tile=2*tile_id+1, \
-            voxel_size_xyz=(.116,.116,.116), voxel_units='um')
-=======
-        bdv_writer.append_view(deskewed_downsample, time=0, channel=0, tile=2*tile_id+1, \
-            voxel_size_xyz=(.116,.100,.116), voxel_units='um')
->>>>>>> 61b0d296d03490c8c58bce26f17691658e53064e
-
-        # free up memory
-        del deskewed_downsample
-        gc.collect()
+            write_slab(tile_id, y_offset//slab_ny, y_offset, channel_ids, deskewed_channels)
+            del deskewed_channels
+
+    # wait for the last slab to be written
+    bdv_writer.flush()
+    print_pipeline_report(pipeline_stats, time.perf_counter()-pipeline_start)
 
     # write BDV xml file
     # https://github.com/nvladimus/npy2bdv
@@ -282,6 +212,91 @@ def main(argv):
     gc.collect()
 
 
+# deskew the same physical box out of every strip and save as a small BDV H5 file
+def roi_recon(input_dir_path, manifest, output_dir_path, params, roi_um, quality, output_scale):
+
+    tiles = manifest_tiles(manifest)
+
+    # boxes are written in the background while the next one is read and deskewed
+    output_path = output_dir_path / 'deskewed_roi.h5'
+    bdv_writer = BackgroundBdvWriter(npy2bdv.BdvWriter(str(output_path), nchannels=manifest_counts(manifest)[0], ntiles=len(tiles), \
+        subsamp=((1,1,1),),blockdim=((16, 32, 16),)))
+
+    for strip in manifest_strips(manifest):
+
+        # determine the BDV tile this strip corresponds to
+        tile_id = tiles.index((strip['height'], strip['tile']))
+        source = open_strip(input_dir_path, strip)
+
+        # every channel of the strip is its own view
+        for source_channel, channel_id in enumerate(strip_channel_indices(manifest, strip)):
+
+            if source.layout == 'tiff':
+                files, read_frames = source.source, None
+            else:
+                # frames of a packed container, NDTiff dataset, or BDV view are read as one cropped block
+                files = range(source.num_frames)
+                read_frames = lambda first, last, rows, cols, c=source_channel: read_strip_region(source, first, last+1, rows, cols, channel=c)[0]
+
+            # only the frames and camera rows under the box are read from disk
+            deskewed_roi, origin, raw_roi = stage_deskew_roi(files, params, roi_um[0:2], roi_um[2:4], roi_um[4:6], z_bin=2, quality=quality, \
+                output_dtype=np.uint16, scale=output_scale, read_frames=read_frames, frame_shape=source.frame_shape)
+            if raw_roi is None:
+                print('Channel ID: '+str(channel_id)+'; BDV tile ID: '+str(tile_id)+'; ROI is outside of the strip.')
+                continue
+            print('Channel ID: '+str(channel_id)+'; BDV tile ID: '+str(tile_id)+ \
+                '; frames '+str(raw_roi[0][0])+' - '+str(raw_roi[0][1])+' of '+str(len(files))+ \
+                '; camera rows '+str(raw_roi[1][0])+' - '+str(raw_roi[1][1])+'.')
+
+            # place the box at its position in the full deskewed strip
+            affine_matrix = np.array(((1.0, 0.0, 0.0, float(origin[2])),
+                                      (0.0, 1.0, 0.0, float(origin[1])),
+                                      (0.0, 0.0, 1.0, float(origin[0]))))
+
+            bdv_writer.append_view(deskewed_roi, time=0, channel=channel_id, tile=tile_id, \
+                m_affine=affine_matrix, name_affine='roi translation', \
+                voxel_size_xyz=(.116,.116,.116), voxel_units='um')
+
+    bdv_writer.write_xml_file(ntimes=1)
+    bdv_writer.close()
+
+
+# write raw strips as-is into a BDV H5 file, with the deskew shear as each view's affine registration
+def affine_recon(input_dir_path, manifest, output_dir_path, params):
+
+    tiles = manifest_tiles(manifest)
+
+    # views are filled plane by plane, which npy2bdv only supports with in-plane (y, x) subsampling
+    output_path = output_dir_path / 'raw_affine.h5'
+    bdv_writer = npy2bdv.BdvWriter(str(output_path), nchannels=manifest_counts(manifest)[0], ntiles=len(tiles), \
+        subsamp=((1,1,1),(1,4,4),(1,8,8),),blockdim=((16, 32, 16),))
+
+    # raw voxel (camera column, camera row, frame) to deskewed camera pixels (x, scan, height)
+    affine_matrix = deskew_affine(params)
+
+    for strip in manifest_strips(manifest):
+
+        # determine the BDV channels and tile this strip corresponds to
+        channel_ids = strip_channel_indices(manifest, strip)
+        tile_id = tiles.index((strip['height'], strip['tile']))
+
+        source = open_strip(input_dir_path, strip)
+        print('Channel IDs: '+str(channel_ids)+'; BDV tile ID: '+str(tile_id)+'; copying '+str(source.num_frames)+' raw frames.')
+
+        # allocate the views, then stream frames straight from the TIFF files or packed container into them
+        for channel_id in channel_ids:
+            bdv_writer.append_view(stack=None, virtual_stack_dim=(source.num_frames,)+tuple(source.frame_shape), \
+                time=0, channel=channel_id, tile=tile_id, \
+                m_affine=affine_matrix, name_affine='deskew shear', \
+                voxel_size_xyz=(.116,.116,.116), voxel_units='um')
+        for z, frame in enumerate(iter_strip_frames([source])):
+            for source_channel, channel_id in enumerate(channel_ids):
+                bdv_writer.append_plane(plane=frame[source_channel], z=z, time=0, channel=channel_id, tile=tile_id)
+
+    bdv_writer.write_xml_file(ntimes=1)
+    bdv_writer.close()
+
+
 # run
 if __name__ == "__main__":
     main(sys.argv[1:])
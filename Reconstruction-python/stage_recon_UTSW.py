@@ -11,102 +11,15 @@ Shepherd 09/20
 # imports
 import numpy as np
 from pathlib import Path
-from natsort import natsorted, ns
 import npy2bdv
 import gc
 import sys
 import getopt
-import re
-import skimage.io as io
-from skimage.measure import block_reduce
 import time
-from numba import njit, prange
-
-# perform OPM reconstruction using orthogonal interpolation
-# http://numba.pydata.org/numba-doc/latest/user/parallel.html#numba-parallel
-@njit(parallel=True)
-def stage_deskew(data,parameters):
-
-    # unwrap parameters 
-    theta = parameters[0]             # (degrees)
-    distance = parameters[1]          # (nm)
-    pixel_size = parameters[2]        # (nm)
-    [num_images,ny,nx]=data.shape  # (pixels)
-
-
-    # change step size from physical space (nm) to camera space (pixels)
-    pixel_step = distance/pixel_size    # (pixels)
-
-    # calculate the number of pixels scanned during stage scan 
-    scan_end = num_images * pixel_step  # (pixels)
-
-    # calculate properties for final image
-    final_ny = np.int64(np.ceil(scan_end+ny*np.cos(theta*np.pi/180))) # (pixels)
-    final_nz = np.int64(np.ceil(ny*np.sin(theta*np.pi/180)))          # (pixels)
-    final_nx = np.int64(nx)                                           # (pixels)
-
-    # create final image
-    output = np.zeros((final_nz, final_ny, final_nx),dtype=np.float32)  # (pixels,pixels,pixels - data is float32)
-
-    # precalculate trig functions for scan angle
-    tantheta = np.float32(np.tan(theta * np.pi/180)) # (float32)
-    sintheta = np.float32(np.sin(theta * np.pi/180)) # (float32)
-    costheta = np.float32(np.cos(theta * np.pi/180)) # (float32)
-
-    # perform orthogonal interpolation
-
-    # loop through output z planes
-    # defined as parallel loop in numba
-    # http://numba.pydata.org/numba-doc/latest/user/parallel.html#numba-parallel
-    for z in prange(0,final_nz):
-        # calculate range of output y pixels to populate
-        y_range_min=np.minimum(0,np.int64(np.floor(np.float32(z)/tantheta)))
-        y_range_max=np.maximum(final_ny,np.int64(np.ceil(scan_end+np.float32(z)/tantheta+1)))
-
-        # loop through final y pixels
-        # defined as parallel loop in numba
-        # http://numba.pydata.org/numba-doc/latest/user/parallel.html#numba-parallel
-        for y in prange(y_range_min,y_range_max):
-
-            # find the virtual tilted plane that intersects the interpolated plane 
-            virtual_plane = y - z/tantheta
-
-            # find raw data planes that surround the virtual plane
-            plane_before = np.int64(np.floor(virtual_plane/pixel_step))
-            plane_after = np.int64(plane_before+1)
-
-            # continue if raw data planes are within the data range
-            if ((plane_before>=0) and (plane_after<num_images)):
-                
-                # find distance of a point on the  interpolated plane to plane_before and plane_after
-                l_before = virtual_plane - plane_before * pixel_step
-                l_after = pixel_step - l_before
-                
-                # determine location of a point along the interpolated plane
-                za = z/sintheta
-                virtual_pos_before = za + l_before*costheta
-                virtual_pos_after = za - l_after*costheta
-
-                # determine nearest data points to interpoloated point in raw data
-                pos_before = np.int64(np.floor(virtual_pos_before))
-                pos_after = np.int64(np.floor(virtual_pos_after))
-
-                # continue if within data bounds
-                if ((pos_before>=0) and (pos_after >= 0) and (pos_before<ny-1) and (pos_after<ny-1)):
-                    
-                    # determine points surrounding interpolated point on the virtual plane 
-                    dz_before = virtual_pos_before - pos_before
-                    dz_after = virtual_pos_after - pos_after
-
-                    # compute final image plane using orthogonal interpolation
-                    output[z,y,:] = (l_before * dz_after * data[plane_after,pos_after+1,:] + \
-                                    l_before * (1-dz_after) * data[plane_after,pos_after,:] + \
-                                    l_after * dz_before * data[plane_before,pos_before+1,:] + \
-                                    l_after * (1-dz_before) * data[plane_before,pos_before,:]) /pixel_step
-
-
-    # return output
-    return output
+from deskew_engine import stage_deskew, QUALITY_MODES
+from opm_io import open_strip, read_strip
+from opm_manifest import load_manifest, manifest_strips, manifest_tiles
+from opm_pipeline import BackgroundBdvWriter
 
 # parse experimental directory, load data, perform orthogonal deskew, and save as BDV H5 file
 def main(argv):
@@ -114,24 +27,33 @@ def main(argv):
     # parse directory name from command line argument 
     input_dir_string = ''
     output_dir_string = ''
+    quality = 'orthogonal'
+    output_scale = 1.0
 
     try:
-        arguments, values = getopt.getopt(argv,"hi:o:n:c:",["help","ipath=","opath="])
+        arguments, values = getopt.getopt(argv,"hi:o:n:c:q:s:",["help","ipath=","opath=","quality=","scale="])
     except getopt.GetoptError:
-        print('Error. stage_recon.py -i <inputdirectory> -o <outputdirectory>')
+        print('Error. stage_recon.py -i <inputdirectory> -o <outputdirectory> -q <nearest|orthogonal|cubic> -s <output scale>')
         sys.exit(2)
     for current_argument, current_value in arguments:
         if current_argument == '-h':
-            print('Usage. stage_recon.py -i <inputdirectory> -o <outputdirectory>')
+            print('Usage. stage_recon.py -i <inputdirectory> -o <outputdirectory> -q <nearest|orthogonal|cubic> -s <output scale>')
             sys.exit()
         elif current_argument in ("-i", "--ipath"):
             input_dir_string = current_value
         elif current_argument in ("-o", "--opath"):
             output_dir_string = current_value
+        elif current_argument in ("-q", "--quality"):
+            quality = current_value
+        elif current_argument in ("-s", "--scale"):
+            output_scale = float(current_value)
         
     if (input_dir_string == ''):
         print('Input parse error.')
         sys.exit(2)
+    if quality not in QUALITY_MODES:
+        print('Quality parse error. Use one of '+', '.join(QUALITY_MODES)+'.')
+        sys.exit(2)
 
     # Load data
 
@@ -139,19 +61,22 @@ def main(argv):
     # Create Path object to directory
     input_dir_path=Path(input_dir_string)
 
-    # Parse directory for number of channels and strip positions then sort
-    sub_dirs = [x for x in input_dir_path.iterdir() if x.is_dir()]
-    sub_dirs = natsorted(sub_dirs, alg=ns.PATH)
-
-    # TO DO: automatically determine number of channels and tile positions
-    num_channels=1
-    num_tiles=1
-
     # create parameter array
     # [theta, stage move distance, camera pixel size]
     # units are [degrees,nm,nm]
+    # used unless the acquisition recorded its own
     params=np.array([60,250,115],dtype=np.float32)
 
+    # channels, tiles, and frame files of every strip come from the acquisition manifest.
+    # Experiments acquired without one are indexed once and the manifest is saved for the next run.
+    manifest = load_manifest(input_dir_path, params=params)
+    params = np.array(manifest['params'],dtype=np.float32)
+    strips = manifest_strips(manifest)
+    # only channel 0 is reconstructed
+    num_channels=1
+    tiles=manifest_tiles(manifest, channel=0)
+    num_tiles=len(tiles)
+
     # check if user provided output path
     if (output_dir_string==''):
         output_dir_path = input_dir_path
@@ -161,35 +86,34 @@ def main(argv):
     # https://github.com/nvladimus/npy2bdv
     # create BDV H5 file with sub-sampling for BigStitcher
     output_path = output_dir_path / 'deskewed_ch0.h5'
-    bdv_writer = npy2bdv.BdvWriter(str(output_path), nchannels=num_channels, ntiles=2*num_tiles+1, \
-        subsamp=((1,1,1),(4,8,4),(8,16,8),),blockdim=((16, 32, 16),))
+    # strips are written by a background thread while the next one is read and deskewed
+    bdv_writer = BackgroundBdvWriter(npy2bdv.BdvWriter(str(output_path), nchannels=num_channels, ntiles=2*num_tiles+1, \
+        subsamp=((1,1,1),(4,8,4),(8,16,8),),blockdim=((16, 32, 16),)))
 
-    # loop over each directory. Each directory will be placed as a "tile" into the BigStitcher file
-    for sub_dir in sub_dirs:
+    # loop over each strip. Each strip will be placed as a "tile" into the BigStitcher file
+    for strip in strips:
 
-        # determine the channel this directory corresponds to
-        m = re.search('ch(\d+)', str(sub_dir), re.IGNORECASE)
-        channel_id = int(m.group(1))
+        # determine the channel this strip corresponds to
+        channel_id = strip['channel']
 
         if channel_id == 0:
 
-            # determine the experimental tile this directory corresponds to
-            m = re.search('y(\d+)', str(sub_dir), re.IGNORECASE)
-            tile_id = int(m.group(1))
+            # determine the experimental tile this strip corresponds to, numbered by its position in the manifest
+            tile_id = tiles.index((strip['height'], strip['tile']))
             
             # output metadata information to console
-            print('Channel ID: '+str(channel_id)+'; Experimental tile ID: '+str(tile_id)+ \
+            print('Channel ID: '+str(channel_id)+'; Experimental tile ID: '+str(strip['tile'])+ \
                 '; BDV tile IDs: '+str(2*tile_id)+' & '+str(2*tile_id+1))
             
-            # find all individual tif files in the current channel + tile sub directory and sort 
-            files = natsorted(sub_dir.glob('*.tif'), alg=ns.PATH)
+            # raw frames of the current channel + tile strip, from its packed container if it has one
+            source = open_strip(input_dir_path, strip)
         
             print('Deskew data.')
             # read in data
-            sub_stack = np.asarray([io.imread(file) for file in files], dtype=np.float32)
+            sub_stack = read_strip(source, report=True)[0]
 
             # run deskew
-            deskewed = stage_deskew(data=sub_stack,parameters=params)
+            deskewed = stage_deskew(data=sub_stack,parameters=params,quality=quality,output_dtype=np.uint16,scale=output_scale)
             del sub_stack
 
             print('Writing deskewed data.')
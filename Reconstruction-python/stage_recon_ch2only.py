@@ -11,102 +11,16 @@ Shepherd 03/20
 # imports
 import numpy as np
 from pathlib import Path
-from natsort import natsorted, ns
 import npy2bdv
 import gc
 import sys
 import getopt
-import re
-import skimage.io as io
-from skimage.measure import block_reduce
 import time
-from numba import njit, prange
-
-# perform stage scanning reconstruction using orthogonal interpolation
-# http://numba.pydata.org/numba-doc/latest/user/parallel.html#numba-parallel
-@njit(parallel=True)
-def stage_deskew(data,parameters):
-
-    # unwrap parameters 
-    theta = parameters[0]             # (degrees)
-    distance = parameters[1]          # (nm)
-    pixel_size = parameters[2]        # (nm)
-    [num_images,ny,nx]=data.shape  # (pixels)
-
-
-    # change step size from physical space (nm) to camera space (pixels)
-    pixel_step = distance/pixel_size    # (pixels)
-
-    # calculate the number of pixels scanned during stage scan 
-    scan_end = num_images * pixel_step  # (pixels)
-
-    # calculate properties for final image
-    final_ny = np.int64(np.ceil(scan_end+ny*np.cos(theta*np.pi/180))) # (pixels)
-    final_nz = np.int64(np.ceil(ny*np.sin(theta*np.pi/180)))          # (pixels)
-    final_nx = np.int64(nx)                                           # (pixels)
-
-    # create final image
-    output = np.zeros((final_nz, final_ny, final_nx),dtype=np.float32)  # (pixels,pixels,pixels - data is float32)
-
-    # precalculate trig functions for scan angle
-    tantheta = np.float32(np.tan(theta * np.pi/180)) # (float32)
-    sintheta = np.float32(np.sin(theta * np.pi/180)) # (float32)
-    costheta = np.float32(np.cos(theta * np.pi/180)) # (float32)
-
-    # perform orthogonal interpolation
-
-    # loop through output z planes
-    # defined as parallel loop in numba
-    # http://numba.pydata.org/numba-doc/latest/user/parallel.html#numba-parallel
-    for z in prange(0,final_nz):
-        # calculate range of output y pixels to populate
-        y_range_min=np.minimum(0,np.int64(np.floor(np.float32(z)/tantheta)))
-        y_range_max=np.maximum(final_ny,np.int64(np.ceil(scan_end+np.float32(z)/tantheta+1)))
-
-        # loop through final y pixels
-        # defined as parallel loop in numba
-        # http://numba.pydata.org/numba-doc/latest/user/parallel.html#numba-parallel
-        for y in prange(y_range_min,y_range_max):
-
-            # find the virtual tilted plane that intersects the interpolated plane 
-            virtual_plane = y - z/tantheta
-
-            # find raw data planes that surround the virtual plane
-            plane_before = np.int64(np.floor(virtual_plane/pixel_step))
-            plane_after = np.int64(plane_before+1)
-
-            # continue if raw data planes are within the data range
-            if ((plane_before>=0) and (plane_after<num_images)):
-                
-                # find distance of a point on the  interpolated plane to plane_before and plane_after
-                l_before = virtual_plane - plane_before * pixel_step
-                l_after = pixel_step - l_before
-                
-                # determine location of a point along the interpolated plane
-                za = z/sintheta
-                virtual_pos_before = za + l_before*costheta
-                virtual_pos_after = za - l_after*costheta
-
-                # determine nearest data points to interpoloated point in raw data
-                pos_before = np.int64(np.floor(virtual_pos_before))
-                pos_after = np.int64(np.floor(virtual_pos_after))
-
-                # continue if within data bounds
-                if ((pos_before>=0) and (pos_after >= 0) and (pos_before<ny-1) and (pos_after<ny-1)):
-                    
-                    # determine points surrounding interpolated point on the virtual plane 
-                    dz_before = virtual_pos_before - pos_before
-                    dz_after = virtual_pos_after - pos_after
-
-                    # compute final image plane using orthogonal interpolation
-                    output[z,y,:] = (l_before * dz_after * data[plane_after,pos_after+1,:] + \
-                                    l_before * (1-dz_after) * data[plane_after,pos_after,:] + \
-                                    l_after * dz_before * data[plane_before,pos_before+1,:] + \
-                                    l_after * (1-dz_before) * data[plane_before,pos_before,:]) /pixel_step
-
-
-    # return output
-    return output
+from deskew_engine import stage_deskew, QUALITY_MODES
+from opm_io import open_strip, read_strip
+from opm_manifest import load_manifest, manifest_strips, manifest_tiles
+from memory_planner import plan_frame_blocks, block_ranges, print_memory_plan
+from opm_pipeline import BackgroundBdvWriter
 
 # parse experimental directory, load data, perform orthogonal deskew, and save as BDV H5 file
 def main(argv):
@@ -114,24 +28,36 @@ def main(argv):
     # parse directory name from command line argument 
     input_dir_string = ''
     output_dir_string = ''
+    quality = 'orthogonal'
+    output_scale = 1.0
+    memory_budget = None
 
     try:
-        arguments, values = getopt.getopt(argv,"hi:o:n:c:",["help","ipath=","opath="])
+        arguments, values = getopt.getopt(argv,"hi:o:n:c:q:s:m:",["help","ipath=","opath=","quality=","scale=","memory="])
     except getopt.GetoptError:
-        print('Error. stage_recon.py -i <inputdirectory> -o <outputdirectory>')
+        print('Error. stage_recon.py -i <inputdirectory> -o <outputdirectory> -q <nearest|orthogonal|cubic> -s <output scale> -m <RAM budget in GB>')
         sys.exit(2)
     for current_argument, current_value in arguments:
         if current_argument == '-h':
-            print('Usage. stage_recon.py -i <inputdirectory> -o <outputdirectory>')
+            print('Usage. stage_recon.py -i <inputdirectory> -o <outputdirectory> -q <nearest|orthogonal|cubic> -s <output scale> -m <RAM budget in GB>')
             sys.exit()
         elif current_argument in ("-i", "--ipath"):
             input_dir_string = current_value
         elif current_argument in ("-o", "--opath"):
             output_dir_string = current_value
+        elif current_argument in ("-q", "--quality"):
+            quality = current_value
+        elif current_argument in ("-s", "--scale"):
+            output_scale = float(current_value)
+        elif current_argument in ("-m", "--memory"):
+            memory_budget = int(float(current_value)*1e9)
         
     if (input_dir_string == ''):
         print('Input parse error.')
         sys.exit(2)
+    if quality not in QUALITY_MODES:
+        print('Quality parse error. Use one of '+', '.join(QUALITY_MODES)+'.')
+        sys.exit(2)
 
     # Load data
     # this approach assumes data is generated by QI2lab MM script
@@ -143,111 +69,95 @@ def main(argv):
     # Create Path object to directory
     input_dir_path=Path(input_dir_string)
 
-    # Parse directory for number of channels and strip positions then sort
-    sub_dirs = [x for x in input_dir_path.iterdir() if x.is_dir()]
-    sub_dirs = natsorted(sub_dirs, alg=ns.PATH)
-
-    # TO DO: automatically determine number of channels and tile positions
-    num_channels=1
-    num_tiles=79
-
     # create parameter array
     # [theta, stage move distance, camera pixel size]
     # units are [degrees,nm,nm]
+    # used unless the acquisition recorded its own
     params=np.array([30,100,116],dtype=np.float32)
 
+    # channels, tiles, and frame files of every strip come from the acquisition manifest.
+    # Experiments acquired without one are indexed once and the manifest is saved for the next run.
+    manifest = load_manifest(input_dir_path, params=params)
+    params = np.array(manifest['params'],dtype=np.float32)
+    strips = manifest_strips(manifest)
+    # only channel 3 is reconstructed
+    num_channels=1
+    tiles=manifest_tiles(manifest, channel=3)
+    num_tiles=len(tiles)
+
     # check if user provided output path
     if (output_dir_string==''):
         output_dir_path = input_dir_path
     else:
         output_dir_path = Path(output_dir_string)
 
+    # all strips have the same camera ROI and are planned for the longest one. Split each strip into the fewest
+    # overlapping blocks of frames that fit in the RAM budget, with the previous block still being written while the
+    # next one is read and deskewed.
+    # BDV sub-sampling levels are shared by the memory planner and the writer.
+    subsamp = ((1,1,1),(4,8,4),(8,16,8),)
+    memory_plan = plan_frame_blocks(max([strip['frames'] for strip in strips]), tuple(manifest['frame_shape']), params, dtype=manifest['dtype'], z_bin=2, \
+        output_dtype=np.uint16, quality=quality, subsamp=subsamp, overlap=0.2, budget_bytes=memory_budget, \
+        pipelined=True)
+    print_memory_plan(memory_plan)
+    num_blocks = memory_plan.num_blocks
+
     # https://github.com/nvladimus/npy2bdv
     # create BDV H5 file with sub-sampling for BigStitcher
     # TO DO: modify npy2bdv to support B3D compression, https://git.embl.de/balazs/B3D
     #        this may involve change the underlying hdf5 install that h5py is using
     output_path = output_dir_path / 'deskewed_ch1.h5'
-    bdv_writer = npy2bdv.BdvWriter(str(output_path), nchannels=num_channels, ntiles=2*num_tiles+1, \
-        subsamp=((1,1,1),(4,8,4),(8,16,8),),blockdim=((16, 32, 16),))
+    # views are written by a background thread, one block at a time, while the next block is deskewed
+    bdv_writer = BackgroundBdvWriter(npy2bdv.BdvWriter(str(output_path), nchannels=num_channels, ntiles=num_blocks*num_tiles+1, \
+        subsamp=subsamp,blockdim=((16, 32, 16),)), max_bytes=memory_plan.binned_bytes//2)
 
-    # loop over each directory. Each directory will be placed as a "tile" into the BigStitcher file
+    # loop over each strip. Each strip will be placed as a "tile" into the BigStitcher file
     # TO DO: implement directory polling to do this in the background while data is being acquired.
-    for sub_dir in sub_dirs:
+    for strip in strips:
 
-        # determine the channel this directory corresponds to
-        m = re.search('ch(\d+)', str(sub_dir), re.IGNORECASE)
-        channel_id = int(m.group(1))
+        # determine the channel this strip corresponds to
+        channel_id = strip['channel']
 
         if channel_id == 3:
 
-            channel_id = channel_id-3
+            # the only channel of the BDV file
+            channel_id = 0
 
-            # determine the experimental tile this directory corresponds to
-            m = re.search('y(\d+)', str(sub_dir), re.IGNORECASE)
-            tile_id = int(m.group(1))
-            tile_id=tile_id-7
+            # determine the experimental tile this strip corresponds to, numbered by its position in the manifest
+            tile_id = tiles.index((strip['height'], strip['tile']))
 
             # output metadata information to console
-            print('Channel ID: '+str(channel_id)+'; Experimental tile ID: '+str(tile_id)+ \
-                '; BDV tile IDs: '+str(2*tile_id)+' & '+str(2*tile_id+1))
+            print('Channel ID: '+str(channel_id)+'; Experimental tile ID: '+str(strip['tile'])+ \
+                '; BDV tile IDs: '+str(num_blocks*tile_id)+' - '+str(num_blocks*tile_id+num_blocks-1))
             
-            # find all individual tif files in the current channel + tile sub directory and sort 
-            files = natsorted(sub_dir.glob('*.tif'), alg=ns.PATH)
-
-            # reverse file list so that tilt angle is along reconstruction direction 
-        # files.reverse()
-
-            # find middle of tilted plane acquisition
-            split = len(files)//2
-            overlap = np.int64(np.floor(2*split*.1))
-
-            print('Deskew block 1.')
-            # read in first block of data with a small overlap for alignment in BigStitcher
-            #sub_stack = np.asarray([io.imread(file, plugin='pil') for file in files[0:split+overlap]],dtype=np.float32)
-            sub_stack = np.asarray([io.imread(file) for file in files[0:split+overlap]],dtype=np.float32)
-
-            # run deskew for the first block of data
-            deskewed = stage_deskew(data=sub_stack,parameters=params)
-            del sub_stack
-
-            # downsample by 2x in z due to oversampling when going from OPM to coverslip geometry
-            deskewed_downsample = block_reduce(deskewed,block_size=(2,1,1),func=np.mean)
-            del deskewed
-            gc.collect()
-
-            print('Writing deskewed block 1.')
-            # write BDV tile
-            # https://github.com/nvladimus/npy2bdv 
-            bdv_writer.append_view(deskewed_downsample, time=0, channel=channel_id, tile=2*tile_id, \
-                voxel_size_xyz=(.116,.100,.116), voxel_units='um')
-
-            # free up memory
-            del deskewed_downsample
-            gc.collect()
-
-            print('Deskew block 2.')
-            # read in second block of data with a small overlap for alignment in BigStitcher
-            #sub_stack = np.asarray([io.imread(file, plugin='pil') for file in files[split-overlap:]],dtype=np.float32)
-            sub_stack = np.asarray([io.imread(file) for file in files[split-overlap:]],dtype=np.float32)
-
-            # run deskew for the second block of data
-            deskewed = stage_deskew(data=sub_stack,parameters=params)
-            del sub_stack
-
-            # downsample by 2x in z due to oversampling when going from OPM to coverslip geometry
-            deskewed_downsample = block_reduce(deskewed,block_size=(2,1,1),func=np.mean)
-            del deskewed
-            gc.collect()
-
-            print('Writing deskewed block 2.')
-            # write BDV tile
-            # https://github.com/nvladimus/npy2bdv 
-            bdv_writer.append_view(deskewed_downsample, time=0, channel=channel_id, tile=2*tile_id+1, \
-                voxel_size_xyz=(.116,.100,.116), voxel_units='um')
-
-            # free up memory
-            del deskewed_downsample
-            gc.collect()
+            # raw frames of the current channel + tile strip, from its packed container if it has one
+            source = open_strip(input_dir_path, strip)
+
+            # reverse frame order so that tilt angle is along reconstruction direction
+            reverse = False
+
+            # deskew and write each block of the tilted plane acquisition as its own BDV tile
+            for block_id, (block_start, block_end) in enumerate(block_ranges(source.num_frames, num_blocks, overlap=0.2)):
+
+                print('Deskew block '+str(block_id+1)+'.')
+                # read in block of data with a small overlap for alignment in BigStitcher
+                sub_stack = read_strip(source, block_start, block_end, reverse=reverse, report=True)[0]
+
+                # run deskew for this block of data
+                # downsample by 2x in z due to oversampling when going from OPM to coverslip geometry
+                deskewed_downsample = stage_deskew(data=sub_stack,parameters=params,z_bin=2,quality=quality,output_dtype=np.uint16,scale=output_scale)
+                del sub_stack
+                gc.collect()
+
+                print('Writing deskewed block '+str(block_id+1)+'.')
+                # write BDV tile
+                # https://github.com/nvladimus/npy2bdv
+                bdv_writer.append_view(deskewed_downsample, time=0, channel=channel_id, tile=num_blocks*tile_id+block_id, \
+                    voxel_size_xyz=(.116,.100,.116), voxel_units='um')
+
+                # free up memory
+                del deskewed_downsample
+                gc.collect()
 
     # write BDV xml file
     # https://github.com/nvladimus/npy2bdv
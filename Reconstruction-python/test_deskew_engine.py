@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+
+'''
+Regression tests for deskew_engine. Run with "python -m pytest" from this directory.
+'''
+
+# imports
+import numpy as np
+from deskew_engine import stage_deskew, deskew_output_shape, _plane_y_range, QUALITY_MODES
+
+def test_short_scan_deskews():
+    # (num_images-1)*step is below one camera pixel, so some output planes have no valid output row
+    parameters = (30, 10, 116)
+    data = np.ones((2,16,8), dtype=np.uint16)
+    for quality in QUALITY_MODES:
+        deskewed = stage_deskew(data, parameters, quality=quality, cache_dir=None, backend='numba')
+        assert deskewed.shape == deskew_output_shape(parameters, data.shape)
+        assert np.all((deskewed == 0) | (deskewed == 1))
+
+def test_short_scan_empty_plane_range():
+    tantheta = np.float32(np.tan(30*np.pi/180))
+    pixel_step = np.float32(10/116)
+    empty = 0
+    for z in range(8):
+        y_lo, y_hi = _plane_y_range(z, tantheta, pixel_step, 2)
+        assert y_lo <= y_hi
+        empty = empty + (y_lo == y_hi)
+    assert empty > 0